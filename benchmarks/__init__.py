@@ -0,0 +1 @@
+## Offline benchmarks of index build, load and query, see benchmarks/bench_index.py
@@ -0,0 +1,276 @@
+"""
+Offline benchmark of the index: build time, load time, peak memory, size on disk and retrieval latency of
+QuantSimpleVectorStorage at several corpus sizes. It needs no network and no API key: the corpus is synthetic,
+the embedding model is HashingEmbedding and the LLM is a MockLLM (only retrieval is measured).
+
+    python -m benchmarks.bench_index --sizes 1000 10000 100000 --output benchmarks/results/run.json
+    python -m benchmarks.bench_index --sizes 1000 10000 --baseline benchmarks/results/run.json
+
+Every size is built and loaded in a fresh process, so the peak RSS of each phase is its own. The results are
+written as JSON; with `--baseline` they are compared with an earlier run and the regressions are listed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# metrics compared with the baseline, and whether a higher value is better
+COMPARED_METRICS = {
+    "build_seconds": False,
+    "build_peak_rss_mb": False,
+    "load_seconds": False,
+    "load_peak_rss_mb": False,
+    "index_bytes": False,
+    "query_p50_ms": False,
+    "query_p95_ms": False,
+    "query_p99_ms": False,
+    "queries_per_second": True,
+}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def directory_bytes(folder: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(folder) for name in files
+    )
+
+
+def percentile_ms(latencies: List[float], q: float) -> float:
+    return round(float(np.percentile(latencies, q)) * 1000, 3)
+
+
+def create_storage(config: Dict[str, Any], corpus_dir: str, persist_dir: str):
+    from benchmarks.fakes import BenchmarkStorage, HashingEmbedding, use_offline_tokenizer
+
+    use_offline_tokenizer()
+    return BenchmarkStorage(
+        persist_dir=persist_dir,
+        gpt_model="mock",
+        gpt_temperature=0.0,
+        source_folder=corpus_dir,
+        vector_store_type=config["vector_store_type"],
+        docstore_type=config.get("docstore_type", "simple"),
+        retriever_mode=config["retriever_mode"],
+        chunker=config["chunker"],
+        ann=config["ann"],
+        quantization=config.get("quantization"),
+        ingestion_workers=config["ingestion_workers"],
+        embed_model=HashingEmbedding(dim=config["dim"]),
+        lazy=True,
+    )
+
+
+def build_phase(config: Dict[str, Any], corpus_dir: str, persist_dir: str) -> Dict[str, Any]:
+    """
+    Builds and persists the index the way `setup_index` does when there is no persisted index.
+    """
+    rss_before = peak_rss_mb()
+    storage = create_storage(config, corpus_dir, persist_dir)
+    rss_imported = peak_rss_mb()
+
+    started = time.perf_counter()
+    storage.index = storage.create_index()
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    storage.index.storage_context.persist(persist_dir=persist_dir)
+    storage.manifest.persist(persist_dir)
+    if storage.retriever_mode == "hybrid":
+        storage.bm25_index = storage.load_bm25_index()
+    persist_seconds = time.perf_counter() - started
+
+    return {
+        "nodes": len(storage.index.docstore.docs),
+        "build_seconds": round(build_seconds, 3),
+        "persist_seconds": round(persist_seconds, 3),
+        "build_peak_rss_mb": peak_rss_mb(),
+        "baseline_rss_mb": max(rss_before, rss_imported),
+    }
+
+
+def query_phase(config: Dict[str, Any], corpus_dir: str, persist_dir: str, queries: List[str]) -> Dict[str, Any]:
+    """
+    Loads the persisted index with `setup_index` and measures the retrieval latency of the query engine: query
+    embedding, vector (and BM25) search and the node postprocessors, without the LLM.
+    """
+    from llama_index.indices.query.schema import QueryBundle
+
+    storage = create_storage(config, corpus_dir, persist_dir)
+
+    started = time.perf_counter()
+    storage.setup_index()
+    load_seconds = time.perf_counter() - started
+    load_peak_rss = peak_rss_mb()
+
+    query_engine = storage.create_query_engine()
+    for query in queries[:config["warmup_queries"]]:
+        query_engine.retrieve(QueryBundle(query))
+
+    latencies = []
+    started = time.perf_counter()
+    for query in queries:
+        query_started = time.perf_counter()
+        query_engine.retrieve(QueryBundle(query))
+        latencies.append(time.perf_counter() - query_started)
+    total_seconds = time.perf_counter() - started
+
+    return {
+        "load_seconds": round(load_seconds, 3),
+        "load_peak_rss_mb": load_peak_rss,
+        "queries": len(queries),
+        "query_p50_ms": percentile_ms(latencies, 50),
+        "query_p95_ms": percentile_ms(latencies, 95),
+        "query_p99_ms": percentile_ms(latencies, 99),
+        "queries_per_second": round(len(queries) / total_seconds, 1),
+        "query_peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_in_fresh_process(fn: Callable, *args) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def run_size(num_chunks: int, config: Dict[str, Any], workdir: str, queries: List[str]) -> Dict[str, Any]:
+    from benchmarks.corpus import generate_corpus
+
+    corpus_dir = os.path.join(workdir, f"corpus_{num_chunks}")
+    persist_dir = os.path.join(workdir, f"index_{num_chunks}")
+    files = generate_corpus(corpus_dir, num_chunks, seed=config["seed"])
+    shutil.rmtree(persist_dir, ignore_errors=True)
+
+    logger.info(f"Benchmarking {num_chunks} chunks ({len(files)} files).")
+    result: Dict[str, Any] = {"chunks": num_chunks, "files": len(files)}
+    result.update(run_in_fresh_process(build_phase, config, corpus_dir, persist_dir))
+    result["index_bytes"] = directory_bytes(persist_dir)
+    result.update(run_in_fresh_process(query_phase, config, corpus_dir, persist_dir, queries))
+    logger.info(f"{num_chunks} chunks: {json.dumps(result)}")
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Compares the results with a baseline run of the same corpus sizes and returns a description of every metric
+    that got worse by more than `threshold` (a fraction).
+    """
+    baseline_results = {result["chunks"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result["chunks"])
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            line = f"{result['chunks']:>9} chunks  {metric:<20} {old:>12} -> {new:>12}  ({change:+.1%})"
+            print(line)
+            if worse > threshold:
+                regressions.append(line)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark of index build, load and retrieval.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                        help="Corpus sizes in chunks, up to 1000000.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of timed queries per size.")
+    parser.add_argument("--warmup-queries", type=int, default=10)
+    parser.add_argument("--vector-store-type", default="numpy", choices=["simple", "numpy"])
+    parser.add_argument("--docstore-type", default="simple", choices=["simple", "sqlite"])
+    parser.add_argument("--retriever-mode", default="hybrid", choices=["vector", "hybrid"])
+    parser.add_argument("--chunker", default="markdown", choices=["markdown", "token"])
+    parser.add_argument("--ann", default=None, choices=["ivf"])
+    parser.add_argument("--quantization", default=None, choices=["float16", "int8"])
+    parser.add_argument("--ingestion-workers", type=int, default=1)
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimensions.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default="./data/benchmarks", help="Where corpora and indexes are written.")
+    parser.add_argument("--output", default=None, help="The JSON results file, printed if not set.")
+    parser.add_argument("--baseline", default=None, help="A results file to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="The relative change that counts as a regression.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    config = {
+        "vector_store_type": args.vector_store_type,
+        "docstore_type": args.docstore_type,
+        "retriever_mode": args.retriever_mode,
+        "chunker": args.chunker,
+        "ann": args.ann,
+        "quantization": args.quantization,
+        "ingestion_workers": args.ingestion_workers,
+        "dim": args.dim,
+        "seed": args.seed,
+        "warmup_queries": args.warmup_queries,
+    }
+
+    from benchmarks.corpus import generate_queries
+
+    queries = generate_queries(args.queries, seed=args.seed)
+    results = [run_size(num_chunks, config, args.workdir, queries) for num_chunks in args.sizes]
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": config,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results written to {args.output}.")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions over {args.threshold:.0%}:")
+            print("\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+Memory and recall of the quantized NumpyVectorStore compared with exact float32 search, to pick `quantization` and
+`rerank_factor` with numbers and to fail a run when the recall loss gets too large.
+
+    python -m benchmarks.bench_quantization --persist-dir ./index/current --max-recall-loss 0.01
+    python -m benchmarks.bench_quantization --synthetic 100000 --rerank-factors 1 2 4 8
+
+The vectors are either those of a persisted index (`--persist-dir`) or synthetic ones shaped like ada-002
+embeddings: a large component shared by all of them, a topic cluster and noise. The queries are stored vectors
+with fresh noise. For every quantization the store is persisted once under `--workdir` and queried in a fresh
+process, which reports:
+    - recall_at_k: the fraction of the exact float32 top k (the first run) that the configuration returns
+    - scanned_mb: the arrays every query scans, the codes and norms with quantization, the vectors without
+    - rss_mb: the resident memory the loaded store added after all the queries, including the pages of the
+      float32 rows that were re-scored
+    - query_p50_ms / query_p95_ms: the latency of `NumpyVectorStore.query`
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.bench_index import percentile_ms
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def rss_mb() -> float:
+    """
+    The current resident set size, read from /proc on Linux.
+    """
+    with open("/proc/self/status", "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    raise RuntimeError("VmRSS not found in /proc/self/status.")
+
+
+def synthetic_embeddings(num_vectors: int, dim: int, clusters: int, seed: int,
+                         block_size: int = 16384) -> np.ndarray:
+    """
+    Returns unit-length vectors whose similarities look like ada-002's: about 0.6 between unrelated vectors and
+    about 0.85 within a topic, where the nearest neighbours are close calls.
+    """
+    rng = np.random.default_rng(seed)
+    common = rng.standard_normal(dim).astype(np.float32)
+    common /= np.linalg.norm(common)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1)[:, None]
+
+    embeddings = np.empty((num_vectors, dim), dtype=np.float32)
+    for start in range(0, num_vectors, block_size):
+        size = min(block_size, num_vectors - start)
+        noise = rng.standard_normal((size, dim)).astype(np.float32) * (0.7 / np.sqrt(dim))
+        block = 1.5 * common + centers[rng.integers(clusters, size=size)] + noise
+        embeddings[start:start + size] = block / np.linalg.norm(block, axis=1)[:, None]
+    return embeddings
+
+
+def sample_queries(embeddings: np.ndarray, num_queries: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed + 1)
+    rows = np.sort(rng.choice(len(embeddings), size=num_queries, replace=False))
+    queries = np.asarray(embeddings[rows], dtype=np.float32)
+    queries = queries / np.linalg.norm(queries, axis=1)[:, None]
+    queries += rng.standard_normal(queries.shape).astype(np.float32) * (0.7 / np.sqrt(embeddings.shape[1]))
+    return queries / np.linalg.norm(queries, axis=1)[:, None]
+
+
+def build_store(embeddings: np.ndarray, quantization: Optional[str], persist_path: str) -> float:
+    """
+    Persists the vectors as a NumpyVectorStore, which encodes the codes, and returns the seconds it took.
+    """
+    from quantgptlib.numpy_vector_store import NumpyVectorStore
+
+    ids = np.array([f"node-{row}" for row in range(len(embeddings))], dtype=np.str_)
+    store = NumpyVectorStore(
+        embeddings=embeddings,
+        norms=np.linalg.norm(embeddings, axis=1).astype(np.float32),
+        ids=ids,
+        ref_doc_ids=ids,
+        quantization=quantization,
+    )
+    started = time.perf_counter()
+    store.persist(persist_path)
+    return time.perf_counter() - started
+
+
+def query_phase(persist_path: str, quantization: Optional[str], rerank_factor: int, queries: np.ndarray, k: int,
+                warmup_queries: int) -> Dict[str, Any]:
+    """
+    Loads the persisted store like a serving process does and runs the queries.
+    """
+    from llama_index.vector_stores.types import VectorStoreQuery
+    from quantgptlib.numpy_vector_store import NumpyVectorStore
+
+    rss_before = rss_mb()
+    store = NumpyVectorStore.from_persist_path(persist_path, quantization=quantization, rerank_factor=rerank_factor)
+    if quantization is not None and not store.is_quantized:
+        raise RuntimeError(f"The store at {persist_path} has no {quantization} codes.")
+
+    for query in queries[:warmup_queries]:
+        store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=k))
+
+    results, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        result = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=k))
+        latencies.append(time.perf_counter() - started)
+        results.append(result.ids)
+
+    scanned = store._codes if store.is_quantized else store._embeddings
+    return {
+        "ids": results,
+        "scanned_mb": round((scanned.nbytes + store._norms.nbytes) / 2 ** 20, 1),
+        "rss_mb": round(rss_mb() - rss_before, 1),
+        "query_p50_ms": percentile_ms(latencies, 50),
+        "query_p95_ms": percentile_ms(latencies, 95),
+    }
+
+
+def run_in_fresh_process(fn, *args) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def recall(ids: List[List[str]], exact_ids: List[List[str]]) -> float:
+    return float(np.mean([len(set(found) & set(exact)) / len(exact) for found, exact in zip(ids, exact_ids)]))
+
+
+def print_table(results: List[Dict[str, Any]]):
+    columns = list(results[0])
+    rows = [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Memory and recall of the quantized vector store.")
+    parser.add_argument("--persist-dir", default=None, help="Benchmark the vectors of this persisted index.")
+    parser.add_argument("--synthetic", type=int, default=50000, metavar="N",
+                        help="The number of synthetic vectors, without --persist-dir.")
+    parser.add_argument("--dim", type=int, default=1536, help="Dimensions of the synthetic vectors.")
+    parser.add_argument("--clusters", type=int, default=500, help="Topics of the synthetic vectors.")
+    parser.add_argument("--quantizations", nargs="+", default=["float16", "int8"], choices=["float16", "int8"])
+    parser.add_argument("--rerank-factors", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup-queries", type=int, default=10)
+    parser.add_argument("--max-recall-loss", type=float, default=0.01,
+                        help="Fail if the default rerank factor loses more recall@k than this.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default="./data/bench_quantization", help="Where the stores are written.")
+    parser.add_argument("--output", default=None, help="The JSON results file.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.persist_dir:
+        embeddings = np.load(os.path.join(args.persist_dir, "vector_store.npy"), mmap_mode="r")
+    else:
+        embeddings = synthetic_embeddings(args.synthetic, args.dim, args.clusters, args.seed)
+    queries = sample_queries(embeddings, min(args.queries, len(embeddings)), args.seed)
+    logger.info(f"Benchmarking {len(queries)} queries on {embeddings.shape[0]} x {embeddings.shape[1]} vectors.")
+
+    from quantgptlib.numpy_vector_store import NumpyVectorStore
+
+    default_rerank_factor = NumpyVectorStore().rerank_factor
+    results: List[Dict[str, Any]] = []
+    exact_ids = None
+    for quantization in [None, *args.quantizations]:
+        persist_path = os.path.join(args.workdir, quantization or "float32", "vector_store.json")
+        shutil.rmtree(os.path.dirname(persist_path), ignore_errors=True)
+        build_seconds = build_store(embeddings, quantization, persist_path)
+
+        for rerank_factor in args.rerank_factors if quantization else [1]:
+            result = run_in_fresh_process(query_phase, persist_path, quantization, rerank_factor, queries,
+                                          args.top_k, args.warmup_queries)
+            ids = result.pop("ids")
+            if exact_ids is None:
+                exact_ids = ids
+            results.append({
+                "quantization": quantization or "float32",
+                "rerank_factor": rerank_factor if quantization else None,
+                f"recall_at_{args.top_k}": round(recall(ids, exact_ids), 4),
+                "build_seconds": round(build_seconds, 3),
+                **result,
+            })
+            logger.info(json.dumps(results[-1]))
+
+    print_table(results)
+    failed = [
+        result for result in results
+        if result["rerank_factor"] == default_rerank_factor
+        and 1.0 - result[f"recall_at_{args.top_k}"] > args.max_recall_loss
+    ]
+    for result in failed:
+        print(f"{result['quantization']} loses more than {args.max_recall_loss} recall@{args.top_k}.")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"vectors": list(embeddings.shape), "queries": len(queries), "results": results}, f, indent=2)
+        logger.info(f"Results written to {args.output}.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
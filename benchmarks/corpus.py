@@ -0,0 +1,130 @@
+import os
+import json
+import random
+import logging
+from typing import List
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+CORPUS_INFO_FNAME = "corpus.json"
+
+_CLASSES = ["Portfolio", "Data", "Signals", "Records", "Orders", "Trades", "Drawdowns", "Ranges", "Splitter",
+            "Indicator", "Returns", "Accessor", "Wrapper", "Grouper", "Chunker", "Jitted", "Parameter", "Template"]
+_METHODS = ["from_signals", "from_orders", "from_holding", "from_random", "run", "stats", "plot", "resample",
+            "realign", "apply", "to_mapped", "get_value", "get_returns", "total_return", "sharpe_ratio", "split",
+            "fetch", "update", "rolling_apply", "combine", "broadcast", "concat", "select", "items"]
+_ARGUMENTS = ["close", "entries", "exits", "sl_stop", "tp_stop", "tsl_stop", "size", "size_type", "direction",
+              "fees", "slippage", "init_cash", "freq", "group_by", "cash_sharing", "call_seq", "accumulate",
+              "upon_opposite_entry", "chunked", "jitted", "wrapper_kwargs", "template_context"]
+_WORDS = ["the", "a", "of", "to", "and", "is", "in", "for", "with", "by", "when", "each", "column", "row", "signal",
+          "order", "position", "trade", "price", "value", "array", "frame", "series", "index", "window", "stop",
+          "loss", "profit", "entry", "exit", "long", "short", "cash", "return", "metric", "parameter", "group",
+          "strategy", "backtest", "simulation", "portfolio", "indicator", "data", "symbol", "timeframe", "record"]
+
+
+def _identifier(rng: random.Random) -> str:
+    return f"vbt.{rng.choice(_CLASSES)}.{rng.choice(_METHODS)}"
+
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 16))]
+    # documentation sentences mention the API they describe
+    words.insert(rng.randrange(len(words)), f"`{_identifier(rng) if rng.random() < 0.5 else rng.choice(_ARGUMENTS)}`")
+    return " ".join(words).capitalize() + "."
+
+
+def _section(rng: random.Random, number: int, words_per_section: int) -> str:
+    parts = [f"# {rng.choice(_CLASSES)} {rng.choice(_METHODS).replace('_', ' ')} {number}"]
+    paragraph: List[str] = []
+    words = 0
+    while words < words_per_section:
+        sentence = _sentence(rng)
+        paragraph.append(sentence)
+        words += sentence.count(" ") + 1
+        if len(paragraph) == 4:
+            parts.append(" ".join(paragraph))
+            paragraph = []
+    if paragraph:
+        parts.append(" ".join(paragraph))
+
+    roll = rng.random()
+    if roll < 0.3:
+        arguments = ", ".join(f"{argument}={rng.randint(1, 100)}" for argument in rng.sample(_ARGUMENTS, 3))
+        parts.append(f"```pycon\n>>> pf = {_identifier(rng)}(close, {arguments})\n>>> pf.stats()\n```")
+    elif roll < 0.4:
+        rows = [f"| {argument} | {' '.join(rng.choice(_WORDS) for _ in range(6))} |"
+                for argument in rng.sample(_ARGUMENTS, 4)]
+        parts.append("\n".join(["| Argument | Description |", "|---|---|", *rows]))
+    return "\n\n".join(parts)
+
+
+def generate_corpus(folder: str, num_sections: int, sections_per_file: int = 50, words_per_section: int = 80,
+                    seed: int = 0) -> List[str]:
+    """
+    Writes a synthetic, vectorbt-like markdown corpus of `num_sections` sections to `folder` and returns the file
+    paths. Every section is a top-level heading with a few paragraphs that mention API names, some with a code
+    block or a table, and is short enough to become exactly one chunk, so the number of sections is the number
+    of indexed chunks.
+
+    The output only depends on the arguments. A folder that already holds the same corpus is reused.
+    """
+    info = dict(num_sections=num_sections, sections_per_file=sections_per_file,
+                words_per_section=words_per_section, seed=seed)
+    info_path = os.path.join(folder, CORPUS_INFO_FNAME)
+    if os.path.exists(info_path):
+        with open(info_path, "r", encoding="utf-8") as f:
+            existing = json.load(f)
+        if existing.get("info") == info:
+            return existing["files"]
+
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for file_number, start in enumerate(range(0, num_sections, sections_per_file)):
+        # one generator per file, any file can be regenerated on its own
+        rng = random.Random(f"{seed}:{file_number}")
+        path = os.path.join(folder, f"page_{file_number:06d}.md")
+        sections = [_section(rng, number, words_per_section)
+                    for number in range(start, min(start + sections_per_file, num_sections))]
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(sections) + "\n")
+        files.append(path)
+
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump({"info": info, "files": files}, f)
+    logger.info(f"Generated {num_sections} sections in {len(files)} files in {folder}.")
+    return files
+
+
+def generate_queries(num_queries: int, seed: int = 0) -> List[str]:
+    """
+    Returns questions in the style of the users of the chat, most of them naming an API or an argument.
+    """
+    rng = random.Random(f"queries:{seed}")
+    queries = []
+    for _ in range(num_queries):
+        subject = _identifier(rng) if rng.random() < 0.6 else rng.choice(_ARGUMENTS)
+        words = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 8)))
+        queries.append(f"How do I use {subject} {words}?")
+    return queries
+
+
+def generate_golden_set(files: List[str], num_questions: int, seed: int = 0) -> List[dict]:
+    """
+    Returns golden questions about random sections of a synthetic corpus, each with the file of its section as the
+    expected source. Only meant to exercise the evaluation harness, a real golden set is written by hand.
+    """
+    rng = random.Random(f"golden:{seed}")
+    golden = []
+    for _ in range(num_questions):
+        path = rng.choice(files)
+        with open(path, "r", encoding="utf-8") as f:
+            sections = f.read().split("\n# ")
+        section = rng.choice(sections)
+        title = " ".join(word for word in section.lstrip("# ").split("\n", 1)[0].split() if not word.isdigit())
+        names = [part.split("`")[0] for part in section.split("`")[1::2]] or [title]
+        golden.append({
+            "question": f"How do I use {rng.choice(names)} for {title.lower()}?",
+            "expected_files": [os.path.basename(path)],
+        })
+    return golden
@@ -0,0 +1,267 @@
+"""
+Retrieval quality versus cost of QuantSimpleVectorStorage, to tune `similarity_top_k`, `similarity_cutoff`, the
+chunk size, the retriever mode and the context token budget with numbers instead of guesses.
+
+    python -m benchmarks.eval_retrieval --golden-set golden.jsonl --source-folder ./quant_scraper/docs \
+        --embedding-cache ./data/embedding_cache.sqlite --chunk-sizes 512 1024 --top-k 5 10 20 \
+        --cutoffs 0.7 0.73 0.77 --retriever-modes vector hybrid --min-recall 0.9 --output eval.json
+
+The golden set is a JSONL file with one question per line and the files that answer it, relative to the source
+folder:
+
+    {"question": "How do I set a trailing stop?", "expected_files": ["api/portfolio/base.md"]}
+
+For every chunker and chunk size an index is built once under `--workdir` (and updated incrementally after
+that), the document and question embeddings go through the SQLite embedding cache, so repeating a sweep only
+costs the retrieval itself. Every configuration reports recall@k (the fraction of the expected files among the
+retrieved nodes), MRR, the number of context tokens passed to the LLM and the retrieval latency without the
+question embedding. `--synthetic N` evaluates a generated corpus with a generated golden set and
+HashingEmbedding, to try the harness without network access.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def load_golden_set(path: str) -> List[Dict[str, Any]]:
+    golden = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if not item.get("expected_files"):
+                    raise ValueError(f"Golden question without expected files: {item.get('question')}")
+                golden.append(item)
+    return golden
+
+
+def relative_source(file_path: str, source_folder: str) -> str:
+    return os.path.normpath(os.path.relpath(file_path, source_folder))
+
+
+def embed_questions(embed_model, questions: Sequence[str], cache_path: Optional[str]) -> List[List[float]]:
+    """
+    Embeds the questions once for the whole sweep. Query embeddings are cached under their own model name, some
+    models embed queries and documents differently.
+    """
+    from quantgptlib.embedding_pipeline import EmbeddingCache, EmbeddingPipeline
+
+    async def embed_fn(texts: List[str]) -> List[List[float]]:
+        return [await embed_model.aget_query_embedding(text) for text in texts]
+
+    pipeline = EmbeddingPipeline(
+        embed_fn=embed_fn,
+        model_name=f"{embed_model.model_name}:query",
+        cache=EmbeddingCache(cache_path) if cache_path else None,
+    )
+    embeddings = pipeline.embed_texts(questions)
+    logger.info(f"Question embeddings: {pipeline.last_stats}")
+    return embeddings
+
+
+def score(retrieved_files: List[str], expected_files: Sequence[str]) -> Dict[str, float]:
+    """
+    Returns the recall of the expected files among the retrieved ones and the reciprocal rank of the first hit.
+    """
+    expected = {os.path.normpath(path) for path in expected_files}
+    found = expected.intersection(retrieved_files)
+    reciprocal_rank = 0.0
+    for rank, path in enumerate(retrieved_files, start=1):
+        if path in expected:
+            reciprocal_rank = 1.0 / rank
+            break
+    return {"recall": len(found) / len(expected), "reciprocal_rank": reciprocal_rank}
+
+
+def evaluate(storage, golden: List[Dict[str, Any]], embeddings: List[List[float]]) -> Dict[str, Any]:
+    """
+    Runs every golden question through the retriever and the node postprocessors of the storage's query engine,
+    as configured on the storage, and averages the scores.
+    """
+    from llama_index.indices.query.schema import QueryBundle
+    from llama_index.schema import MetadataMode
+    from llama_index.utils import globals_helper
+
+    query_engine = storage.create_query_engine()
+    recalls, reciprocal_ranks, context_tokens, node_counts, latencies = [], [], [], [], []
+    for item, embedding in zip(golden, embeddings):
+        started = time.perf_counter()
+        nodes = query_engine.retrieve(QueryBundle(item["question"], embedding=embedding))
+        latencies.append(time.perf_counter() - started)
+
+        retrieved_files = [
+            relative_source(node.node.metadata["file_path"], storage.source_folder)
+            for node in nodes if "file_path" in node.node.metadata
+        ]
+        scores = score(retrieved_files, item["expected_files"])
+        recalls.append(scores["recall"])
+        reciprocal_ranks.append(scores["reciprocal_rank"])
+        context_tokens.append(sum(
+            len(globals_helper.tokenizer(node.node.get_content(metadata_mode=MetadataMode.LLM))) for node in nodes
+        ))
+        node_counts.append(len(nodes))
+
+    return {
+        "recall_at_k": round(float(np.mean(recalls)), 4),
+        "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+        "context_tokens": round(float(np.mean(context_tokens)), 1),
+        "nodes": round(float(np.mean(node_counts)), 2),
+        "retrieval_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "retrieval_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+    }
+
+
+def create_storage(args: argparse.Namespace, source_folder: str, chunker: str, chunk_size: int):
+    from benchmarks.fakes import BenchmarkStorage, HashingEmbedding, use_offline_tokenizer
+
+    embed_model = None
+    if args.fake_embeddings:
+        use_offline_tokenizer()
+        embed_model = HashingEmbedding(dim=args.dim)
+    storage = BenchmarkStorage(
+        persist_dir=os.path.join(args.workdir, f"index_{chunker}_{chunk_size}"),
+        gpt_model="mock",
+        gpt_temperature=0.0,
+        source_folder=source_folder,
+        incremental=True,
+        vector_store_type="numpy",
+        embed_model=embed_model,
+        embedding_cache_path=args.embedding_cache,
+        ingestion_workers=args.ingestion_workers,
+        chunker=chunker,
+        chunk_size=chunk_size,
+        lazy=True,
+    )
+    storage.setup_index()
+    return storage
+
+
+def sweep(storage, golden: List[Dict[str, Any]], embeddings: List[List[float]], args: argparse.Namespace,
+          chunker: str, chunk_size: int) -> List[Dict[str, Any]]:
+    results = []
+    budgets = [None if budget.lower() == "none" else int(budget) for budget in args.context_budgets]
+    for retriever_mode, top_k, cutoff, budget in itertools.product(
+            args.retriever_modes, args.top_k, args.cutoffs, budgets):
+        if retriever_mode == "hybrid" and storage.bm25_index is None:
+            storage.bm25_index = storage.load_bm25_index()
+        # in hybrid mode k is the number of fused nodes, both retrievers contribute k candidates
+        storage.retriever_mode = retriever_mode
+        storage.similarity_top_k = top_k
+        storage.hybrid_top_k = top_k
+        storage.similarity_cutoff = cutoff
+        storage.context_token_budget = budget
+
+        result = {
+            "chunker": chunker,
+            "chunk_size": chunk_size,
+            "retriever_mode": retriever_mode,
+            "top_k": top_k,
+            "cutoff": cutoff,
+            "context_budget": budget,
+        }
+        result.update(evaluate(storage, golden, embeddings))
+        logger.info(json.dumps(result))
+        results.append(result)
+    return results
+
+
+def pick_cheapest(results: List[Dict[str, Any]], min_recall: float) -> Optional[Dict[str, Any]]:
+    """
+    Returns the configuration with the fewest context tokens, then the lowest latency, that reaches `min_recall`.
+    """
+    candidates = [result for result in results if result["recall_at_k"] >= min_recall]
+    return min(candidates, key=lambda result: (result["context_tokens"], result["retrieval_p50_ms"]), default=None)
+
+
+def print_table(results: List[Dict[str, Any]]):
+    columns = ["chunker", "chunk_size", "retriever_mode", "top_k", "cutoff", "context_budget", "recall_at_k", "mrr",
+               "context_tokens", "retrieval_p50_ms", "retrieval_p95_ms"]
+    rows = [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Sweep retrieval settings against a golden set of questions.")
+    parser.add_argument("--golden-set", default=None, help="The JSONL file of questions and expected files.")
+    parser.add_argument("--source-folder", default="./quant_scraper/docs")
+    parser.add_argument("--synthetic", type=int, default=None, metavar="N",
+                        help="Evaluate N generated questions on a generated corpus, implies --fake-embeddings.")
+    parser.add_argument("--synthetic-sections", type=int, default=2000)
+    parser.add_argument("--chunkers", nargs="+", default=["markdown"], choices=["markdown", "token"])
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[1024])
+    parser.add_argument("--retriever-modes", nargs="+", default=["vector"], choices=["vector", "hybrid"])
+    parser.add_argument("--top-k", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--cutoffs", type=float, nargs="+", default=[0.0, 0.7, 0.73, 0.77])
+    parser.add_argument("--context-budgets", nargs="+", default=["none"],
+                        help="Context token budgets, 'none' for no budget.")
+    parser.add_argument("--embedding-cache", default="./data/embedding_cache.sqlite")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use HashingEmbedding instead of the OpenAI embedding model.")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimensions of --fake-embeddings.")
+    parser.add_argument("--ingestion-workers", type=int, default=1)
+    parser.add_argument("--workdir", default="./data/eval_retrieval", help="Where the indexes are written.")
+    parser.add_argument("--min-recall", type=float, default=None,
+                        help="Report the cheapest configuration that reaches this recall@k.")
+    parser.add_argument("--output", default=None, help="The JSON results file.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    os.makedirs(args.workdir, exist_ok=True)
+    source_folder = args.source_folder
+    if args.synthetic:
+        from benchmarks.corpus import generate_corpus, generate_golden_set
+
+        args.fake_embeddings = True
+        source_folder = os.path.join(args.workdir, f"corpus_{args.synthetic_sections}")
+        files = generate_corpus(source_folder, args.synthetic_sections, seed=args.seed)
+        golden = generate_golden_set(files, args.synthetic, seed=args.seed)
+    elif args.golden_set:
+        golden = load_golden_set(args.golden_set)
+    else:
+        parser.error("either --golden-set or --synthetic is required")
+
+    results = []
+    embeddings = None
+    for chunker, chunk_size in itertools.product(args.chunkers, args.chunk_sizes):
+        logger.info(f"Setting up the {chunker} index with {chunk_size} token chunks.")
+        storage = create_storage(args, source_folder, chunker, chunk_size)
+        if embeddings is None:
+            embeddings = embed_questions(storage.embed_model, [item["question"] for item in golden],
+                                         args.embedding_cache)
+        results.extend(sweep(storage, golden, embeddings, args, chunker, chunk_size))
+
+    results.sort(key=lambda result: (-result["recall_at_k"], result["context_tokens"]))
+    print_table(results)
+    report: Dict[str, Any] = {"questions": len(golden), "results": results}
+    if args.min_recall is not None:
+        report["cheapest"] = pick_cheapest(results, args.min_recall)
+        if report["cheapest"] is None:
+            print(f"\nNo configuration reaches a recall@k of {args.min_recall}.")
+        else:
+            print(f"\nCheapest configuration with a recall@k of at least {args.min_recall}:")
+            print(json.dumps(report["cheapest"], indent=2))
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results written to {args.output}.")
+    return 0 if args.min_recall is None or report["cheapest"] is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
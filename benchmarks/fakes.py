@@ -0,0 +1,91 @@
+import re
+import zlib
+import logging
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+from llama_index import LLMPredictor
+from llama_index.bridge.pydantic import Field
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import MockLLM
+from llama_index.utils import globals_helper
+
+from quantgptlib.bm25_index import tokenize
+from quantgptlib.simple_vector_storage import QuantSimpleVectorStorage
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+@lru_cache(maxsize=65536)
+def _term_slot(term: str) -> Tuple[int, float]:
+    code = zlib.crc32(term.encode("utf-8"))
+    return code, 1.0 if code & 0x80000000 else -1.0
+
+
+class HashingEmbedding(BaseEmbedding):
+    """
+    A deterministic, offline embedding model for benchmarks. Every term of the text (see `tokenize`) adds +1 or -1
+    to one of `dim` dimensions picked by its crc32, and the vector is normalized. Texts that share terms get similar
+    vectors, so retrieval returns sensible neighbours, and the vectors have the shape of real ones.
+    """
+
+    dim: int = Field(default=1536, description="The number of dimensions, 1536 like OpenAI's ada-002.")
+
+    def __init__(self, dim: int = 1536, **kwargs):
+        kwargs.setdefault("model_name", f"hashing-{dim}")
+        super().__init__(dim=dim, **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashingEmbedding"
+
+    def embed(self, text: str) -> List[float]:
+        slots = [_term_slot(term) for term in tokenize(text)]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if slots:
+            codes, signs = zip(*slots)
+            vector = np.bincount(np.asarray(codes, dtype=np.int64) % self.dim, weights=signs,
+                                 minlength=self.dim).astype(np.float32)
+        norm = float(np.linalg.norm(vector))
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self.embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self.embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._get_text_embeddings(texts)
+
+
+def use_offline_tokenizer():
+    """
+    Makes llama_index count tokens without tiktoken if its encoding files can not be loaded, which needs network
+    access the first time. The counts are close enough for chunking and prompt packing.
+    """
+    try:
+        globals_helper.tokenizer("warm up")
+    except Exception as e:
+        logger.warning(f"tiktoken is not available offline ({type(e).__name__}), counting words and punctuation.")
+        globals_helper._tokenizer = _TOKEN_RE.findall
+
+
+class BenchmarkStorage(QuantSimpleVectorStorage):
+    """
+    QuantSimpleVectorStorage with a MockLLM instead of ChatOpenAI. The embedding model is passed in, see
+    HashingEmbedding.
+    """
+
+    def create_llm_predictor(self) -> LLMPredictor:
+        return LLMPredictor(llm=MockLLM(max_tokens=16))
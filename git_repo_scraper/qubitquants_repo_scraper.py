@@ -2,8 +2,80 @@ import os
 import re
 import platform
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+import nbformat
+from nbconvert import MarkdownExporter
+from nbconvert.preprocessors import Preprocessor
+
+# The last commit whose notebooks were converted, kept in the output directory
+CONVERTED_COMMIT_FNAME = '.converted_commit'
+
+
+class StripOutputsPreprocessor(Preprocessor):
+    """
+    Removes what does not belong in the documentation index while the notebook is converted: the HTML of rich
+    outputs like dataframes and plots (the plain text version is kept), `<div>` blocks in markdown cells, and the
+    tail of outputs longer than `max_output_chars`.
+    """
+
+    def __init__(self, remove_html_content=True, max_output_chars=2000, **kwargs):
+        super().__init__(**kwargs)
+        self.remove_html_content = remove_html_content
+        self.max_output_chars = max_output_chars
+
+    def truncate(self, text):
+        if isinstance(text, list):
+            text = ''.join(text)
+        if self.max_output_chars and len(text) > self.max_output_chars:
+            return text[:self.max_output_chars] + '\n... (output truncated)\n'
+        return text
+
+    def preprocess_cell(self, cell, resources, index):
+        if cell.cell_type == 'markdown' and self.remove_html_content:
+            cell.source = re.sub('<div>.*?</div>', '', cell.source, flags=re.DOTALL)
+        elif cell.cell_type == 'code':
+            for output in cell.get('outputs', []):
+                if output.output_type == 'stream':
+                    output.text = self.truncate(output.text)
+                elif 'data' in output:
+                    if self.remove_html_content and 'text/html' in output.data:
+                        del output.data['text/html']
+                    if 'text/plain' in output.data:
+                        output.data['text/plain'] = self.truncate(output.data['text/plain'])
+        return cell, resources
+
+
+def convert_notebook(notebook_path, output_dir, remove_html_content=True, max_output_chars=2000):
+    """
+    Converts one notebook to `<output_dir>/<name>.md` like `jupyter nbconvert --to markdown`, images included, in
+    the calling process. Runs in the worker processes of `GitRepoScrapper.convert_ipynb_to_md`.
+    """
+    name = os.path.splitext(os.path.basename(notebook_path))[0]
+    notebook = nbformat.read(notebook_path, as_version=4)
+
+    exporter = MarkdownExporter()
+    exporter.register_preprocessor(
+        StripOutputsPreprocessor(remove_html_content=remove_html_content, max_output_chars=max_output_chars),
+        enabled=True,
+    )
+    body, resources = exporter.from_notebook_node(
+        notebook, resources={'unique_key': name, 'output_files_dir': f'{name}_files'})
+
+    # Images of the outputs are written next to the markdown file, where the markdown links them
+    for filename, data in resources.get('outputs', {}).items():
+        path = os.path.join(output_dir, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    md_path = os.path.join(output_dir, f'{name}.md')
+    with open(md_path, 'w', encoding='utf-8-sig') as f:
+        f.write(body)
+    return md_path
+
+
 class GitRepoScrapper:
     """This class object handles the operations to clone and scrap the content in a git repo into Markdown format"""
     def __init__(self, repo_url, repo_path):
@@ -46,57 +118,109 @@ class GitRepoScrapper:
                 # Remove directory or file on Linux or MacOS
                 subprocess.run(['rm', '-rf', path], check=False)
 
+    def git(self, *args):
+        """
+        Runs a git command in the repo and returns its output, or None if it failed.
+        """
+        result = subprocess.run(['git', '-C', self.repo_path, *args], capture_output=True, text=True, check=False)
+        return result.stdout if result.returncode == 0 else None
 
-    def convert_ipynb_to_md(self, verbose: bool = True, remove_html_content : bool = True):
+    def changed_notebooks(self, ipynb_files, md_directory):
         """
-        This function converts the downloaded .ipynb files in a folder to markdown format. 
-        If `remove_html_content` is set to True, it will remove the content between <div> tags like dataframe outputs
-        If `verbose` is set to True, it will print some console messages when doing the `nbconvert` operations. 
+        Returns the notebooks to convert and the deleted notebooks since the last converted commit. Without a
+        converted commit, or when git can not compare with it (e.g. after a force push), every notebook is
+        converted.
+        """
+        commit_path = os.path.join(md_directory, CONVERTED_COMMIT_FNAME)
+        last_commit = None
+        if os.path.exists(commit_path):
+            with open(commit_path, 'r', encoding='utf-8') as f:
+                last_commit = f.read().strip()
+
+        diff = self.git('diff', '--name-status', '--no-renames', last_commit, 'HEAD') if last_commit else None
+        if diff is None:
+            return list(ipynb_files), []
+
+        changed, deleted = set(), []
+        for line in diff.splitlines():
+            status, _, path = line.partition('\t')
+            # only the notebooks at the top of the repo are converted
+            if not path.endswith('.ipynb') or '/' in path:
+                continue
+            if status == 'D':
+                deleted.append(path)
+            else:
+                changed.add(path)
+
+        # a notebook whose markdown is missing is converted again, whatever changed
+        for file in ipynb_files:
+            if not os.path.exists(os.path.join(md_directory, f'{os.path.splitext(file)[0]}.md')):
+                changed.add(file)
+        return sorted(changed & set(ipynb_files)), deleted
+
+    def convert_ipynb_to_md(self, verbose: bool = True, remove_html_content : bool = True, max_workers: int = None,
+                            max_output_chars: int = 2000):
+        """
+        This function converts the downloaded .ipynb files in a folder to markdown format.
+        Only the notebooks that changed since the last converted commit are converted, in parallel in `max_workers`
+        processes (one per CPU core by default), and the markdown of deleted notebooks is removed.
+        If `remove_html_content` is set to True, it will remove the HTML of outputs like dataframes and the content
+        between <div> tags in markdown cells. Outputs are cut at `max_output_chars` characters.
+        If `verbose` is set to True, it will print some console messages when doing the conversions.
         """
         # Get a list of all Jupyter notebook files in the repository
         ipynb_files = [file for file in os.listdir(self.repo_path) if file.endswith('.ipynb')]
         print(f"List of Jupyter Notebooks in Git Repo: {self.repo_url}\n" + "\n".join(f"\t• {file}" for file in ipynb_files))
         print("\n")
 
-        # Create a progress bar
-        pbar_ipynb = tqdm(ipynb_files, unit="notebook")
-
         # Create the 'docs_md' directory if it doesn't exist
         md_directory = os.path.join(self.repo_path, "docs_md")
         os.makedirs(md_directory, exist_ok=True)
 
-        # Loop through the files in the repository with a progress bar
-        for file in pbar_ipynb:
-            # Update the description
-            pbar_ipynb.set_description(f"Converting {file} to Markdown format")            
-            # Convert it to markdown
-            os.system(f'jupyter nbconvert --to markdown "{os.path.join(self.repo_path, file)}" \
-                        --output-dir="{os.path.join(self.repo_path, "docs_md")}"' \
-                        + (' > /dev/null 2>&1' if not verbose else ''))   
-
-
-        if remove_html_content:
-            md_files = [file for file in os.listdir(os.path.join(self.repo_path, "docs_md")) if file.endswith('.md')]
-            # Create a progress bar
-            pbar_md = tqdm(md_files, unit="file")
-            # Loop through the markdown files in the docs directory and remove HTML content like dataframe outputs
-            for file in pbar_md:
-                file_path = os.path.join(self.repo_path, "docs_md", file)
-                # Update the description
-                pbar_md.set_description(f"Removing HTML Content in {file}")                 
-                # Read the file
-                with open(file_path, 'r', encoding='utf-8-sig') as f:
-                    content = f.read()
-
-                # Remove all content within <div> tags
-                cleaned_content = re.sub('<div>.*?</div>', '', content, flags=re.DOTALL)
-
-                # Write the cleaned content back to the file
-                with open(file_path, 'w', encoding='utf-8-sig') as f:
-                    f.write(cleaned_content)
-
-
-processor = GitRepoScrapper(repo_url = 'https://github.com/QubitQuants/vectorbt_pro_tutorials.git', 
-                            repo_path = 'qubit_quants_vbt_repo')
-processor.clone_update_repo()
-processor.convert_ipynb_to_md(verbose = False, remove_html_content = True)
+        head = (self.git('rev-parse', 'HEAD') or '').strip()
+        to_convert, deleted = self.changed_notebooks(ipynb_files, md_directory)
+
+        for file in deleted:
+            md_path = os.path.join(md_directory, f'{os.path.splitext(file)[0]}.md')
+            if os.path.exists(md_path):
+                os.remove(md_path)
+                if verbose:
+                    print(f"Removed {md_path}, its notebook was deleted")
+
+        if not to_convert:
+            print("The notebooks did not change since the last conversion.")
+        else:
+            failed = []
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(convert_notebook, os.path.join(self.repo_path, file), md_directory,
+                                    remove_html_content, max_output_chars): file
+                    for file in to_convert
+                }
+                # Create a progress bar
+                pbar_ipynb = tqdm(as_completed(futures), total=len(futures), unit="notebook",
+                                  desc="Converting notebooks to Markdown format")
+                for future in pbar_ipynb:
+                    file = futures[future]
+                    try:
+                        md_path = future.result()
+                        if verbose:
+                            pbar_ipynb.write(f"Converted {file} to {md_path}")
+                    except Exception as e:
+                        failed.append(file)
+                        print(f"Failed to convert {file}: {e}")
+            if failed:
+                # the converted commit is not moved, the failed notebooks are converted again next time
+                return
+
+        if head:
+            with open(os.path.join(md_directory, CONVERTED_COMMIT_FNAME), 'w', encoding='utf-8') as f:
+                f.write(head)
+
+
+if __name__ == "__main__":
+    # The conversion workers import this module, only the main process clones and converts
+    processor = GitRepoScrapper(repo_url = 'https://github.com/QubitQuants/vectorbt_pro_tutorials.git',
+                                repo_path = 'qubit_quants_vbt_repo')
+    processor.clone_update_repo()
+    processor.convert_ipynb_to_md(verbose = False, remove_html_content = True)
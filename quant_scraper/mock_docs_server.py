@@ -0,0 +1,153 @@
+"""
+A local stand-in for the vectorbt.pro docs to tune the crawler settings against, without hammering the real site.
+
+    python mock_docs_server.py --pages 2000 --latency 0.15 --max-concurrency 8
+    scrapy crawl vbt_pro -a secret_url=pvt_mock -a base_url=http://127.0.0.1:8765 -s JOBDIR=crawls/mock
+
+It serves the five sections and an API tree of `--pages` pages. Every page links to a few others with the
+spellings a real site uses (fragments, query strings, with and without a trailing slash, `index.html`), answers
+conditional requests with 304 and takes `--latency` seconds. Beyond `--max-concurrency` requests in flight it
+answers 503 like an overloaded server. Stop it with Ctrl-C (or SIGTERM) to print the number of requests, 304s,
+503s, pages fetched more than once and the peak concurrency, then compare crawl times of different settings.
+"""
+import sys
+import time
+import random
+import signal
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+SECTIONS = ['features', 'tutorials', 'documentation', 'api', 'cookbook']
+
+
+class MockDocs:
+    def __init__(self, secret_url, pages, seed=0):
+        self.secret_url = secret_url
+        self.modules = [f'module_{i:05d}' for i in range(pages)]
+        self.rng = random.Random(seed)
+        # the links of every page and their spelling are fixed, so repeated crawls see the same site
+        self.links = {
+            title: [self.rng.choice(self.link_variants(target)) for target in self.rng.sample(self.modules, 5)]
+            for title in [*self.modules, *SECTIONS]
+        }
+        self.last_modified = formatdate(time.time(), usegmt=True)
+
+    def link_variants(self, module):
+        base = f'/{self.secret_url}/api/{module}'
+        return [f'{base}/', base, f'{base}/#section-1', f'{base}/?version=2', f'{base}/index.html']
+
+    def page(self, path):
+        parts = [part for part in path.split('/') if part and part != 'index.html']
+        if len(parts) < 2 or parts[0] != self.secret_url or parts[1] not in SECTIONS:
+            return None
+        if parts[1] == 'api' and len(parts) == 3 and parts[2] in self.modules:
+            title = parts[2]
+        elif len(parts) == 2:
+            title = parts[1]
+        else:
+            return None
+        links = ''.join(f'<li><a href="{href}">{href}</a></li>' for href in self.links[title])
+        paragraphs = ''.join(f'<p>{title} paragraph {i} about portfolios, signals and orders.</p>' for i in range(20))
+        return (f'<html><head><title>{title}</title></head><body><article><h1>{title}</h1>{paragraphs}'
+                f'<ul>{links}</ul></article></body></html>').encode('utf-8')
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.fetches = Counter()
+        self.in_flight = 0
+        self.peak = 0
+
+
+def make_handler(docs, stats, latency, max_concurrency):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with stats.lock:
+                stats.counts['requests'] += 1
+                stats.in_flight += 1
+                stats.peak = max(stats.peak, stats.in_flight)
+                overloaded = max_concurrency and stats.in_flight > max_concurrency
+            try:
+                self.respond(overloaded)
+            finally:
+                with stats.lock:
+                    stats.in_flight -= 1
+
+        def respond(self, overloaded):
+            if overloaded:
+                with stats.lock:
+                    stats.counts['503'] += 1
+                self.send_error(503)
+                return
+            time.sleep(latency)
+
+            path = urlsplit(self.path).path
+            body = docs.page(path)
+            if body is None:
+                with stats.lock:
+                    stats.counts['404'] += 1
+                self.send_error(404)
+                return
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                with stats.lock:
+                    stats.counts['304'] += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            with stats.lock:
+                stats.fetches[path.rstrip('/').removesuffix('/index.html')] += 1
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', docs.last_modified)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a mock vectorbt.pro docs tree.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--secret-url', default='pvt_mock')
+    parser.add_argument('--pages', type=int, default=2000, help='The number of API pages, at least 5.')
+    parser.add_argument('--latency', type=float, default=0.15, help='Seconds per response.')
+    parser.add_argument('--max-concurrency', type=int, default=8,
+                        help='Requests in flight beyond this get a 503, 0 for no limit.')
+    args = parser.parse_args()
+
+    docs = MockDocs(args.secret_url, args.pages)
+    stats = Stats()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(docs, stats, args.latency,
+                                                                       args.max_concurrency))
+    server.daemon_threads = True
+    print(f'Serving http://{args.host}:{args.port}/{args.secret_url}/api/ with {args.pages} pages')
+    started = time.monotonic()
+    # stopped in the background with kill, the stats are printed all the same
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    refetched = sum(1 for count in stats.fetches.values() if count > 1)
+    print(f'{dict(stats.counts)}, {len(stats.fetches)} pages fetched, {refetched} more than once, '
+          f'peak concurrency {stats.peak}, {time.monotonic() - started:.0f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+import logging
+
+from quant_scraper.frontier import canonical_url
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def state_key(url):
+    # links that only differ in fragment, query or trailing slash are one page
+    return canonical_url(url)
+
+
+class CrawlState:
+    """
+    Remembers what the last crawl saw of every URL: the ETag and Last-Modified validators, a hash of the body, the
+    file the page was written to and the links that were followed from it. The next crawl sends conditional
+    requests with the validators, skips conversion when the body hash did not change, and still follows the links
+    of unchanged pages.
+
+    The pages seen by the current crawl are kept apart from the previous ones, so the URLs that disappeared from
+    the site are known at the end of a complete crawl. They are also appended to a journal as they are seen, so a
+    crawl resumed from its JOBDIR after a crash or a shutdown knows the pages it saw before.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.journal_path = f'{path}.journal'
+        self.pages = {}
+        self.seen = {}
+        self.changed = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.pages = json.load(f).get('pages', {})
+        self.resume = resume
+        if resume:
+            self._replay_journal()
+        self._journal = None
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a crashed crawl can be incomplete
+                    continue
+                if 'changed' in record:
+                    self.changed.append(record['changed'])
+                else:
+                    self.seen[record['url']] = record['entry']
+        logger.info(f'Resuming a crawl that saw {len(self.seen)} pages.')
+
+    def _append(self, record):
+        if self._journal is None:
+            # a new crawl starts a new journal, a resumed one continues it
+            os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+            self._journal = open(self.journal_path, 'a' if self.resume else 'w', encoding='utf-8')
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+
+    def previous(self, url):
+        return self.pages.get(state_key(url))
+
+    def conditional_headers(self, url):
+        entry = self.previous(url)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record(self, url, entry, pending=False):
+        key = state_key(url)
+        self.seen[key] = entry
+        if pending:
+            # until the page is written it is journaled without validators, so a crash makes it fetched again
+            entry = {**entry, 'etag': None, 'last_modified': None, 'hash': None}
+        self._append({'url': key, 'entry': entry})
+
+    def confirm(self, url):
+        # the page of a pending entry was written
+        key = state_key(url)
+        if key in self.seen:
+            self._append({'url': key, 'entry': self.seen[key]})
+
+    def mark_changed(self, url):
+        key = state_key(url)
+        self.changed.append(key)
+        self._append({'changed': key})
+
+    def invalidate(self, url):
+        # keeps the file and links of the page but makes the next crawl download and convert it again
+        key = state_key(url)
+        entry = self.seen.get(key)
+        if entry is not None:
+            entry.update(etag=None, last_modified=None, hash=None)
+            self._append({'url': key, 'entry': entry})
+
+    def removed_urls(self):
+        return sorted(url for url in self.pages if url not in self.seen)
+
+    def orphaned_files(self, urls):
+        """
+        Returns the files of the given URLs that no page of the current crawl was written to.
+        """
+        kept = {entry.get('file') for entry in self.seen.values()}
+        return sorted({self.pages[url].get('file') for url in urls} - kept - {None})
+
+    def save(self, complete):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        if not complete:
+            # the previous crawl stays the reference, the journal holds the progress of this one
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pages': self.seen}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.pages = self.seen
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
@@ -0,0 +1,29 @@
+from urllib.parse import urlsplit, urlunsplit
+
+from scrapy.dupefilters import RFPDupeFilter
+
+
+def canonical_url(url):
+    """
+    Returns the URL of the page a link points to: the fragment and the query string are dropped (the docs and the
+    blog are static pages), the scheme and host are lowercased, `index.html` is dropped and directory paths end
+    with a slash, so `/api/portfolio`, `/api/portfolio/#from-signals` and `/api/portfolio/index.html?v=2` are
+    one page.
+    """
+    scheme, netloc, path, _, _ = urlsplit(url)
+    path = path or '/'
+    if path.endswith('/index.html'):
+        path = path[:-len('index.html')]
+    elif not path.endswith('/') and '.' not in path.rsplit('/', 1)[-1]:
+        path += '/'
+    return urlunsplit((scheme.lower(), netloc.lower(), path, '', ''))
+
+
+class CanonicalDupeFilter(RFPDupeFilter):
+    """
+    Drops requests for a page that was already requested under another spelling of its URL, see `canonical_url`.
+    With JOBDIR set the fingerprints are persisted, so a resumed crawl does not fetch the pages it already has.
+    """
+
+    def request_fingerprint(self, request):
+        return super().request_fingerprint(request.replace(url=canonical_url(request.url)))
@@ -7,6 +7,11 @@ import scrapy
 
 
 class QuantScraperItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+    # A downloaded page, converted to Markdown and written by QuantScraperPipeline
+    url = scrapy.Field()
+    # The part of the site the page belongs to, e.g. "api" or the blog post name
+    section = scrapy.Field()
+    # The raw response body
+    html = scrapy.Field()
+    # The Markdown file the page is written to
+    path = scrapy.Field()
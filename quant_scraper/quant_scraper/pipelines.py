@@ -3,11 +3,170 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
 
+import html2text
+from readability.readability import Document
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy.exceptions import DropItem
+from scrapy.utils.defer import deferred_from_coro
+
+logger = logging.getLogger(__name__)
+
+CORPUS_MANIFEST_FNAME = 'corpus_manifest.json'
+
+
+def html_to_markdown(html):
+    # Runs in a worker process, readability and html2text are pure Python and CPU bound
+    document = Document(html.decode('utf-8', errors='replace'))
+    converter = html2text.HTML2Text()
+    return converter.handle(document.summary())
+
+
+def write_files(pages):
+    # Writes the Markdown files whose content changed and returns their paths
+    written = []
+    for path, markdown_content in pages:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                if f.read() == markdown_content:
+                    continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(markdown_content)
+        written.append(path)
+    return written
+
+
+class CorpusManifest:
+    """
+    The URL, file, Markdown hash and write time of every crawled page, kept next to the files in
+    `corpus_manifest.json`, so the indexer can tell where a file came from and when it last changed without
+    reading it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.pages = json.load(f).get('pages', {})
+
+    def update(self, url, path, content_hash, changed):
+        entry = self.pages.get(url)
+        if entry is None or changed or entry.get('hash') != content_hash or entry.get('path') != path:
+            entry = {'path': path, 'hash': content_hash, 'timestamp': time.time()}
+        self.pages[url] = entry
+
+    def remove(self, urls):
+        for url in urls:
+            self.pages.pop(url, None)
+
+    def save(self, pages=None):
+        # pages is a snapshot of self.pages when the manifest is saved from another thread
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pages': self.pages if pages is None else pages}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
 
 
 class QuantScraperPipeline:
-    def process_item(self, item, spider):
+    """
+    Converts the downloaded pages to Markdown in a pool of worker processes and writes them in batches from a
+    thread, so the reactor keeps downloading while pages are converted. Every batch updates the corpus manifest.
+
+    Settings:
+        CONVERSION_WORKERS: The number of conversion processes, 0 for one per CPU core.
+        CONVERSION_WRITE_BATCH: The number of converted pages written at once.
+    """
+
+    def __init__(self, workers=0, batch_size=50):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.executor = None
+        self.manifest = None
+        self.pending = []
+        self.write_lock = None
+        self.page_hashes = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            workers=crawler.settings.getint('CONVERSION_WORKERS', 0),
+            batch_size=crawler.settings.getint('CONVERSION_WRITE_BATCH', 50),
+        )
+
+    def open_spider(self, spider):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.manifest = CorpusManifest(os.path.join(spider.base_dir, CORPUS_MANIFEST_FNAME))
+        self.pending = []
+        self.write_lock = asyncio.Lock()
+        # body hash -> URL of the pages of this crawl, a page served under two URLs is converted once
+        self.page_hashes = {}
+
+    async def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        first_url = self.page_hashes.setdefault(hashlib.sha256(adapter['html']).hexdigest(), adapter['url'])
+        if first_url != adapter['url']:
+            # nothing is written for this URL, the next crawl must not skip it as unchanged
+            state = getattr(spider, 'crawl_state', None)
+            if state is not None:
+                state.invalidate(adapter['url'])
+            raise DropItem(f"{adapter['url']} is the same page as {first_url}")
+
+        loop = asyncio.get_running_loop()
+        try:
+            markdown_content = await loop.run_in_executor(self.executor, html_to_markdown, adapter['html'])
+        except Exception:
+            # the page must be downloaded and converted again by the next crawl
+            state = getattr(spider, 'crawl_state', None)
+            if state is not None:
+                state.invalidate(adapter['url'])
+            raise
+
+        self.pending.append((adapter['url'], adapter['path'], markdown_content))
+        if len(self.pending) >= self.batch_size:
+            await self.flush(spider)
+
+        # the HTML is not needed anymore, keep it out of feeds and memory
+        adapter['html'] = None
         return item
+
+    async def flush(self, spider):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        # several URLs can be written to one file, the last page wins
+        files = {path: markdown_content for _, path, markdown_content in batch}
+        loop = asyncio.get_running_loop()
+        # one batch at a time, so two batches never write the same file or the manifest concurrently
+        async with self.write_lock:
+            written = set(await loop.run_in_executor(None, write_files, list(files.items())))
+
+            state = getattr(spider, 'crawl_state', None)
+            for url, path, markdown_content in batch:
+                changed = path in written and files[path] is markdown_content
+                content_hash = hashlib.sha256(markdown_content.encode('utf-8')).hexdigest()
+                self.manifest.update(url, path, content_hash, changed)
+                if state is not None:
+                    state.confirm(url)
+                    if changed:
+                        state.mark_changed(url)
+            await loop.run_in_executor(None, self.manifest.save, dict(self.manifest.pages))
+        logger.debug(f'Wrote {len(written)} of {len(files)} converted files.')
+
+    async def _close(self, spider):
+        await self.flush(spider)
+        self.executor.shutdown()
+
+    def close_spider(self, spider):
+        # close_spider may return a Deferred but not a coroutine
+        return deferred_from_coro(self._close(spider))
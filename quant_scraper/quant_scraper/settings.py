@@ -20,14 +20,15 @@ NEWSPIDER_MODULE = "quant_scraper.spiders"
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
+CONCURRENT_REQUESTS = 16
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
 #DOWNLOAD_DELAY = 3
 # The download delay setting will honor only one of:
-#CONCURRENT_REQUESTS_PER_DOMAIN = 16
+# Both sites are a single static host, autothrottle keeps the actual concurrency below this cap
+CONCURRENT_REQUESTS_PER_DOMAIN = 8
 #CONCURRENT_REQUESTS_PER_IP = 16
 
 # Disable cookies (enabled by default)
@@ -62,20 +63,24 @@ ROBOTSTXT_OBEY = False
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    "quant_scraper.pipelines.QuantScraperPipeline": 300,
-#}
+ITEM_PIPELINES = {
+    "quant_scraper.pipelines.QuantScraperPipeline": 300,
+}
+# Processes that convert pages to Markdown (0 for one per CPU core), and the number of pages written at once
+CONVERSION_WORKERS = 0
+CONVERSION_WRITE_BATCH = 50
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-#AUTOTHROTTLE_ENABLED = True
+# Tune these against mock_docs_server.py (latency and overload limit of the real site) before a large crawl
+AUTOTHROTTLE_ENABLED = True
 # The initial download delay
-#AUTOTHROTTLE_START_DELAY = 5
+AUTOTHROTTLE_START_DELAY = 0.5
 # The maximum download delay to be set in case of high latencies
-#AUTOTHROTTLE_MAX_DELAY = 60
+AUTOTHROTTLE_MAX_DELAY = 10
 # The average number of requests Scrapy should be sending in parallel to
 # each remote server
-#AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
+AUTOTHROTTLE_TARGET_CONCURRENCY = 4.0
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG = False
 
@@ -87,6 +92,17 @@ ROBOTSTXT_OBEY = False
 #HTTPCACHE_IGNORE_HTTP_CODES = []
 #HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
 
+# Overloaded servers answer 503 or 429, retry those a few times instead of losing the page
+RETRY_TIMES = 3
+DOWNLOAD_TIMEOUT = 30
+
+# Links that only differ in fragment, query string, trailing slash or index.html are requested once
+DUPEFILTER_CLASS = "quant_scraper.frontier.CanonicalDupeFilter"
+
+# Crawls are resumable with -s JOBDIR=crawls/<name>: the request queue, the seen requests and the
+# incremental crawl state survive a shutdown (Ctrl-C once) or a crash
+#JOBDIR = "crawls/vbt_pro"
+
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
@@ -1,7 +1,8 @@
 import os
 import scrapy
-from readability.readability import Document
-import html2text
+
+from quant_scraper.items import QuantScraperItem
+from quant_scraper.frontier import canonical_url
 
 class VbtProSpider(scrapy.Spider):
     name = "qubit_quants_blog"
@@ -31,30 +32,19 @@ class VbtProSpider(scrapy.Spider):
         os.makedirs(self.base_dir, exist_ok=True)
 
         for url in self.start_urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+            yield scrapy.Request(url=canonical_url(url), callback=self.parse)
 
     def parse(self, response):
-        # Decode the response body explicitly with UTF-8 if necessary
-        response_body = response.body.decode('utf-8', errors='replace')
-
         # Identify the section of the URL to determine the output directory and file naming
         blog_title = response.url.split('/')[-2]
 
-        # Using readability to extract the main content
-        document = Document(response_body)
-        summary = document.summary()
-
-        # Converting HTML summary to Markdown using html2text
-        html_converter = html2text.HTML2Text()
-        markdown_content = html_converter.handle(summary)
-
         # Write content to appropriate files depending on the URL section
         filename = os.path.join(self.base_dir, f'{blog_title}.md')
 
-        # Write main content as Markdown with UTF-8 encoding
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(markdown_content)
+        # Conversion to Markdown and writing happen in QuantScraperPipeline
+        yield QuantScraperItem(url=response.url, section=blog_title, html=response.body, path=filename)
 
         # Follow links according to the logic of both spiders
         for href in response.css('a::attr(href)').getall():
-            yield response.follow(href, self.parse)
+            # The same post is linked with anchors and as .../index.html, request it once
+            yield scrapy.Request(canonical_url(response.urljoin(href)), callback=self.parse)
@@ -1,22 +1,35 @@
 import os
+import json
 import scrapy
-from readability.readability import Document
-import html2text
+from urllib.parse import urlsplit
+
+from quant_scraper.crawl_state import CrawlState, content_hash, state_key
+from quant_scraper.frontier import canonical_url
+from quant_scraper.items import QuantScraperItem
+from quant_scraper.pipelines import CORPUS_MANIFEST_FNAME, CorpusManifest
 
 class VbtProSpider(scrapy.Spider):
     name = "vbt_pro"
     allowed_domains = ['vectorbt.pro']
 
+    # 304 Not Modified answers the conditional requests of an incremental crawl
+    handle_httpstatus_list = [304]
+
     # Initialize the spider with the secret_url parameter
-    def __init__(self, secret_url=None, *args, **kwargs):
+    def __init__(self, secret_url=None, incremental='true', base_url='https://vectorbt.pro', *args, **kwargs):
         super(VbtProSpider, self).__init__(*args, **kwargs)
         self.secret_url = secret_url
+        # -a base_url=http://127.0.0.1:8765 crawls mock_docs_server.py instead of the real site
+        self.base_url = base_url.rstrip('/')
+        self.allowed_domains = [urlsplit(self.base_url).hostname]
+        # -a incremental=false downloads and converts every page, e.g. after a change of the conversion
+        self.incremental = str(incremental).lower() not in ('0', 'false', 'no')
         self.start_urls = [
-            f'https://vectorbt.pro/{self.secret_url}/features/',
-            f'https://vectorbt.pro/{self.secret_url}/tutorials/',
-            f'https://vectorbt.pro/{self.secret_url}/documentation/',
-            f'https://vectorbt.pro/{self.secret_url}/api/',
-            f'https://vectorbt.pro/{self.secret_url}/cookbook/'
+            f'{self.base_url}/{self.secret_url}/features/',
+            f'{self.base_url}/{self.secret_url}/tutorials/',
+            f'{self.base_url}/{self.secret_url}/documentation/',
+            f'{self.base_url}/{self.secret_url}/api/',
+            f'{self.base_url}/{self.secret_url}/cookbook/'
         ]
 
         # Combine and centralize data directories from both spiders
@@ -30,43 +43,118 @@ class VbtProSpider(scrapy.Spider):
             'cookbook': 'cookbook.md'
         }
 
+        # Validators, hashes and links of the last crawl, and the changes found by this one, see from_crawler
+        self.crawl_state = None
+        self.changes_path = os.path.join(self.base_dir, 'crawl_changes.json')
+        self.counts = {'downloaded': 0, 'not_modified': 0, 'unchanged': 0, 'converted': 0}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(VbtProSpider, cls).from_crawler(crawler, *args, **kwargs)
+        # A crawl with a JOBDIR may be the continuation of an interrupted one, see CrawlState
+        # (spider.state is taken by Scrapy's own JOBDIR state)
+        spider.crawl_state = CrawlState(os.path.join(spider.base_dir, '.crawl_state.json'),
+                                        resume=bool(crawler.settings.get('JOBDIR')))
+        return spider
+
     def start_requests(self):
         # Ensure base directories exist
         os.makedirs(self.base_dir, exist_ok=True)
         os.makedirs(self.api_dir, exist_ok=True)
 
         for url in self.start_urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+            yield self.request(url)
 
-    def parse(self, response):
-        # Decode the response body explicitly with UTF-8 if necessary
-        response_body = response.body.decode('utf-8', errors='replace')
+    def request(self, url):
+        # Ask only for pages that changed since the last crawl
+        url = canonical_url(url)
+        headers = self.crawl_state.conditional_headers(url) if self.incremental else {}
+        return scrapy.Request(url=url, callback=self.parse, headers=headers)
 
+    def output_filename(self, url):
         # Identify the section of the URL to determine the output directory and file naming
-        section = response.url.split('/')[4]
-
-        # Using readability to extract the main content
-        document = Document(response_body)
-        summary = document.summary()
-
-        # Converting HTML summary to Markdown using html2text
-        converter = html2text.HTML2Text()
-        markdown_content = converter.handle(summary)
-
-        # Write content to appropriate files depending on the URL section
+        section = url.split('/')[4]
         if section == 'api':
             # The filename is set using the last part of the URL path for the API section
-            filename = os.path.join(self.api_dir, f'{response.url.split("/")[-2]}.md')
-        else:
-            # Use predefined filenames for other sections
-            filename = os.path.join(self.base_dir, self.file_map.get(section, 'unknown.md'))
-
-        # Write main content as Markdown with UTF-8 encoding
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(markdown_content)
+            return os.path.join(self.api_dir, f'{url.split("/")[-2]}.md')
+        # Use predefined filenames for other sections
+        return os.path.join(self.base_dir, self.file_map.get(section, 'unknown.md'))
 
+    def extract_links(self, response):
         # Follow links according to the logic of both spiders
+        links = []
         for href in response.css('a::attr(href)').getall():
             # The spider should follow links found in the API pages, as well as those containing the secret URL
             if href.startswith(f'/{self.secret_url}/api/') or self.secret_url in href:
-                yield response.follow(href, self.parse)
+                links.append(response.urljoin(href))
+        return links
+
+    def parse(self, response):
+        # The state is keyed by the requested URL, the one the conditional headers were looked up for
+        url = response.request.url
+        previous = self.crawl_state.previous(url)
+
+        if response.status == 304:
+            # Nothing changed, follow the links the page had last time
+            self.counts['not_modified'] += 1
+            entry = previous or {}
+            self.crawl_state.record(url, entry)
+            for link in entry.get('links', []):
+                yield self.request(link)
+            return
+
+        self.counts['downloaded'] += 1
+        body_hash = content_hash(response.body)
+        filename = self.output_filename(response.url)
+        links = self.extract_links(response)
+
+        entry = {
+            'etag': response.headers.get('ETag', b'').decode('latin-1') or None,
+            'last_modified': response.headers.get('Last-Modified', b'').decode('latin-1') or None,
+            'hash': body_hash,
+            'file': filename,
+            'links': links,
+        }
+
+        if (self.incremental and previous and previous.get('hash') == body_hash
+                and previous.get('file') == filename and os.path.exists(filename)):
+            # The server does not support validators for this page but the content is the same
+            self.counts['unchanged'] += 1
+            self.crawl_state.record(url, entry)
+        else:
+            # The pipeline confirms the entry once the file is written
+            self.crawl_state.record(url, entry, pending=True)
+            # Conversion and writing happen in QuantScraperPipeline, off the reactor
+            self.counts['converted'] += 1
+            yield QuantScraperItem(url=state_key(url), section=response.url.split('/')[4], html=response.body,
+                                   path=filename)
+
+        for link in links:
+            yield self.request(link)
+
+    def closed(self, reason):
+        # Only a complete crawl can tell which pages disappeared from the site
+        complete = reason == 'finished'
+        removed = self.crawl_state.removed_urls() if complete else []
+        removed_files = self.crawl_state.orphaned_files(removed)
+        for filename in removed_files:
+            if os.path.exists(filename):
+                os.remove(filename)
+        if removed:
+            # The pipeline has written its last batch when the spider is closed
+            manifest = CorpusManifest(os.path.join(self.base_dir, CORPUS_MANIFEST_FNAME))
+            manifest.remove(removed)
+            manifest.save()
+
+        self.crawl_state.save(complete)
+        with open(self.changes_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'changed': sorted(self.crawl_state.changed),
+                'removed': removed,
+                'removed_files': removed_files,
+                'counts': self.counts,
+                'complete': complete,
+            }, f, indent=1)
+
+        self.logger.info(f'Crawl {reason}: {len(self.crawl_state.changed)} changed and {len(removed)} removed pages, '
+                         f'{self.counts}. Changes written to {self.changes_path}.')
@@ -1,24 +1,51 @@
+import asyncio
 import logging
 import os
-from typing import Optional
+import time
+from typing import Awaitable, Callable, List, Optional
 import openai
 import chainlit as cl
 from dotenv import load_dotenv
 
-from llama_index.query_engine import RetrieverQueryEngine
-from quantgptlib.simple_vector_storage import QuantSimpleVectorStorage
+from llama_index.schema import NodeWithScore
+from llama_index.indices.query.schema import QueryBundle
+from quantgptlib.build_index import PERSIST_DIR, create_storage
+from quantgptlib.index_generations import current_generation
+from quantgptlib.index_warmup import IndexWarmup
+from quantgptlib.answer_cache import SemanticAnswerCache
+from quantgptlib.query_embedding import CachedQueryEmbedding
+from quantgptlib.llm_scheduler import FairLLMScheduler
+from quantgptlib.shared_query_engine import SessionQueryEngine, SharedQueryEngine
+from quantgptlib.metrics import (CACHE_REQUESTS, ERRORS, LLM_QUEUE_SECONDS, REQUEST_SECONDS, MetricsCallbackHandler,
+                                 MetricsServer, create_registry)
 
 # Load environment variables
 load_dotenv(".env", override=True)
 
-# obtain gpt model name from environment variables
-gpt_model = os.getenv('GPT_MODEL')
-gpt_temperature = float(os.getenv('GPT_TEMPERATURE'))
+# how long a message waits for the index warm-up before the user is told to come back later
+warmup_wait_timeout = float(os.getenv('WARMUP_WAIT_TIMEOUT', 30))
 
-print(f"Using GPT model: {gpt_model} with temperature: {gpt_temperature}")
+# questions this similar to an answered one get the cached answer without retrieval or an LLM call
+answer_cache_threshold = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.95))
+answer_cache_ttl = float(os.getenv('ANSWER_CACHE_TTL', 7 * 24 * 3600))
 
-persist_dir = "./index"
-source_folder = "./quant_scraper/docs"
+# at most this many LLM calls run at once, the others queue up with a fair share per user
+llm_max_concurrency = int(os.getenv('LLM_MAX_CONCURRENCY', 4))
+# the tokens-per-minute quota of GPT_MODEL, LLM calls wait instead of being rate limited; 0 disables the limit
+llm_tokens_per_minute = float(os.getenv('LLM_TOKENS_PER_MINUTE', 0))
+
+# stage latencies and token counts are served in Prometheus format on this local port, 0 disables the endpoint
+metrics_port = int(os.getenv('METRICS_PORT', 9464))
+# every observation is also appended to this JSONL file if it is set
+metrics_jsonl_path = os.getenv('METRICS_JSONL_PATH') or None
+
+# set by serve.py in each of its workers, which attach to the index it maintains read-only (not read from .env)
+worker_id = os.getenv('QUANTGPT_WORKER_ID')
+answer_cache_path = "./data/answer_cache"
+if worker_id is not None:
+    # the workers run side by side, each one needs its own port and cache files
+    metrics_port = metrics_port + int(worker_id) if metrics_port else 0
+    answer_cache_path = f"./data/answer_cache_{worker_id}"
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -27,28 +54,127 @@ logger = logging.getLogger(__name__)
 # Fetch API key from environment variables
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+### Setup Metrics
+metrics = create_registry(jsonl_path=metrics_jsonl_path)
+if metrics_port:
+    MetricsServer(metrics, port=metrics_port).start()
+
 ### Setup Storage
-quant_storage = QuantSimpleVectorStorage(
-    persist_dir="./index",
-    gpt_model=gpt_model,
-    gpt_temperature=gpt_temperature,
-    source_folder=source_folder,
+# the index is loaded (or built) in the background so the app starts serving right away
+# the index settings (GPT_MODEL, VECTOR_STORE_TYPE, ...) are read by create_storage, shared with the index build
+# a published generation may be served by serve.py workers as well, it is never updated in place; the app only
+# builds or updates an index of its own, and `python -m quantgptlib.build_index` publishes the next generation
+read_only_index = worker_id is not None or current_generation(PERSIST_DIR) is not None
+if read_only_index and worker_id is None:
+    logger.info(f"Serving the index generation {current_generation(PERSIST_DIR)} read-only, "
+                f"run `python -m quantgptlib.build_index` to update it.")
+quant_storage = create_storage(
+    callback_handlers=[MetricsCallbackHandler(metrics)],
+    read_only=read_only_index,
+    lazy=True,
+)
+print(f"Using GPT model: {quant_storage.gpt_model} with temperature: {quant_storage.gpt_temperature}")
+if isinstance(quant_storage.embed_model, CachedQueryEmbedding):
+    quant_storage.embed_model.lookup_callback = \
+        lambda result: metrics.inc(CACHE_REQUESTS, cache="query_embedding", result=result)
+index_warmup = IndexWarmup(quant_storage).start()
+
+answer_cache = SemanticAnswerCache(
+    path=answer_cache_path,
+    threshold=answer_cache_threshold,
+    ttl=answer_cache_ttl,
 )
 
+def current_index_version() -> str:
+    """
+    Identifies what the answers depend on: the indexed documentation and the model that writes the answers.
+    """
+    return f"{quant_storage.manifest.version}:{quant_storage.gpt_model}:{quant_storage.gpt_temperature}"
+
+def source_elements(source_nodes: List[NodeWithScore]) -> List[cl.Text]:
+    """
+    Turns the retrieved nodes into side panel elements, one per source, named after the documentation file.
+    """
+    # hybrid retrieval ranks the sources by reciprocal rank fusion, its scores are not similarities
+    score_label = "Rank fusion score" if quant_storage.retriever_mode == "hybrid" else "Similarity"
+    elements = []
+    for i, source in enumerate(source_nodes, start=1):
+        file_name = os.path.basename(source.node.metadata.get("file_path", "")) or source.node.node_id
+        elements.append(cl.Text(
+            name=f"[{i}] {file_name}",
+            content=f"{source.node.get_content()}\n\n{score_label}: {source.score or 0.0:.3f}",
+            display="side",
+        ))
+    return elements
+
+async def send_sources(source_nodes: List[NodeWithScore]):
+    elements = source_elements(source_nodes)
+    if elements:
+        names = ", ".join(element.name for element in elements)
+        await cl.Message(content=f"Sources: {names}", elements=elements).send()
+
+# the LLM calls of all the sessions go through one scheduler, which enforces the concurrency and token limits
+llm_scheduler = FairLLMScheduler(max_concurrent=llm_max_concurrency, tokens_per_minute=llm_tokens_per_minute or None)
+llm_scheduler.wait_callback = lambda seconds: metrics.observe(LLM_QUEUE_SECONDS, seconds)
+
+# the LLM client, retriever and response synthesizer are built once and shared by all chat sessions
+shared_query_engine = SharedQueryEngine(
+    lambda callback_handler: quant_storage.create_query_engine(callback_handler=callback_handler),
+    scheduler=llm_scheduler,
+)
+
+def create_session_query_engine() -> SessionQueryEngine:
+    """
+    Creates the query engine of a chat session. The index must be ready.
+    """
+    session_engine = shared_query_engine.session(callback_handler=cl.LlamaIndexCallbackHandler())
+    logger.info(f"Query engine metrics: {shared_query_engine.metrics()}")
+    return session_engine
+
+def session_user() -> str:
+    """
+    The user the LLM calls of the current session are scheduled for, the session itself without a login.
+    """
+    app_user = cl.user_session.get("user")
+    return app_user.identifier if app_user is not None else cl.user_session.get("id")
+
+def queue_notice() -> Callable[[int], Awaitable[None]]:
+    """
+    Returns the queue position callback of a question: it tells the user their place in the queue while all the
+    LLM slots are busy, and takes the notice down once their answer is being written.
+    """
+    notice = cl.Message(content="")
+    sent = False
+
+    async def report(position: int):
+        nonlocal sent
+        if position:
+            notice.content = f"All answer slots are busy, your question is number {position} in the queue."
+            await (notice.update() if sent else notice.send())
+            sent = True
+        elif sent:
+            await notice.remove()
+            sent = False
+
+    return report
+
 ### Chat Callbacks
 @cl.on_chat_start
 async def on_chat_start():
     """
     This function is called when a chat session starts. It creates a query engine and sets it in the user session.
-    It also greets the user with a message.
+    It also greets the user with a message. While the index is still warming up, the query engine is created later
+    by the first message of the session.
     """
-    query_engine = quant_storage.create_query_engine(callback_handler=cl.LlamaIndexCallbackHandler())
-
-    cl.user_session.set("query_engine", query_engine)
+    if index_warmup.is_ready:
+        cl.user_session.set("query_engine", create_session_query_engine())
 
     app_user = cl.user_session.get("user")
     await cl.Message(f"Hello {app_user.identifier}. How are you doing?").send()
 
+    if not index_warmup.is_ready:
+        await cl.Message(index_warmup.status_message()).send()
+
 @cl.password_auth_callback
 def auth_callback(username: str, password: str) -> Optional[cl.User]:
     """
@@ -68,18 +194,76 @@ def auth_callback(username: str, password: str) -> Optional[cl.User]:
     else:
         return None
 
+@cl.on_chat_end
+async def on_chat_end():
+    """
+    This function is called when a chat session ends, e.g. when the user closes the page. An answer still in
+    progress is cancelled, which gives its place in the LLM queue, or its slot, to the other users.
+    """
+    answer_task = cl.user_session.get("answer_task")
+    if answer_task is not None and not answer_task.done():
+        logger.info(f"Session of {session_user()} ended, cancelling its answer.")
+        answer_task.cancel()
+
 @cl.on_message
 async def main(message: cl.Message):
     """
-    This function takes a message object as input, queries a RetrieverQueryEngine object with the message content,
-    and sends the response back to the user in a message object.
+    This function takes a message object as input, retrieves the relevant documentation for the message content,
+    shows the sources and streams the answer back to the user token by token.
     """
+    cl.user_session.set("answer_task", asyncio.current_task())
+    with metrics.time(REQUEST_SECONDS):
+        try:
+            await answer_message(message)
+        except Exception:
+            metrics.inc(ERRORS, stage="main")
+            raise
+
+async def answer_message(message: cl.Message):
     query_engine = cl.user_session.get("query_engine")
-    response = await cl.make_async(query_engine.query)(message.content)
+    if query_engine is None:
+        # the session started during the index warm-up, wait for it a bit before giving up
+        if not await index_warmup.wait_ready(timeout=warmup_wait_timeout):
+            await cl.Message(index_warmup.status_message()).send()
+            return
+
+        query_engine = create_session_query_engine()
+        cl.user_session.set("query_engine", query_engine)
+
+    # the question is embedded once, for the cache lookup and for the retriever
+    answer_cache.set_index_version(current_index_version())
+    question_embedding = await quant_storage.embed_model.aget_query_embedding(message.content)
+    cached = answer_cache.lookup(question_embedding)
+
+    metrics.inc(CACHE_REQUESTS, cache="answer", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        logger.info(f"Answer cache hit ({cached.similarity:.3f}) for: {message.content}")
+        # the sources are kept as node ids, their chunks are read from the docstore off the event loop
+        await send_sources(await asyncio.to_thread(cached.source_nodes, quant_storage.index.docstore))
+        await cl.Message(content=cached.answer).send()
+        return
+
+    # sources are shown as soon as retrieval is done, the answer is streamed token by token
+    query_bundle = QueryBundle(message.content, embedding=question_embedding)
+    source_nodes = await query_engine.aretrieve(query_bundle)
+    await send_sources(source_nodes)
 
-    step = cl.Step()
+    answer = cl.Message(content="")
+    started = time.perf_counter()
+    first_token_seconds = None
+    # the LLM calls wait for their turn in the scheduler, the user is told their place in the queue meanwhile
+    with llm_scheduler.requester(session_user(), on_position=queue_notice()):
+        async for token in query_engine.astream_answer(message.content, source_nodes):
+            if first_token_seconds is None:
+                first_token_seconds = time.perf_counter() - started
+            await answer.stream_token(token)
+    await answer.send()
 
-    if hasattr(response, "response"):
-        step.output = response.response
+    if first_token_seconds is not None:
+        logger.info(f"Answer streamed, first token after {first_token_seconds:.1f}s, "
+                    f"complete after {time.perf_counter() - started:.1f}s.")
+    # an answer without sources was written from an empty context, it must not be served to similar questions
+    if answer.content and source_nodes:
+        # the cache file is written in a worker thread, the other sessions keep being served meanwhile
+        await asyncio.to_thread(answer_cache.store, message.content, question_embedding, answer.content, source_nodes)
 
-    await step.send()
\ No newline at end of file
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from llama_index.schema import NodeWithScore
+from llama_index.storage.docstore.types import BaseDocumentStore
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedAnswer:
+    """
+    An answer stored in the `SemanticAnswerCache`. Source nodes are kept as their id and score only, the chunks
+    themselves are read back from the docstore of the index the answer was generated from.
+    """
+    question: str
+    answer: str
+    sources: List[Dict[str, Any]] = field(default_factory=list)
+    created_at: float = 0.0
+    last_used_at: float = 0.0
+    hits: int = 0
+    similarity: float = 1.0
+
+    def source_nodes(self, docstore: BaseDocumentStore) -> List[NodeWithScore]:
+        """
+        Rebuilds the source nodes of the answer from the docstore. Nodes that are no longer in it are left out.
+        """
+        node_ids = [source["id"] for source in self.sources if docstore.document_exists(source["id"])]
+        nodes = docstore.get_nodes(node_ids)
+        scores = {source["id"]: source["score"] for source in self.sources}
+        return [NodeWithScore(node=node, score=scores[node.node_id]) for node in nodes]
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers by the embedding of the question. A question whose embedding has a cosine similarity of at least
+    `threshold` with a cached question gets the cached answer and source nodes, without retrieval or an LLM call.
+
+    Entries expire `ttl` seconds after they were created, the least recently used entries are evicted beyond
+    `max_entries`, and the whole cache is dropped when the index version changes, so answers never outlive the
+    documentation they were generated from.
+
+    The cache is persisted to the SQLite file `<path>.sqlite`, one row per answer with its question embedding, so a
+    restarted app starts with the answers of the previous run. `store` only writes the rows that changed since the
+    previous call; lookups never touch the file, their recency and the expired answers they drop are written with
+    the next stored answer. The file is written outside the lock that lookups take, call `store` from a worker
+    thread (e.g. with `asyncio.to_thread`) to keep the write off the event loop.
+
+    Attributes:
+            path (Optional[str]): The cache file without extension, or None to keep the cache in memory only.
+            threshold (float): The minimum cosine similarity of a hit.
+            max_entries (int): The maximum number of cached answers.
+            ttl (float): The lifetime of an answer in seconds.
+            index_version (Optional[str]): The version of the index the cached answers were generated from.
+    """
+
+    def __init__(self, path: Optional[str] = None, threshold: float = 0.95, max_entries: int = 1000,
+                 ttl: float = 7 * 24 * 3600, index_version: Optional[str] = None):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_version = index_version
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self._embeddings: Dict[str, np.ndarray] = {}
+        # unit-length question embeddings stacked in the order of `_keys`, rebuilt lazily after changes
+        self._keys: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        # changes of lookups that are written with the next stored answer
+        self._used: Set[str] = set()
+        self._deleted: Set[str] = set()
+
+        # the writes are serialized by their own lock, lookups only wait for the in-memory update
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._open()
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def set_index_version(self, index_version: Optional[str]):
+        """
+        Drops every cached answer if the index version changed.
+        """
+        with self._lock:
+            if index_version == self.index_version:
+                return
+            if self._entries:
+                logger.info(f"Index version changed to {index_version}, dropping {len(self._entries)} cached answers.")
+            self.index_version = index_version
+            self._clear()
+        self._write([
+            ("DELETE FROM answers", [()]),
+            ("INSERT OR REPLACE INTO meta VALUES ('index_version', ?)", [(index_version,)]),
+        ])
+
+    def lookup(self, embedding: Sequence[float]) -> Optional[CachedAnswer]:
+        """
+        Returns the cached answer of the most similar question, if it is similar enough.
+        """
+        with self._lock:
+            self._evict_expired()
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.vstack([self._embeddings[key] for key in self._keys])
+
+            scores = self._matrix @ self._normalize(embedding)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            key = self._keys[best]
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            entry.last_used_at = time.time()
+            entry.hits += 1
+            entry.similarity = float(scores[best])
+            self.hits += 1
+            # recency only matters for eviction, it is saved with the next stored answer
+            self._used.add(key)
+            return entry
+
+    def store(self, question: str, embedding: Sequence[float], answer: str,
+              source_nodes: Sequence[NodeWithScore] = ()) -> CachedAnswer:
+        """
+        Caches an answer and evicts the least recently used answers beyond `max_entries`.
+        """
+        now = time.time()
+        entry = CachedAnswer(
+            question=question,
+            answer=answer,
+            sources=[{"id": source.node.node_id, "score": source.score} for source in source_nodes],
+            created_at=now,
+            last_used_at=now,
+        )
+
+        with self._lock:
+            key = uuid.uuid4().hex
+            self._entries[key] = entry
+            self._embeddings[key] = self._normalize(embedding)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                del self._embeddings[old_key]
+                self._deleted.add(old_key)
+            self._matrix = None
+
+            inserted = (key, entry.question, entry.answer, json.dumps(entry.sources), entry.created_at,
+                        entry.last_used_at, entry.hits, self._embeddings[key].tobytes())
+            used = [(self._entries[k].last_used_at, self._entries[k].hits, k) for k in self._used if k in self._entries]
+            deleted = [(k,) for k in self._deleted]
+            self._used.clear()
+            self._deleted.clear()
+            index_version = self.index_version
+
+        self._write([
+            ("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [inserted]),
+            ("UPDATE answers SET last_used_at = ?, hits = ? WHERE key = ?", used),
+            ("DELETE FROM answers WHERE key = ?", deleted),
+        ], index_version=index_version)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+        self._write([("DELETE FROM answers", [()])])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _clear(self):
+        self._entries.clear()
+        self._embeddings.clear()
+        self._matrix = None
+        self._used.clear()
+        self._deleted.clear()
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry.created_at < cutoff]
+        for key in expired:
+            del self._entries[key]
+            del self._embeddings[key]
+        if expired:
+            self._matrix = None
+            self._deleted.update(expired)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(f"{self.path}.sqlite", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " key TEXT PRIMARY KEY,"
+            " question TEXT NOT NULL,"
+            " answer TEXT NOT NULL,"
+            " sources TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL,"
+            " embedding BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _write(self, statements: List[Tuple[str, Sequence[tuple]]], index_version: Optional[str] = None):
+        """
+        Runs the statements with their rows in one transaction. With `index_version`, they are skipped if the cache
+        was dropped for another version in the meantime.
+        """
+        with self._db_lock:
+            if self._conn is None or (index_version is not None and index_version != self.index_version):
+                return
+            with self._conn:
+                for sql, rows in statements:
+                    if rows:
+                        self._conn.executemany(sql, rows)
+
+    def _load(self):
+        try:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'index_version'").fetchone()
+            rows = self._conn.execute(
+                "SELECT key, question, answer, sources, created_at, last_used_at, hits, embedding FROM answers"
+                " ORDER BY last_used_at").fetchall()
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Could not load the answer cache from {self.path}: {e}")
+            return
+
+        stored_version = row[0] if row is not None else None
+        if self.index_version is not None and stored_version != self.index_version:
+            if rows:
+                logger.info("Answer cache was built for another index version, starting with an empty cache.")
+            self._write([
+                ("DELETE FROM answers", [()]),
+                ("INSERT OR REPLACE INTO meta VALUES ('index_version', ?)", [(self.index_version,)]),
+            ])
+            return
+
+        self.index_version = stored_version
+        for key, question, answer, sources, created_at, last_used_at, hits, embedding in rows:
+            self._entries[key] = CachedAnswer(question=question, answer=answer, sources=json.loads(sources),
+                                              created_at=created_at, last_used_at=last_used_at, hits=hits)
+            self._embeddings[key] = np.frombuffer(embedding, dtype=np.float32)
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            del self._embeddings[old_key]
+            self._deleted.add(old_key)
+        self._evict_expired()
+        logger.info(f"Loaded {len(self._entries)} cached answers from {self.path}.")
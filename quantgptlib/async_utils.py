@@ -0,0 +1,117 @@
+import time
+import random
+import asyncio
+import logging
+import concurrent.futures
+from typing import Any, Awaitable, Callable, Coroutine, Optional, Tuple, Type, TypeVar
+
+import openai
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# errors of the OpenAI API that go away when the request is repeated a bit later
+RETRYABLE_ERRORS: Tuple[Type[BaseException], ...] = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+async def retry_async(
+    fn: Callable[[], Awaitable[T]],
+    retry_on: Tuple[Type[BaseException], ...] = RETRYABLE_ERRORS,
+    max_retries: int = 6,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    on_retry: Optional[Callable[[int, BaseException], None]] = None,
+) -> T:
+    """
+    Awaits `fn()` and repeats it with exponential backoff and full jitter when it raises one of `retry_on`.
+
+    Args:
+        fn (Callable[[], Awaitable[T]]): A factory for the awaitable, called once per attempt.
+        retry_on (Tuple[Type[BaseException], ...]): The exception types that trigger a retry.
+        max_retries (int): How many times the call is repeated before the last error is raised.
+        base_delay (float): The upper bound of the first backoff delay, in seconds. It doubles on every retry.
+        max_delay (float): The cap of the backoff delay, in seconds.
+        on_retry (Optional[Callable[[int, BaseException], None]]): Called with the attempt number and the error
+            before every retry.
+
+    Returns:
+        The result of the first successful attempt.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except retry_on as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            if on_retry is not None:
+                on_retry(attempt, e)
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            logger.warning(f"{type(e).__name__}: {e}. Retrying in {delay:.1f}s (attempt {attempt}/{max_retries}).")
+            await asyncio.sleep(delay)
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """
+    Runs a coroutine to completion from synchronous code. When the calling thread already runs an event loop
+    (e.g. inside a notebook), the coroutine is run on a fresh loop in a helper thread instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+class TokenRateLimiter:
+    """
+    An async token bucket that keeps the number of tokens sent to an API below a per-minute limit, such as the
+    tokens-per-minute quota of an OpenAI model. The bucket starts full and refills continuously; a request waits
+    until the bucket holds its estimated tokens. Waiting requests are served in arrival order.
+
+    The limiter uses an asyncio lock, create it inside the event loop that uses it.
+
+    Attributes:
+            tokens_per_minute (float): The refill rate of the bucket.
+            capacity (float): The size of the bucket, i.e. the largest burst. Defaults to `tokens_per_minute`.
+    """
+
+    def __init__(self, tokens_per_minute: float, capacity: Optional[float] = None):
+        self.tokens_per_minute = tokens_per_minute
+        self.capacity = capacity or tokens_per_minute
+        self.waited = 0.0
+
+        self._available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.tokens_per_minute / 60)
+        self._updated = now
+
+    async def acquire(self, tokens: float):
+        """
+        Waits until `tokens` can be spent and takes them from the bucket. A request larger than the bucket waits
+        for a full bucket.
+        """
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self._available < tokens:
+                delay = (tokens - self._available) * 60 / self.tokens_per_minute
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self._refill()
+            self._available -= tokens
@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import logging
+from functools import lru_cache
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import BaseNode, MetadataMode, NodeWithScore
+from llama_index.storage.docstore.types import BaseDocumentStore
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+BM25_FNAME = "bm25_index.json"
+BM25_ARRAYS = ("node_ids", "terms", "offsets", "rows", "term_frequencies", "doc_lengths", "weights")
+
+# identifiers with optional dotted access, e.g. `vbt.Portfolio.from_signals`
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*")
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+@lru_cache(maxsize=65536)
+def _expand_identifier(identifier: str) -> Tuple[str, ...]:
+    terms = []
+    parts = identifier.split(".")
+    if len(parts) > 1:
+        terms.append(identifier.lower())
+    for part in parts:
+        terms.append(part.lower())
+        words = [word for piece in part.split("_") for word in _CAMEL_RE.findall(piece)]
+        if len(words) > 1:
+            terms.extend(word.lower() for word in words)
+    return tuple(terms)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lowercase terms in a way that suits Python API documentation. A dotted name is kept whole
+    and also split into its parts, and every part is further split at underscores and camel case humps:
+
+        `vbt.Portfolio.from_signals` -> vbt.portfolio.from_signals, vbt, portfolio, from_signals, from, signals
+
+    so a query for the full name, the method name or a single word all find the chunk.
+    """
+    terms = []
+    # documentation reuses a small vocabulary, every distinct identifier is expanded once
+    for identifier in _IDENTIFIER_RE.findall(text):
+        terms.extend(_expand_identifier(identifier))
+    return terms
+
+
+class BM25Index:
+    """
+    An inverted index that ranks nodes with Okapi BM25.
+
+    The posting lists are stored in CSR layout: the postings of term `t` are `rows[offsets[t]:offsets[t + 1]]`,
+    the rows of the nodes that contain the term, with the precomputed BM25 weight of the term in each of them.
+    A query only adds a few short array slices into a score vector. The vocabulary is sorted and looked up by
+    binary search, so a persisted index is used straight from its memory-mapped arrays, and processes that load
+    the same index share its pages instead of holding a copy each.
+
+    Attributes:
+            node_ids (np.ndarray): The indexed node ids, a node's row is its position in this array.
+            terms (np.ndarray): The sorted vocabulary, a term's id is its position in this array.
+            offsets (np.ndarray): The start of every term's postings, followed by the total number of postings.
+            rows (np.ndarray): The node rows of all postings.
+            term_frequencies (np.ndarray): How often the term occurs in the node, for every posting.
+            doc_lengths (np.ndarray): The number of terms of every node.
+            k1 (float): The BM25 term frequency saturation.
+            b (float): The BM25 length normalization.
+            version (Optional[str]): The version of the corpus the index was built from.
+    """
+
+    def __init__(self, node_ids: np.ndarray, terms: np.ndarray, offsets: np.ndarray, rows: np.ndarray,
+                 term_frequencies: np.ndarray, doc_lengths: np.ndarray, k1: float = 1.2, b: float = 0.75,
+                 version: Optional[str] = None, weights: Optional[np.ndarray] = None):
+        self.node_ids = node_ids
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.term_frequencies = term_frequencies
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.version = version
+
+        # the persisted weights are only recomputed when the index is built
+        self._weights = weights if weights is not None else self._weigh()
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    @classmethod
+    def from_nodes(cls, nodes: Iterable[BaseNode], version: Optional[str] = None, **kwargs) -> "BM25Index":
+        """
+        Indexes the nodes by the same content the embedding model sees, i.e. the text and the embedded metadata.
+        """
+        node_ids = []
+        doc_lengths = []
+        vocabulary: Dict[str, int] = {}
+        occurrence_terms: List[int] = []
+        occurrence_rows: List[int] = []
+        for row, node in enumerate(nodes):
+            terms = tokenize(node.get_content(metadata_mode=MetadataMode.EMBED))
+            node_ids.append(node.node_id)
+            doc_lengths.append(len(terms))
+            occurrence_terms.extend(vocabulary.setdefault(term, len(vocabulary)) for term in terms)
+            occurrence_rows.extend([row] * len(terms))
+
+        terms = np.empty(len(vocabulary), dtype=object)
+        for term, term_id in vocabulary.items():
+            terms[term_id] = term
+        terms = terms.astype(np.str_)
+
+        # term ids follow the sorted vocabulary, see `term_id`
+        order = np.argsort(terms, kind="stable")
+        sorted_ids = np.empty(len(order), dtype=np.int64)
+        sorted_ids[order] = np.arange(len(order))
+
+        # every distinct (term, row) pair is a posting, its count is the term frequency
+        num_docs = max(len(node_ids), 1)
+        occurrence_terms = sorted_ids[np.asarray(occurrence_terms, dtype=np.int64)]
+        keys = occurrence_terms * num_docs + np.asarray(occurrence_rows, dtype=np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        posting_terms = keys // num_docs
+
+        return cls(
+            node_ids=np.array(node_ids, dtype=np.str_),
+            terms=terms[order],
+            offsets=np.searchsorted(posting_terms, np.arange(len(vocabulary) + 1)),
+            rows=(keys % num_docs).astype(np.int32),
+            term_frequencies=counts.astype(np.float32),
+            doc_lengths=np.array(doc_lengths, dtype=np.float32),
+            version=version,
+            **kwargs,
+        )
+
+    @classmethod
+    def from_docstore(cls, docstore: BaseDocumentStore, version: Optional[str] = None, **kwargs) -> "BM25Index":
+        nodes = sorted(docstore.docs.values(), key=lambda node: node.node_id)
+        return cls.from_nodes(nodes, version=version, **kwargs)
+
+    def _weigh(self) -> np.ndarray:
+        if len(self.node_ids) == 0:
+            return np.empty(0, dtype=np.float32)
+
+        num_docs = len(self.node_ids)
+        document_frequencies = np.diff(self.offsets)
+        idf = np.log(1 + (num_docs - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+        avg_length = max(float(self.doc_lengths.mean()), 1.0)
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / avg_length)
+        tf = self.term_frequencies
+        weights = np.repeat(idf, document_frequencies) * tf * (self.k1 + 1) / (tf + length_norm[self.rows])
+        return weights.astype(np.float32)
+
+    def term_id(self, term: str) -> Optional[int]:
+        position = int(np.searchsorted(self.terms, term))
+        if position < len(self.terms) and self.terms[position] == term:
+            return position
+        return None
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        Returns the BM25 score of every node for the query.
+        """
+        scores = np.zeros(len(self.node_ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_id(term)
+            if term_id is not None:
+                start, end = self.offsets[term_id], self.offsets[term_id + 1]
+                scores[self.rows[start:end]] += self._weights[start:end]
+        return scores
+
+    def query(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        """
+        Returns the ids and scores of the `top_k` best matching nodes, best first. Nodes without any query term are
+        never returned.
+        """
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(str(self.node_ids[row]), float(scores[row])) for row in candidates]
+
+    @staticmethod
+    def exists(persist_dir: str) -> bool:
+        return os.path.exists(os.path.join(persist_dir, BM25_FNAME))
+
+    @staticmethod
+    def _array_path(persist_dir: str, name: str) -> str:
+        return os.path.join(persist_dir, f"bm25_{name}.npy")
+
+    def persist(self, persist_dir: str):
+        """
+        Writes every array, the BM25 weights included, to its own `.npy` file and the parameters to
+        `bm25_index.json`. Every file is written to a temporary name and moved into place, the JSON file last.
+        """
+        os.makedirs(persist_dir, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in BM25_ARRAYS if name != "weights"}
+        arrays["weights"] = self._weights
+        for name, array in arrays.items():
+            path = self._array_path(persist_dir, name)
+            with open(f"{path}.tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(f"{path}.tmp", path)
+
+        path = os.path.join(persist_dir, BM25_FNAME)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "version": self.version}, f)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "BM25Index":
+        """
+        Opens a persisted index. The arrays are memory-mapped read-only, nothing is copied into memory.
+        """
+        with open(os.path.join(persist_dir, BM25_FNAME), "r", encoding="utf-8") as f:
+            params = json.load(f)
+        arrays = {name: np.load(cls._array_path(persist_dir, name), mmap_mode="r") for name in BM25_ARRAYS}
+        return cls(k1=params["k1"], b=params["b"], version=params["version"], **arrays)
+
+
+class BM25Retriever(BaseRetriever):
+    """
+    Retrieves the nodes of a docstore that best match the query terms, scored with BM25.
+    """
+
+    def __init__(self, bm25_index: BM25Index, docstore: BaseDocumentStore, similarity_top_k: int = 20):
+        self.bm25_index = bm25_index
+        self.docstore = docstore
+        self.similarity_top_k = similarity_top_k
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        matches = self.bm25_index.query(query_bundle.query_str, self.similarity_top_k)
+        nodes = self.docstore.get_nodes([node_id for node_id, _ in matches])
+        return [NodeWithScore(node=node, score=score) for node, (_, score) in zip(nodes, matches)]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the results of a vector retriever and a BM25 retriever with reciprocal rank fusion: a node scores
+    1 / (rrf_k + rank) for its rank in every result list, summed over the lists. Exact identifier matches that
+    the embedding search ranks low are pulled up, without having to calibrate the two kinds of scores.
+
+    Attributes:
+            vector_retriever (BaseRetriever): The embedding based retriever.
+            bm25_retriever (BM25Retriever): The lexical retriever.
+            similarity_top_k (int): The number of fused nodes returned.
+            vector_similarity_cutoff (Optional[float]): Vector results below this similarity are dropped before
+                fusion, fused scores can not be compared with a similarity cutoff. If no vector result is left the
+                question is off-topic and nothing is returned, the BM25 results only re-rank on-topic questions.
+            rrf_k (int): The rank offset of reciprocal rank fusion, 60 is the usual choice.
+    """
+
+    def __init__(self, vector_retriever: BaseRetriever, bm25_retriever: BM25Retriever, similarity_top_k: int = 10,
+                 vector_similarity_cutoff: Optional[float] = None, rrf_k: int = 60):
+        self.vector_retriever = vector_retriever
+        self.bm25_retriever = bm25_retriever
+        self.similarity_top_k = similarity_top_k
+        self.vector_similarity_cutoff = vector_similarity_cutoff
+        self.rrf_k = rrf_k
+        super().__init__()
+
+    def fuse(self, vector_nodes: Sequence[NodeWithScore], bm25_nodes: Sequence[NodeWithScore]) -> List[NodeWithScore]:
+        if self.vector_similarity_cutoff is not None:
+            vector_nodes = [node for node in vector_nodes if (node.score or 0.0) >= self.vector_similarity_cutoff]
+            if not vector_nodes:
+                # like the cutoff alone in vector mode, an off-topic question gets no context
+                return []
+
+        fused: Dict[str, float] = defaultdict(float)
+        nodes: Dict[str, NodeWithScore] = {}
+        for results in (vector_nodes, bm25_nodes):
+            for rank, node in enumerate(results, start=1):
+                fused[node.node_id] += 1.0 / (self.rrf_k + rank)
+                nodes.setdefault(node.node_id, node)
+
+        ranked = sorted(fused, key=fused.get, reverse=True)[:self.similarity_top_k]
+        return [NodeWithScore(node=nodes[node_id].node, score=fused[node_id]) for node_id in ranked]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.fuse(self.vector_retriever.retrieve(query_bundle), self.bm25_retriever.retrieve(query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_nodes = await self.vector_retriever.aretrieve(query_bundle)
+        # the lexical lookup takes well under a millisecond, it runs inline
+        return self.fuse(vector_nodes, self.bm25_retriever.retrieve(query_bundle))
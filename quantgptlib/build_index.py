@@ -0,0 +1,116 @@
+"""
+Builds or updates the index of QuantGPT and exits, serve.py runs it before it starts the workers.
+
+    python -m quantgptlib.build_index
+
+The update is built in a new generation of ./index and published as ./index/current once it is complete (see
+`index_generations`), so the workers attached to the previous generation keep serving it unchanged.
+
+The storage is configured from the environment and .env, like the chat app's (see `create_storage`). Nothing runs
+when the module is imported, so the spawned parse workers of `parallel_ingestion`, which re-import the main module,
+do not start builds of their own and INGESTION_WORKERS can be raised for this entry point.
+"""
+import os
+import sys
+import shutil
+import logging
+from typing import Any, Optional
+
+import openai
+from dotenv import load_dotenv
+
+from quantgptlib.simple_vector_storage import QuantSimpleVectorStorage
+from quantgptlib.index_generations import (UNCHANGED_EXIT_CODE, current_generation, index_dir, publish_generation,
+                                           stage_generation)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+PERSIST_DIR = "./index"
+SOURCE_FOLDER = "./quant_scraper/docs"
+EMBEDDING_CACHE_PATH = "./data/embedding_cache.sqlite"
+
+
+def create_storage(**kwargs: Any) -> QuantSimpleVectorStorage:
+    """
+    Creates the storage of the app with the settings of the environment, see env.example. `kwargs` are passed on
+    to QuantSimpleVectorStorage and take precedence, e.g. the chat app's `lazy=True`.
+
+    The index is opened from the current generation of PERSIST_DIR, resolved once here, so the storage keeps using
+    that generation when a build publishes the next one.
+    """
+    settings = dict(
+        persist_dir=index_dir(PERSIST_DIR),
+        # obtain gpt model name from environment variables
+        gpt_model=os.getenv('GPT_MODEL'),
+        gpt_temperature=float(os.getenv('GPT_TEMPERATURE')),
+        source_folder=SOURCE_FOLDER,
+        incremental=True,
+        # "simple" keeps llama_index's JSON vector store, "numpy" memory-maps the embeddings for a fast start
+        vector_store_type=os.getenv('VECTOR_STORE_TYPE', 'simple'),
+        # "sqlite" keeps the chunks in docstore.sqlite in the index directory and reads them on demand, so several
+        # workers can share the index
+        docstore_type=os.getenv('DOCSTORE_TYPE', 'simple'),
+        # "int8" or "float16" searches compressed copies of the embeddings and re-scores the best matches exactly
+        quantization=os.getenv('VECTOR_QUANTIZATION') or None,
+        # "hybrid" fuses the vector search with a BM25 index that matches exact API names, "vector" disables it
+        retriever_mode=os.getenv('RETRIEVER_MODE', 'hybrid'),
+        # the retrieved chunks are packed into this many tokens, small enough for a single tree_summarize call
+        context_token_budget=int(os.getenv('CONTEXT_TOKEN_BUDGET', 4000)),
+        # processes that read and split the documentation when the index is (re)built, 0 uses all CPU cores; the
+        # workers re-import the main module, more than 1 needs an entry point that is safe to import, like this one
+        ingestion_workers=int(os.getenv('INGESTION_WORKERS', 1)),
+        # "markdown" chunks the documentation along its sections, "token" splits it by token count
+        chunker=os.getenv('CHUNKER', 'markdown'),
+        embedding_cache_path=EMBEDDING_CACHE_PATH,
+        # questions asked again skip the embedding request, 0 disables the cache of question embeddings
+        query_cache_size=int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', 1024)),
+    )
+    settings.update(kwargs)
+    return QuantSimpleVectorStorage(**settings)
+
+
+def build_index() -> Optional[str]:
+    """
+    Builds the index, or updates a copy of the current generation with the changed documentation, and publishes
+    it as the new current generation. The previous generations are left for `remove_old_generations`.
+
+    Returns:
+        Optional[str]: The new generation directory, or None if the current generation was already up to date and
+            is kept.
+    """
+    staging = stage_generation(PERSIST_DIR)
+    try:
+        storage = create_storage(persist_dir=staging)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    if storage.kvstore is not None:
+        # the last connection checkpoints the WAL into the docstore file before the directory is published
+        storage.kvstore.close()
+    if not storage.persisted and current_generation(PERSIST_DIR) is not None:
+        shutil.rmtree(staging, ignore_errors=True)
+        logger.info(f"Index {storage.manifest.version} is up to date in {current_generation(PERSIST_DIR)}.")
+        return None
+
+    generation = publish_generation(PERSIST_DIR, staging, storage.manifest.version)
+    logger.info(f"Index {storage.manifest.version} is ready in {generation}.")
+    return generation
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv(".env", override=True)
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    try:
+        generation = build_index()
+    except Exception:
+        logger.exception("Index build failed.")
+        return 1
+    # serve.py only restarts its workers for a new generation
+    return 0 if generation is not None else UNCHANGED_EXIT_CODE
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+import re
+import math
+import logging
+from collections import Counter
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.indices.postprocessor.types import BaseNodePostprocessor
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.schema import MetadataMode, NodeRelationship, NodeWithScore
+from llama_index.utils import globals_helper
+
+from quantgptlib.bm25_index import tokenize
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# the key of the packing statistics in the payload of the RERANKING callback event
+PACKING_STATS_KEY = "packing_stats"
+
+_WORD_RE = re.compile(r"\w+")
+_HEADER_RE = re.compile(r"^#{1,6}\s")
+
+
+@dataclass
+class PackingStats:
+    """
+    What `TokenBudgetPostprocessor` did to the nodes of one query.
+    """
+    nodes_in: int = 0
+    nodes_out: int = 0
+    duplicates_dropped: int = 0
+    nodes_merged: int = 0
+    sections_dropped: int = 0
+    tokens_in: int = 0
+    tokens_out: int = 0
+
+
+def shingles(text: str, size: int = 3) -> Set[Tuple[str, ...]]:
+    """
+    Returns the set of word n-grams of the text, the fingerprint used to find near-duplicate chunks.
+    """
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def split_sections(text: str) -> List[str]:
+    """
+    Splits markdown into sections at blank lines and headers. A header stays with the paragraph that follows it,
+    fenced code blocks are never split.
+    """
+    sections: List[str] = []
+    current: List[str] = []
+    in_code = False
+    for line in text.split("\n"):
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+        boundary = not in_code and (not line.strip() or _HEADER_RE.match(line))
+        only_headers = all(_HEADER_RE.match(previous) for previous in current)
+        if boundary and current and not (only_headers and not line.strip()):
+            sections.append("\n".join(current))
+            current = []
+        if line.strip() or in_code:
+            current.append(line)
+    if current:
+        sections.append("\n".join(current))
+    return sections
+
+
+class TokenBudgetPostprocessor(BaseNodePostprocessor):
+    """
+    Packs the retrieved nodes into a context of at most `token_budget` tokens before response synthesis:
+
+    1. near-duplicate nodes (word 3-gram Jaccard similarity of at least `duplicate_threshold`) are dropped,
+    2. nodes that follow each other in the same source file are merged into one,
+    3. if the context is still over budget, every node is cut down to its sections (paragraphs, code blocks,
+       headers) that share the most informative terms with the query, until the budget is met.
+
+    With a budget below the LLM's context window the `tree_summarize` synthesizer answers in a single LLM call
+    instead of summarizing the chunks level by level. Every run emits a RERANKING callback event whose end
+    payload holds the packed nodes and the `PackingStats` under `PACKING_STATS_KEY`.
+    """
+
+    token_budget: int = Field(default=4000, description="The maximum number of context tokens.")
+    duplicate_threshold: float = Field(default=0.85, description="The Jaccard similarity of duplicate nodes.")
+    merge_adjacent: bool = Field(default=True, description="Whether to merge consecutive nodes of a file.")
+
+    _tokenizer: Callable[[str], List] = PrivateAttr()
+
+    def __init__(self, tokenizer: Optional[Callable[[str], List]] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._tokenizer = tokenizer or globals_helper.tokenizer
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenBudgetPostprocessor"
+
+    def count_tokens(self, text: str) -> int:
+        return len(self._tokenizer(text))
+
+    def postprocess_nodes(self, nodes: List[NodeWithScore],
+                          query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        """Postprocess nodes."""
+        query_str = query_bundle.query_str if query_bundle is not None else ""
+        with self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={EventPayload.NODES: nodes, EventPayload.QUERY_STR: query_str},
+        ) as event:
+            packed, stats = self.pack(nodes, query_str)
+            logger.debug(f"Packed context: {stats}")
+            event.on_end(payload={EventPayload.NODES: packed, PACKING_STATS_KEY: asdict(stats)})
+        return packed
+
+    def pack(self, nodes: List[NodeWithScore], query_str: str) -> Tuple[List[NodeWithScore], PackingStats]:
+        """
+        Returns the packed nodes, best first, and the statistics of the packing.
+        """
+        stats = PackingStats(nodes_in=len(nodes))
+        stats.tokens_in = sum(self.count_tokens(node.node.get_content(MetadataMode.LLM)) for node in nodes)
+
+        nodes = self.drop_duplicates(sorted(nodes, key=lambda node: node.score or 0.0, reverse=True))
+        stats.duplicates_dropped = stats.nodes_in - len(nodes)
+        if self.merge_adjacent:
+            merged = self.merge_neighbours(nodes)
+            stats.nodes_merged = len(nodes) - len(merged)
+            nodes = merged
+
+        nodes, stats.sections_dropped = self.fit_budget(nodes, query_str)
+        stats.nodes_out = len(nodes)
+        stats.tokens_out = sum(self.count_tokens(node.node.get_content(MetadataMode.LLM)) for node in nodes)
+        return nodes, stats
+
+    def drop_duplicates(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        kept: List[NodeWithScore] = []
+        fingerprints: List[Set[Tuple[str, ...]]] = []
+        for node in nodes:
+            fingerprint = shingles(node.node.get_content())
+            duplicate = any(
+                len(fingerprint & other) / max(len(fingerprint | other), 1) >= self.duplicate_threshold
+                for other in fingerprints
+            )
+            if not duplicate:
+                kept.append(node)
+                fingerprints.append(fingerprint)
+        return kept
+
+    @staticmethod
+    def merge_neighbours(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """
+        Merges runs of nodes that are linked as next/previous chunks of the same file, keeping the rank of the best
+        node of every run.
+        """
+        by_id = {node.node_id: node for node in nodes}
+        next_ids: Dict[str, str] = {}
+        for node in nodes:
+            next_info = node.node.relationships.get(NodeRelationship.NEXT)
+            if next_info is not None and next_info.node_id in by_id and \
+                    by_id[next_info.node_id].node.metadata.get("file_path") == node.node.metadata.get("file_path"):
+                next_ids[node.node_id] = next_info.node_id
+        if not next_ids:
+            return nodes
+
+        has_previous = set(next_ids.values())
+        run_of: Dict[str, str] = {}
+        runs: Dict[str, List[NodeWithScore]] = {}
+        for node in nodes:
+            if node.node_id in has_previous:
+                continue
+            run = [node]
+            while run[-1].node_id in next_ids and next_ids[run[-1].node_id] not in run_of:
+                run.append(by_id[next_ids[run[-1].node_id]])
+                run_of[run[-1].node_id] = node.node_id
+            runs[node.node_id] = run
+            for member in run:
+                run_of[member.node_id] = node.node_id
+
+        merged: List[NodeWithScore] = []
+        emitted = set()
+        for node in nodes:
+            run_id = run_of.get(node.node_id, node.node_id)
+            if run_id in emitted:
+                continue
+            emitted.add(run_id)
+            run = runs.get(run_id, [node])
+            if len(run) == 1:
+                merged.append(run[0])
+                continue
+
+            merged_node = run[0].node.copy()
+            merged_node.text = "\n\n".join(member.node.get_content() for member in run)
+            merged.append(NodeWithScore(node=merged_node, score=max(member.score or 0.0 for member in run)))
+        return merged
+
+    def fit_budget(self, nodes: List[NodeWithScore], query_str: str) -> Tuple[List[NodeWithScore], int]:
+        """
+        Cuts the nodes down to the sections most relevant to the query until their total size is within the budget.
+        Returns the nodes and the number of dropped sections.
+        """
+        sizes = [self.count_tokens(node.node.get_content(MetadataMode.LLM)) for node in nodes]
+        if sum(sizes) <= self.token_budget:
+            return nodes, 0
+
+        node_sections = [split_sections(node.node.get_content()) for node in nodes]
+        section_terms = [[set(tokenize(section)) for section in sections] for sections in node_sections]
+
+        # weigh the query terms by how rare they are among the sections, "how do I" matches everything
+        document_frequency = Counter(term for terms in section_terms for section in terms for term in section)
+        num_sections = max(sum(len(sections) for sections in node_sections), 1)
+        query_terms = set(tokenize(query_str))
+        weights = {
+            term: math.log(1 + num_sections / document_frequency[term])
+            for term in query_terms if document_frequency[term]
+        }
+
+        candidates = []
+        for rank, (sections, terms) in enumerate(zip(node_sections, section_terms)):
+            for position, section_terms_set in enumerate(terms):
+                relevance = sum(weights.get(term, 0.0) for term in section_terms_set & query_terms)
+                candidates.append((-relevance, rank, position))
+        candidates.sort()
+
+        # the metadata header of a node is paid once, with its first kept section
+        overheads = [
+            size - self.count_tokens(node.node.get_content()) for size, node in zip(sizes, nodes)
+        ]
+        # every kept section may need a gap marker
+        separator_cost = self.count_tokens("\n\n...\n\n")
+        kept: Dict[int, List[int]] = {}
+        budget_left = self.token_budget
+        for _, rank, position in candidates:
+            cost = self.count_tokens(node_sections[rank][position]) + separator_cost + \
+                (0 if rank in kept else overheads[rank])
+            if cost <= budget_left:
+                kept.setdefault(rank, []).append(position)
+                budget_left -= cost
+
+        packed: List[NodeWithScore] = []
+        for rank, node in enumerate(nodes):
+            if rank not in kept:
+                continue
+            positions = sorted(kept[rank])
+            if len(positions) == len(node_sections[rank]):
+                packed.append(node)
+                continue
+
+            parts = []
+            for i, position in enumerate(positions):
+                # mark the gaps, so the LLM does not read two distant sections as one passage
+                if position > 0 and (i == 0 or positions[i - 1] != position - 1):
+                    parts.append("...")
+                parts.append(node_sections[rank][position])
+            trimmed_node = node.node.copy()
+            trimmed_node.text = "\n\n".join(parts)
+            packed.append(NodeWithScore(node=trimmed_node, score=node.score))
+
+        return packed, len(candidates) - sum(len(positions) for positions in kept.values())
@@ -0,0 +1,234 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Type
+
+import numpy as np
+from tqdm import tqdm
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.schema import BaseNode, MetadataMode
+
+from quantgptlib.async_utils import RETRYABLE_ERRORS, retry_async, run_sync
+from quantgptlib.index_manifest import hash_text
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+EmbedFn = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+
+class EmbeddingCache:
+    """
+    A persistent embedding cache in a local SQLite file, keyed by (embedding model, sha256 of the embedded text).
+    Embeddings are stored as raw float32 bytes. The cache can be shared by threads of one process.
+
+    Attributes:
+            path (str): The SQLite database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " embedding BLOB NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.commit()
+
+    def get_many(self, model: str, text_hashes: Sequence[str]) -> Dict[str, List[float]]:
+        """
+        Returns the cached embeddings of the given text hashes. Missing hashes are left out of the result.
+        """
+        found: Dict[str, List[float]] = {}
+        # stay below SQLite's limit of host parameters per statement
+        for start in range(0, len(text_hashes), 500):
+            chunk = list(text_hashes[start:start + 500])
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *chunk],
+                ).fetchall()
+            for text_hash, blob in rows:
+                found[text_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: Iterable[Tuple[str, List[float]]]):
+        """
+        Stores (text hash, embedding) pairs, replacing existing entries.
+        """
+        rows = [(model, text_hash, np.asarray(embedding, dtype=np.float32).tobytes()) for text_hash, embedding in items]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class EmbeddingStats:
+    """
+    Counters of one `EmbeddingPipeline` run.
+    """
+    texts: int = 0
+    cache_hits: int = 0
+    embedded: int = 0
+    requests: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    def __str__(self) -> str:
+        return f"{self.texts} texts, {self.cache_hits} from cache, {self.embedded} embedded " \
+               f"in {self.requests} requests ({self.retries} retries), {self.seconds:.1f}s"
+
+
+class EmbeddingPipeline:
+    """
+    Embeds texts in batches with a bounded number of concurrent requests, retrying rate-limited requests with
+    exponential backoff, and skipping every text whose embedding is already in the cache. Identical texts are
+    embedded once per run.
+
+    Attributes:
+            embed_fn (EmbedFn): An async function that embeds one batch of texts. Any local function works, which
+                makes the pipeline easy to exercise without network access.
+            model_name (str): The embedding model name, part of the cache key.
+            cache (Optional[EmbeddingCache]): The persistent cache, or None to always embed.
+            batch_size (int): The number of texts sent in one request.
+            max_concurrency (int): The maximum number of requests in flight.
+            max_retries (int): How many times a failed request is repeated.
+            retry_on (Tuple[Type[BaseException], ...]): The exception types that trigger a retry.
+            show_progress (bool): Whether to show a progress bar.
+    """
+
+    def __init__(
+        self,
+        embed_fn: EmbedFn,
+        model_name: str,
+        cache: Optional[EmbeddingCache] = None,
+        batch_size: int = 100,
+        max_concurrency: int = 4,
+        max_retries: int = 6,
+        retry_on: Tuple[Type[BaseException], ...] = RETRYABLE_ERRORS,
+        show_progress: bool = False,
+    ):
+        self.embed_fn = embed_fn
+        self.model_name = model_name
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_on = retry_on
+        self.show_progress = show_progress
+        self.progress_callback: Optional[Callable[[int, int], None]] = None
+        self.last_stats = EmbeddingStats()
+
+    @classmethod
+    def from_embed_model(cls, embed_model: BaseEmbedding, cache_path: Optional[str] = None,
+                         **kwargs) -> "EmbeddingPipeline":
+        """
+        Creates a pipeline that embeds with a llama_index embedding model.
+
+        Args:
+            embed_model (BaseEmbedding): The embedding model.
+            cache_path (Optional[str]): The SQLite cache file, or None to disable the cache.
+            **kwargs: Passed to the constructor. `batch_size` defaults to the model's `embed_batch_size`.
+        """
+        kwargs.setdefault("batch_size", embed_model.embed_batch_size)
+        return cls(
+            embed_fn=embed_model.aget_text_embedding_batch,
+            model_name=embed_model.model_name,
+            cache=EmbeddingCache(cache_path) if cache_path else None,
+            **kwargs,
+        )
+
+    async def aembed_texts(self, texts: Sequence[str]) -> List[List[float]]:
+        """
+        Embeds the texts and returns their embeddings in the same order.
+        """
+        started = time.perf_counter()
+        stats = EmbeddingStats(texts=len(texts))
+
+        hashes = [hash_text(text) for text in texts]
+        embeddings: Dict[str, List[float]] = {}
+        if self.cache is not None:
+            embeddings.update(self.cache.get_many(self.model_name, sorted(set(hashes))))
+        stats.cache_hits = sum(1 for text_hash in hashes if text_hash in embeddings)
+
+        # every distinct missing text is embedded once
+        missing: Dict[str, str] = {}
+        for text_hash, text in zip(hashes, texts):
+            if text_hash not in embeddings:
+                missing.setdefault(text_hash, text)
+        missing_items = list(missing.items())
+        batches = [missing_items[i:i + self.batch_size] for i in range(0, len(missing_items), self.batch_size)]
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        progress = tqdm(total=len(missing_items), desc="Generating embeddings", disable=not self.show_progress)
+
+        def on_retry(attempt: int, error: BaseException):
+            stats.retries += 1
+
+        async def embed_batch(batch: List[Tuple[str, str]]):
+            async with semaphore:
+                batch_texts = [text for _, text in batch]
+                batch_embeddings = await retry_async(
+                    lambda: self.embed_fn(batch_texts),
+                    retry_on=self.retry_on,
+                    max_retries=self.max_retries,
+                    on_retry=on_retry,
+                )
+            stats.requests += 1
+            results = [(text_hash, embedding) for (text_hash, _), embedding in zip(batch, batch_embeddings)]
+            embeddings.update(results)
+            # write every finished batch right away, an interrupted build keeps what it already paid for
+            if self.cache is not None:
+                self.cache.put_many(self.model_name, results)
+            stats.embedded += len(batch)
+            progress.update(len(batch))
+            if self.progress_callback is not None:
+                self.progress_callback(stats.embedded, len(missing_items))
+
+        try:
+            await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        finally:
+            progress.close()
+            stats.seconds = time.perf_counter() - started
+            self.last_stats = stats
+            logger.info(f"Embeddings: {stats}")
+
+        return [embeddings[text_hash] for text_hash in hashes]
+
+    def embed_texts(self, texts: Sequence[str]) -> List[List[float]]:
+        """
+        Synchronous version of `aembed_texts`.
+        """
+        return run_sync(self.aembed_texts(texts))
+
+    def embed_nodes(self, nodes: Sequence[BaseNode]) -> Sequence[BaseNode]:
+        """
+        Fills the embedding of every node that has none, using the same content the index would embed.
+        VectorStoreIndex keeps embeddings that are already set, so it makes no embedding calls of its own.
+        """
+        pending = [node for node in nodes if node.embedding is None]
+        if pending:
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+            for node, embedding in zip(pending, self.embed_texts(texts)):
+                node.embedding = embedding
+        return nodes
@@ -0,0 +1,142 @@
+"""
+Keeps every build of the index in its own directory, a generation, so the processes that serve one generation are
+never affected by the build of the next one:
+
+    index/
+        current -> 3f2a9c0d1e2b4a5f-20261018190000
+        3f2a9c0d1e2b4a5f-20261018190000/
+            manifest.json, docstore.sqlite, vector_store.npy, bm25_*.npy, ...
+
+A build copies the files of the current generation into a staging directory, updates the index there, and publishes
+it by renaming the directory and swapping the `current` symlink atomically. A process that resolves `current` always
+finds a complete index, and keeps the generation it resolved for its whole lifetime.
+
+The module only uses the standard library, so the serving supervisor can import it without loading the index.
+"""
+import os
+import re
+import time
+import shutil
+import logging
+from typing import List, Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+CURRENT_LINK = "current"
+STAGING_PREFIX = ".staging-"
+# the exit code of `python -m quantgptlib.build_index` when the current generation was up to date and is kept
+UNCHANGED_EXIT_CODE = 3
+# `<manifest version>-<build time>`, optionally followed by the pid of the build
+_GENERATION_RE = re.compile(r"[0-9a-f]{16}-[0-9]{14}(-[0-9]+)?")
+
+# written to a temporary file and moved into place whenever they change, so a generation can share them
+_SHARED_SUFFIXES = (".npy", ".npz")
+
+
+def current_generation(root: str) -> Optional[str]:
+    """
+    Returns the resolved directory of the current generation, or None if no generation was published yet.
+    """
+    link = os.path.join(root, CURRENT_LINK)
+    if not os.path.isdir(link):
+        return None
+    return os.path.realpath(link)
+
+
+def index_dir(root: str) -> str:
+    """
+    Returns the directory to open the index from: the current generation, or `root` itself for an index that was
+    built in place, before generations were used or without `build_index`.
+    """
+    return current_generation(root) or root
+
+
+def _link_or_copy(source: str, target: str):
+    if source.endswith(_SHARED_SUFFIXES):
+        try:
+            # the arrays are never modified in place, both generations can point to the same inode
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, target)
+
+
+def stage_generation(root: str) -> str:
+    """
+    Creates a staging directory with the index files of the current generation, for a build to update. The NumPy
+    arrays are hard-linked, the other files (the SQLite docstore and the JSON files, which are updated in place)
+    are copied.
+
+    Returns:
+        str: The staging directory.
+    """
+    source = index_dir(root)
+    staging = os.path.join(root, f"{STAGING_PREFIX}{os.getpid()}")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    if os.path.isdir(source):
+        for name in os.listdir(source):
+            path = os.path.join(source, name)
+            # SQLite rebuilds the shared memory file of the WAL, the generations of `root` are not part of an index
+            if not os.path.isfile(path) or name.endswith(("-shm", ".tmp")):
+                continue
+            _link_or_copy(path, os.path.join(staging, name))
+    return staging
+
+
+def publish_generation(root: str, staging: str, version: str) -> str:
+    """
+    Moves a complete staging directory to its generation directory and points `current` to it.
+
+    Args:
+        root (str): The index root.
+        staging (str): The staging directory the index was built in.
+        version (str): The version of the built corpus, the generation is named after it and the build time.
+
+    Returns:
+        str: The new generation directory.
+    """
+    name = f"{version}-{time.strftime('%Y%m%d%H%M%S')}"
+    if os.path.exists(os.path.join(root, name)):
+        name = f"{name}-{os.getpid()}"
+    generation = os.path.join(root, name)
+    os.rename(staging, generation)
+
+    # the link is relative, so the index root can be moved as a whole
+    link = os.path.join(root, CURRENT_LINK)
+    tmp_link = f"{link}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(name, tmp_link)
+    os.replace(tmp_link, link)
+    logger.info(f"Published index generation {generation}.")
+    return generation
+
+
+def remove_old_generations(root: str) -> List[str]:
+    """
+    Removes every generation except the current one, and the staging directories of builds that did not finish.
+    Call it once no process serves an older generation any more, e.g. after all the workers were restarted.
+
+    Returns:
+        List[str]: The removed directories.
+    """
+    current = current_generation(root)
+    if current is None or not os.path.isdir(root):
+        return []
+
+    removed = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.islink(path) or not os.path.isdir(path) or os.path.realpath(path) == current:
+            continue
+        if not (_GENERATION_RE.fullmatch(name) or name.startswith(STAGING_PREFIX)):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed.append(path)
+    if removed:
+        logger.info(f"Removed {len(removed)} old index generations.")
+    return removed
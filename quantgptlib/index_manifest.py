@@ -0,0 +1,206 @@
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from llama_index.schema import BaseNode, MetadataMode
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_FNAME = "manifest.json"
+
+
+def normalize_path(path: str) -> str:
+    """
+    Normalizes a source path the same way SimpleDirectoryReader does when it fills the `file_path` metadata,
+    so manifest keys and node metadata can be compared directly.
+    """
+    return str(Path(path))
+
+
+def hash_text(text: str) -> str:
+    """
+    Returns the sha256 hex digest of a text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Returns the sha256 hex digest of a file's content, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_node(node: BaseNode) -> str:
+    """
+    Returns the hash of the exact content that is sent to the embedding model for a node.
+    Two nodes with the same hash share the same embedding.
+    """
+    return hash_text(node.get_content(metadata_mode=MetadataMode.EMBED))
+
+
+@dataclass
+class ManifestDiff:
+    """
+    The difference between the files recorded in a manifest and the files currently on disk.
+
+    Attributes:
+            added (List[str]): Files that are not in the manifest yet.
+            changed (List[str]): Files whose content hash differs from the recorded one.
+            removed (List[str]): Files that are recorded in the manifest but no longer exist.
+    """
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self) -> str:
+        return f"{len(self.added)} added, {len(self.changed)} changed, {len(self.removed)} removed"
+
+
+class IndexManifest:
+    """
+    Keeps track of the content hash of every indexed source file together with the documents and nodes
+    it produced, so the index can be refreshed by re-parsing only the files that changed.
+
+    The manifest is a JSON file stored next to the persisted index:
+
+        {
+            "chunker": "<name of the node parser>",
+            "files": {
+                "<file path>": {
+                    "hash": "<sha256 of the file>",
+                    "ref_doc_ids": ["<document id>", ...],
+                    "nodes": {"<node id>": "<sha256 of the embedded node content>", ...}
+                }
+            }
+        }
+    """
+
+    def __init__(self, files: Optional[Dict[str, dict]] = None, chunker: Optional[str] = None):
+        self.files = files or {}
+        self.chunker = chunker
+
+    @staticmethod
+    def exists(persist_dir: str) -> bool:
+        return os.path.exists(os.path.join(persist_dir, MANIFEST_FNAME))
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, with_nodes: bool = True) -> "IndexManifest":
+        """
+        Loads the manifest from the persist directory. Returns an empty manifest if there is none yet.
+
+        Args:
+            persist_dir (str): The directory of the persisted index.
+            with_nodes (bool): If False, only the file hashes are kept, enough for `version` but not for an update.
+        """
+        manifest_path = os.path.join(persist_dir, MANIFEST_FNAME)
+        if not os.path.exists(manifest_path):
+            return cls()
+
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        files = data.get("files", {})
+        if not with_nodes:
+            files = {path: {"hash": entry["hash"]} for path, entry in files.items()}
+        return cls(files=files, chunker=data.get("chunker"))
+
+    def persist(self, persist_dir: str):
+        """
+        Writes the manifest to the persist directory. The file is replaced atomically so a crash never leaves
+        a truncated manifest behind.
+        """
+        os.makedirs(persist_dir, exist_ok=True)
+        manifest_path = os.path.join(persist_dir, MANIFEST_FNAME)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.version, "chunker": self.chunker, "files": self.files}, f)
+        os.replace(tmp_path, manifest_path)
+
+    @property
+    def version(self) -> str:
+        """
+        A short hash that identifies the indexed corpus. It changes whenever any indexed file or the chunker
+        changes.
+        """
+        digest = hashlib.sha256()
+        if self.chunker is not None:
+            digest.update(f"chunker:{self.chunker}\n".encode("utf-8"))
+        for path in sorted(self.files):
+            digest.update(f"{path}:{self.files[path]['hash']}\n".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def diff(self, file_hashes: Dict[str, str], chunker: Optional[str] = None) -> ManifestDiff:
+        """
+        Compares the recorded files with the current ones. If the files are now split by another chunker,
+        every recorded file counts as changed.
+
+        Args:
+            file_hashes (Dict[str, str]): Mapping of normalized file path to its current content hash.
+            chunker (Optional[str]): The name of the current node parser, None to ignore it.
+
+        Returns:
+            ManifestDiff: The added, changed and removed files.
+        """
+        result = ManifestDiff()
+        rechunk = chunker is not None and chunker != self.chunker
+        for path, file_hash in sorted(file_hashes.items()):
+            if path not in self.files:
+                result.added.append(path)
+            elif rechunk or self.files[path]["hash"] != file_hash:
+                result.changed.append(path)
+        result.removed = sorted(path for path in self.files if path not in file_hashes)
+        return result
+
+    def find_node(self, path: str, node_hash: str) -> Optional[str]:
+        """
+        Returns the id of a previously indexed node of `path` with the given content hash, if any.
+        """
+        entry = self.files.get(path)
+        if entry is None:
+            return None
+        for node_id, recorded_hash in entry["nodes"].items():
+            if recorded_hash == node_hash:
+                return node_id
+        return None
+
+    def record_file(self, path: str, file_hash: str, nodes: Sequence[BaseNode]):
+        """
+        Records a parsed file together with the documents and nodes it produced.
+        """
+        ref_doc_ids = []
+        for node in nodes:
+            if node.ref_doc_id is not None and node.ref_doc_id not in ref_doc_ids:
+                ref_doc_ids.append(node.ref_doc_id)
+
+        self.files[path] = {
+            "hash": file_hash,
+            "ref_doc_ids": ref_doc_ids,
+            "nodes": {node.node_id: hash_node(node) for node in nodes},
+        }
+
+    def forget_file(self, path: str):
+        self.files.pop(path, None)
+
+
+def group_nodes_by_file(nodes: Iterable[BaseNode]) -> Dict[str, List[BaseNode]]:
+    """
+    Groups nodes by the normalized path of the source file they were parsed from.
+    """
+    groups: Dict[str, List[BaseNode]] = {}
+    for node in nodes:
+        path = normalize_path(node.metadata.get("file_path", ""))
+        groups.setdefault(path, []).append(node)
+    return groups
@@ -0,0 +1,147 @@
+import time
+import asyncio
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class IndexWarmup:
+    """
+    Loads or builds the index of a storage in a background thread, so the app can serve requests while the index
+    is being prepared. Chat handlers check `is_ready` or await `wait_ready` before they touch the index.
+
+    Attributes:
+            storage: A storage created with `lazy=True`, its `setup_index` is run by the warm-up thread.
+            state (str): One of "pending", "loading", "ready" or "failed".
+            stage (str): A human readable description of the current step, reported by the storage.
+            fraction (Optional[float]): Completion of the current stage between 0 and 1, if the stage reports it.
+            error (Optional[BaseException]): The exception that made the warm-up fail.
+    """
+
+    PENDING = "pending"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.state = self.PENDING
+        self.stage = "Waiting to start"
+        self.fraction: Optional[float] = None
+        self.error: Optional[BaseException] = None
+
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+        self.storage.progress_callback = self._on_progress
+
+    def start(self) -> "IndexWarmup":
+        """
+        Starts the warm-up thread. The thread is a daemon, it never keeps the process alive on shutdown.
+        """
+        self._started_at = time.monotonic()
+        self.state = self.LOADING
+        threading.Thread(target=self._run, name="index-warmup", daemon=True).start()
+        return self
+
+    def _run(self):
+        try:
+            self.storage.setup_index()
+            self.state = self.READY
+            self.stage = "Index is ready"
+            self.fraction = 1.0
+        except BaseException as e:
+            logger.exception("Index warm-up failed.")
+            self.state = self.FAILED
+            self.stage = "Index warm-up failed"
+            self.error = e
+        finally:
+            self._finished_at = time.monotonic()
+            self._done.set()
+            self._wake_waiters()
+
+    def _on_progress(self, stage: str, fraction: Optional[float] = None):
+        self.stage = stage
+        self.fraction = fraction
+
+    def _wake_waiters(self):
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == self.READY
+
+    @property
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def elapsed(self) -> float:
+        if self._started_at is None:
+            return 0.0
+        return (self._finished_at or time.monotonic()) - self._started_at
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks the calling thread until the warm-up is done. Returns True if the index is ready.
+        """
+        self._done.wait(timeout)
+        return self.is_ready
+
+    async def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits without blocking the event loop until the warm-up is done or the timeout expires.
+
+        Returns:
+                True if the index is ready.
+        """
+        if self.is_done:
+            return self.is_ready
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._waiters.append((loop, future))
+        # the warm-up may have finished before the waiter was registered
+        if self.is_done:
+            return self.is_ready
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_ready
+
+    def progress(self) -> dict:
+        """
+        Returns the warm-up progress as a dict, suitable for logging or a status endpoint.
+        """
+        return {
+            "state": self.state,
+            "stage": self.stage,
+            "fraction": self.fraction,
+            "elapsed": round(self.elapsed, 1),
+            "error": repr(self.error) if self.error is not None else None,
+        }
+
+    def status_message(self) -> str:
+        """
+        Returns a short message that explains the warm-up state to a user.
+        """
+        if self.state == self.FAILED:
+            return "The documentation index could not be loaded, please contact the administrator."
+        if self.state == self.READY:
+            return "The documentation index is ready."
+
+        percent = f" ({self.fraction:.0%})" if self.fraction is not None else ""
+        return f"I'm warming up: {self.stage}{percent}, {self.elapsed:.0f}s so far. " \
+               f"Your question will be answered as soon as the documentation index is ready."
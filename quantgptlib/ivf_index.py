@@ -0,0 +1,167 @@
+import os
+import logging
+from typing import Optional
+
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(embeddings: np.ndarray, norms: Optional[np.ndarray] = None, block_size: int = 65536) -> np.ndarray:
+    """
+    Returns the rows scaled to unit length as a new float32 array. Large (memory-mapped) inputs are processed
+    in blocks so no float64 temporaries of the full matrix are created.
+    """
+    result = np.empty(embeddings.shape, dtype=np.float32)
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        block_norms = norms[start:start + block_size] if norms is not None else np.linalg.norm(block, axis=1)
+        result[start:start + block_size] = block / np.maximum(block_norms, 1e-12)[:, None]
+    return result
+
+
+def spherical_kmeans(data: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Clusters unit-length rows by cosine similarity and returns `k` unit-length centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(data @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=k)
+        filled = np.flatnonzero(counts)
+
+        sums = np.zeros_like(centroids)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        sums[filled] = np.add.reduceat(data[order], starts, axis=0)
+
+        # re-seed empty clusters with random points so every list stays useful
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = data[rng.choice(len(data), size=int(empty.sum()), replace=False)]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1), 1e-12)[:, None]
+
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    An inverted file index for approximate cosine search in pure NumPy.
+
+    The vectors are partitioned into `nlist` clusters with spherical k-means (the coarse quantizer). A query is
+    compared with the centroids first, and only the vectors of the `nprobe` closest clusters are scored exactly.
+    Searching scans roughly nprobe / nlist of the corpus, higher `nprobe` trades latency for recall.
+
+    The index only holds the centroids and the cluster of every row; the vectors themselves stay in the vector
+    store, and rows are identified by their position in the store's embeddings matrix.
+
+    Attributes:
+            centroids (np.ndarray): The (nlist, dim) unit-length cluster centroids.
+            assignments (np.ndarray): The cluster of every row, aligned with the vector store rows.
+            trained_size (int): The number of rows the centroids were trained on.
+            fingerprint (str): Identifies the rows the assignments belong to, set by the vector store when it
+                persists the index and checked when it loads it.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_size: int, fingerprint: str = ""):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.trained_size = trained_size
+        self.fingerprint = fingerprint
+        self._order: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def default_nlist(num_vectors: int) -> int:
+        return max(1, int(round(2 * np.sqrt(num_vectors))))
+
+    @classmethod
+    def train(cls, embeddings: np.ndarray, norms: Optional[np.ndarray] = None, nlist: Optional[int] = None,
+              iterations: int = 10, sample_size_per_list: int = 64, seed: int = 0) -> "IVFIndex":
+        """
+        Trains the coarse quantizer on a sample of the vectors and assigns every vector to its cluster.
+
+        Args:
+            embeddings (np.ndarray): The (n, dim) vectors, may be memory-mapped.
+            norms (Optional[np.ndarray]): The precomputed L2 norm of every vector.
+            nlist (Optional[int]): The number of clusters, defaults to about 2 * sqrt(n).
+            iterations (int): The number of k-means iterations.
+            sample_size_per_list (int): How many training vectors are sampled per cluster.
+            seed (int): The random seed, training is deterministic for a given seed.
+        """
+        num_vectors = len(embeddings)
+        nlist = min(nlist or cls.default_nlist(num_vectors), num_vectors)
+
+        rng = np.random.default_rng(seed)
+        sample_size = min(num_vectors, nlist * sample_size_per_list)
+        sample_rows = np.sort(rng.choice(num_vectors, size=sample_size, replace=False))
+        sample = normalize_rows(embeddings[sample_rows], norms[sample_rows] if norms is not None else None)
+
+        logger.info(f"Training IVF index with {nlist} lists on {sample_size} of {num_vectors} vectors...")
+        centroids = spherical_kmeans(sample, nlist, iterations=iterations, seed=seed)
+
+        index = cls(centroids, np.empty(0, dtype=np.int32), trained_size=num_vectors)
+        index.add(embeddings, norms)
+        return index
+
+    def assign(self, embeddings: np.ndarray, norms: Optional[np.ndarray] = None,
+               block_size: int = 16384) -> np.ndarray:
+        """
+        Returns the closest cluster of every vector.
+        """
+        assignments = np.empty(len(embeddings), dtype=np.int32)
+        for start in range(0, len(embeddings), block_size):
+            block_norms = norms[start:start + block_size] if norms is not None else None
+            block = normalize_rows(embeddings[start:start + block_size], block_norms)
+            assignments[start:start + block_size] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def add(self, embeddings: np.ndarray, norms: Optional[np.ndarray] = None):
+        """
+        Appends rows to the index. The centroids are not retrained.
+        """
+        self.assignments = np.concatenate([self.assignments, self.assign(embeddings, norms)])
+        self._order = None
+
+    def keep(self, mask: np.ndarray):
+        """
+        Drops the rows where `mask` is False, mirroring a deletion in the vector store.
+        """
+        self.assignments = self.assignments[mask]
+        self._order = None
+
+    def _lists(self):
+        if self._order is None:
+            self._order = np.argsort(self.assignments, kind="stable")
+            self._offsets = np.searchsorted(self.assignments[self._order], np.arange(self.nlist + 1))
+        return self._order, self._offsets
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """
+        Returns the rows of the `nprobe` clusters closest to the unit-length query.
+        """
+        order, offsets = self._lists()
+        nprobe = min(nprobe, self.nlist)
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+
+    def persist(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments, trained_size=self.trained_size,
+                     fingerprint=self.fingerprint)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_path(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else ""
+            return cls(data["centroids"], data["assignments"], int(data["trained_size"]), fingerprint)
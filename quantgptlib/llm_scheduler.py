@@ -0,0 +1,215 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+from quantgptlib.async_utils import TokenRateLimiter
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+# the user the LLM calls of the current task are made for, and how they hear about their place in the queue
+_requester: ContextVar[Optional[Tuple[str, Optional[PositionCallback]]]] = ContextVar("requester", default=None)
+
+
+@dataclass(eq=False)
+class _Request:
+    user: str
+    granted: asyncio.Future
+    queued_at: float = field(default_factory=time.monotonic)
+    position: int = 0
+
+
+class FairLLMScheduler:
+    """
+    Admission control for the LLM calls of the chat: at most `max_concurrent` calls run at once and, if
+    `tokens_per_minute` is set, their estimated tokens stay under the per-minute quota (see TokenRateLimiter), so
+    a burst of questions queues up here instead of turning into a storm of rate-limited requests.
+
+    Waiting calls are queued per user and a free slot goes to the users in turn, so a user with many questions
+    (or a tree summarize with many chunks) does not hold back everybody else. The user is taken from `requester`,
+    which the chat handler sets around the query; its position callback is awaited with the place of the call in
+    the queue whenever it changes, to tell the user why the answer is not coming yet, and with 0 once the call
+    got its slot. A call that is cancelled, e.g. because its session disconnected, leaves the queue or frees its
+    slot.
+
+    The scheduler uses asyncio primitives, it serves the calls of one event loop.
+
+    Attributes:
+            max_concurrent (int): The most LLM calls running at once.
+            tokens_per_minute (Optional[float]): The token quota of the model, None for no limit.
+            completed (int): The number of calls that got a slot.
+            max_wait_seconds (float): The longest a call waited for its slot and its tokens.
+            wait_callback (Optional[Callable[[float], None]]): Called with the seconds every call waited for its
+                slot and its tokens, e.g. to observe them in the metrics.
+    """
+
+    def __init__(self, max_concurrent: int = 4, tokens_per_minute: Optional[float] = None):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1.")
+        self.max_concurrent = max_concurrent
+        self.tokens_per_minute = tokens_per_minute
+        self.completed = 0
+        self.max_wait_seconds = 0.0
+        self.wait_callback: Optional[Callable[[float], None]] = None
+
+        self._running = 0
+        # the users with waiting calls, in the order they get the next free slot
+        self._queues: "OrderedDict[str, Deque[_Request]]" = OrderedDict()
+        self._limiter: Optional[TokenRateLimiter] = None
+        # resolved whenever the queue moves, the waiting calls then look up their new position
+        self._moved_future: Optional[asyncio.Future] = None
+
+    @staticmethod
+    @contextmanager
+    def requester(user: str, on_position: Optional[PositionCallback] = None) -> Iterator[None]:
+        """
+        Makes the LLM calls of the block, and of the tasks it starts, calls of `user`.
+        """
+        token = _requester.set((user, on_position))
+        try:
+            yield
+        finally:
+            _requester.reset(token)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "queued": self.queued,
+            "queued_users": len(self._queues),
+            "completed": self.completed,
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+        }
+
+    def _positions(self) -> Dict[_Request, int]:
+        """
+        The place of every waiting call in the order the slots are handed out, starting at 1: one call of every
+        user per round, the users in their turn order.
+        """
+        positions = {}
+        position = 0
+        queues = list(self._queues.values())
+        for round_index in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if round_index < len(queue):
+                    position += 1
+                    positions[queue[round_index]] = position
+        return positions
+
+    def _dispatch(self):
+        """
+        Hands the free slots to the waiting calls, one user after the other.
+        """
+        while self._running < self.max_concurrent and self._queues:
+            user, queue = next(iter(self._queues.items()))
+            request = queue.popleft()
+            if queue:
+                # the user's next call waits for the others' turn
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            self._running += 1
+            request.granted.set_result(True)
+        self._notify_moved()
+
+    def _remove(self, request: _Request):
+        queue = self._queues.get(request.user)
+        if queue is not None and request in queue:
+            queue.remove(request)
+            if not queue:
+                del self._queues[request.user]
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
+
+    async def _wait(self, request: _Request, on_position: Optional[PositionCallback]):
+        while not request.granted.done():
+            # only the user's next call reports, a tree summarize queues several calls at once
+            queue = self._queues.get(request.user)
+            position = self._positions().get(request) if queue and queue[0] is request else None
+            if position is not None and position != request.position:
+                request.position = position
+                if on_position is not None:
+                    await self._report(on_position, position)
+                    continue
+            # woken up when a slot is handed out, which moves every waiting call forward, or when it is this one's
+            await asyncio.wait([request.granted, self._moved()], return_when=asyncio.FIRST_COMPLETED)
+
+    @staticmethod
+    async def _report(on_position: PositionCallback, position: int):
+        """
+        Awaits the position callback. It only informs the user, a failure is logged and the call goes on.
+        """
+        try:
+            await on_position(position)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("The queue position could not be reported.")
+
+    def _moved(self) -> asyncio.Future:
+        if self._moved_future is None or self._moved_future.done():
+            self._moved_future = asyncio.get_running_loop().create_future()
+        return self._moved_future
+
+    def _notify_moved(self):
+        if self._moved_future is not None and not self._moved_future.done():
+            self._moved_future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, tokens: int = 0) -> AsyncIterator[None]:
+        """
+        Waits for `tokens` in the token bucket, then for a free slot, and holds the slot while the block runs. The
+        tokens are taken before the call is queued, so a call waiting for the quota never holds a slot idle.
+
+        Args:
+            tokens (int): The estimated prompt and completion tokens of the call.
+        """
+        user, on_position = _requester.get() or ("", None)
+        queued_at = time.monotonic()
+        if self.tokens_per_minute:
+            if self._limiter is None:
+                self._limiter = TokenRateLimiter(self.tokens_per_minute)
+            await self._limiter.acquire(tokens)
+
+        request = _Request(user=user, granted=asyncio.get_running_loop().create_future(), queued_at=queued_at)
+        self._queues.setdefault(user, deque()).append(request)
+        self._dispatch()
+
+        try:
+            if not request.granted.done():
+                await self._wait(request, on_position)
+                logger.info(f"LLM call of {user or 'an unknown user'} waited "
+                            f"{time.monotonic() - request.queued_at:.1f}s for a slot.")
+                if request.position and on_position is not None:
+                    # position 0: the call is running, e.g. to take the queue notice down
+                    await self._report(on_position, 0)
+
+            waited = time.monotonic() - request.queued_at
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if self.wait_callback is not None:
+                self.wait_callback(waited)
+            self.completed += 1
+            yield
+        finally:
+            if request.granted.done():
+                self._release()
+            else:
+                request.granted.cancel()
+                self._remove(request)
+            self._notify_moved()
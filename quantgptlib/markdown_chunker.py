@@ -0,0 +1,398 @@
+import re
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.callbacks.base import CallbackManager
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.node_parser.extractors.metadata_extractors import MetadataExtractor
+from llama_index.node_parser.interface import NodeParser
+from llama_index.node_parser.node_utils import build_nodes_from_splits
+from llama_index.readers.file.markdown_reader import MarkdownReader
+from llama_index.schema import BaseNode, Document, MetadataMode
+from llama_index.utils import get_tqdm_iterable, globals_helper
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# the metadata key of the headings a chunk is nested in, e.g. "Portfolio > From signals > Stop orders"
+HEADER_PATH_KEY = "header_path"
+HEADER_PATH_SEPARATOR = " > "
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_FENCE_RE = re.compile(r"^\s*(`{3,}|~{3,})")
+_HTML_TAG_RE = re.compile(r"<.*?>")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+@dataclass
+class MarkdownBlock:
+    """
+    A unit of markdown that is never split across chunks unless it alone is larger than a chunk: a heading,
+    a paragraph, a fenced code block or a table.
+    """
+    kind: str
+    text: str
+
+
+@dataclass
+class MarkdownSection:
+    """
+    A heading and the blocks up to the next heading of any level.
+
+    Attributes:
+            header_path (Tuple[str, ...]): The titles of the enclosing headings and of the section's own heading,
+                empty for the text before the first heading.
+            blocks (List[MarkdownBlock]): The heading block, if any, followed by the content blocks.
+    """
+    header_path: Tuple[str, ...]
+    blocks: List[MarkdownBlock] = field(default_factory=list)
+
+
+@dataclass
+class _Piece:
+    # a section, or a part of an oversized one, while sections are packed into chunks
+    header_path: Tuple[str, ...]
+    blocks: List[str]
+    tokens: int
+    budget: int
+    starts_section: bool = True
+    ends_section: bool = True
+
+
+def parse_blocks(text: str) -> List[MarkdownBlock]:
+    """
+    Splits markdown into headings, paragraphs, fenced code blocks and tables. Blank lines separate paragraphs,
+    a code block runs until its closing fence (or the end of the text).
+    """
+    blocks: List[MarkdownBlock] = []
+    lines = text.split("\n")
+    paragraph: List[str] = []
+
+    def end_paragraph():
+        if paragraph:
+            blocks.append(MarkdownBlock("paragraph", "\n".join(paragraph)))
+            paragraph.clear()
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        fence = _FENCE_RE.match(line)
+        if fence:
+            end_paragraph()
+            marker = fence.group(1)
+            code = [line]
+            i += 1
+            while i < len(lines):
+                closing = lines[i].strip()
+                code.append(lines[i])
+                i += 1
+                if len(closing) >= len(marker) and set(closing) == {marker[0]}:
+                    break
+            blocks.append(MarkdownBlock("code", "\n".join(code)))
+            continue
+
+        if line.lstrip().startswith("|"):
+            end_paragraph()
+            table = []
+            while i < len(lines) and lines[i].lstrip().startswith("|"):
+                table.append(lines[i])
+                i += 1
+            blocks.append(MarkdownBlock("table", "\n".join(table)))
+            continue
+
+        if _HEADING_RE.match(line):
+            end_paragraph()
+            blocks.append(MarkdownBlock("heading", line.strip()))
+        elif not line.strip():
+            end_paragraph()
+        else:
+            paragraph.append(line)
+        i += 1
+
+    end_paragraph()
+    return blocks
+
+
+def parse_sections(text: str) -> List[MarkdownSection]:
+    """
+    Groups the blocks of a markdown text into sections, one per heading, and records the heading path of each.
+    """
+    sections = [MarkdownSection(header_path=())]
+    # the (level, title) of the headings enclosing the current position
+    stack: List[Tuple[int, str]] = []
+    for block in parse_blocks(text):
+        if block.kind == "heading":
+            match = _HEADING_RE.match(block.text)
+            level, title = len(match.group(1)), match.group(2)
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            stack.append((level, title))
+            sections.append(MarkdownSection(header_path=tuple(title for _, title in stack)))
+        sections[-1].blocks.append(block)
+    return [section for section in sections if section.blocks]
+
+
+def _common_prefix(paths: Sequence[Tuple[str, ...]]) -> Tuple[str, ...]:
+    prefix = paths[0]
+    for path in paths[1:]:
+        length = 0
+        while length < min(len(prefix), len(path)) and prefix[length] == path[length]:
+            length += 1
+        prefix = prefix[:length]
+    return prefix
+
+
+class MarkdownDocumentReader(MarkdownReader):
+    """
+    Reads a markdown file into a single document. llama_index's MarkdownReader returns one document per heading,
+    which loses the headings the section is nested in; the structure is left to MarkdownSectionNodeParser instead.
+    Links, images and HTML tags are removed the same way.
+    """
+
+    def load_data(self, file: Path, extra_info: Optional[Dict] = None) -> List[Document]:
+        with open(file, encoding="utf-8") as f:
+            content = f.read()
+        if self._remove_hyperlinks:
+            content = self.remove_hyperlinks(content)
+        if self._remove_images:
+            content = self.remove_images(content)
+        return [Document(text=_HTML_TAG_RE.sub("", content), metadata=extra_info or {})]
+
+
+class MarkdownSectionNodeParser(NodeParser):
+    """
+    Splits markdown documents into chunks along the section boundaries of the document.
+
+    Every section (a heading and the text up to the next heading) that fits into `chunk_size` tokens becomes part
+    of one chunk. Consecutive small sections are packed together only while they belong to the same part of the
+    document, i.e. they are nested in or are siblings of the first section of the chunk, so a short section is
+    never padded with unrelated text. A larger section is split between its paragraphs, code blocks and tables;
+    a code block or table is only split by lines if it alone exceeds a chunk, and every piece is closed and
+    reopened so it stays valid markdown.
+
+    The headings a chunk is nested in are recorded in its metadata under `HEADER_PATH_KEY`, so they are part of
+    both the embedded and the LLM content of the chunk. Token counts are cached per block, every block is
+    tokenized once no matter how often the packing looks at it.
+    """
+
+    chunk_size: int = Field(default=1024, description="The maximum number of tokens of a chunk and its metadata.")
+    include_metadata: bool = Field(default=True, description="Whether the chunks inherit the document metadata.")
+    include_prev_next_rel: bool = Field(default=True, description="Include prev/next node relationships.")
+    metadata_extractor: Optional[MetadataExtractor] = Field(
+        default=None, description="Metadata extraction pipeline to apply to nodes."
+    )
+    callback_manager: CallbackManager = Field(default_factory=CallbackManager, exclude=True)
+
+    _tokenizer: Callable[[str], List] = PrivateAttr()
+    _token_counts: Dict[str, int] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, tokenizer: Optional[Callable[[str], List]] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._tokenizer = tokenizer or globals_helper.tokenizer
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MarkdownSectionNodeParser"
+
+    def count_tokens(self, text: str) -> int:
+        count = self._token_counts.get(text)
+        if count is None:
+            count = len(self._tokenizer(text))
+            if len(self._token_counts) >= 100000:
+                self._token_counts.clear()
+            self._token_counts[text] = count
+        return count
+
+    def get_nodes_from_documents(self, documents: Sequence[Document], show_progress: bool = False) -> List[BaseNode]:
+        """Parse document into nodes.
+
+        Args:
+            documents (Sequence[Document]): documents to parse
+            show_progress (bool): whether to show a progress bar
+
+        """
+        with self.callback_manager.event(
+            CBEventType.NODE_PARSING, payload={EventPayload.DOCUMENTS: documents}
+        ) as event:
+            all_nodes: List[BaseNode] = []
+            for document in get_tqdm_iterable(documents, show_progress, "Parsing documents into nodes"):
+                all_nodes.extend(self.get_nodes_from_document(document))
+
+            if self.metadata_extractor is not None:
+                all_nodes = self.metadata_extractor.process_nodes(all_nodes)
+
+            event.on_end(payload={EventPayload.NODES: all_nodes})
+
+        return all_nodes
+
+    def get_nodes_from_document(self, document: Document) -> List[BaseNode]:
+        budget = self.chunk_size
+        if self.include_metadata:
+            # the chunk is embedded together with the document metadata and its heading path
+            metadata_str = document.get_metadata_str(mode=MetadataMode.EMBED)
+            budget -= self.count_tokens(metadata_str) + self.count_tokens(f"{HEADER_PATH_KEY}: ") + 4
+
+        chunks = self.chunk_sections(parse_sections(document.get_content()), budget)
+        nodes = build_nodes_from_splits(
+            [text for text, _ in chunks],
+            document,
+            include_metadata=self.include_metadata,
+            include_prev_next_rel=self.include_prev_next_rel,
+        )
+        for node, (_, header_path) in zip(nodes, chunks):
+            # build_nodes_from_splits shares the document's metadata dict between the nodes
+            node.metadata = dict(node.metadata)
+            if self.include_metadata:
+                node.metadata[HEADER_PATH_KEY] = HEADER_PATH_SEPARATOR.join(header_path)
+        return nodes
+
+    def chunk_sections(self, sections: Sequence[MarkdownSection],
+                       budget: int) -> List[Tuple[str, Tuple[str, ...]]]:
+        """
+        Packs the sections into chunks of at most `budget` tokens, including the heading path.
+
+        Returns:
+            The text and the heading path of every chunk.
+        """
+        separator_tokens = self.count_tokens("\n\n")
+
+        pieces: List[_Piece] = []
+        headings: List[MarkdownBlock] = []
+        for i, section in enumerate(sections):
+            # a heading that is directly followed by a subheading is carried into the subsection
+            if i + 1 < len(sections) and all(block.kind == "heading" for block in section.blocks):
+                headings.extend(section.blocks)
+                continue
+            if headings:
+                section = MarkdownSection(section.header_path, headings + section.blocks)
+                headings = []
+
+            section_budget = budget - self.count_tokens(HEADER_PATH_SEPARATOR.join(section.header_path))
+            parts = self._split_section(section, section_budget, separator_tokens)
+            for i, (blocks, tokens) in enumerate(parts):
+                pieces.append(_Piece(section.header_path, blocks, tokens, section_budget,
+                                     starts_section=i == 0, ends_section=i == len(parts) - 1))
+
+        chunks: List[Tuple[str, Tuple[str, ...]]] = []
+        current: List[_Piece] = []
+        for piece in pieces:
+            if current and current[-1].ends_section and piece.starts_section and \
+                    self._related(current, piece) and \
+                    sum(member.tokens + separator_tokens for member in current) + piece.tokens <= \
+                    min(member.budget for member in current + [piece]):
+                current.append(piece)
+                continue
+            if current:
+                chunks.append(self._join(current))
+            current = [piece]
+        if current:
+            chunks.append(self._join(current))
+        return chunks
+
+    @staticmethod
+    def _related(chunk: Sequence["_Piece"], piece: "_Piece") -> bool:
+        # the text before the first heading joins whatever follows it, after that a section joins the chunk if it
+        # is nested in the chunk's first section or is a sibling of it below the same heading
+        anchor = next((member.header_path for member in chunk if member.header_path), None)
+        if anchor is None:
+            return True
+        path = piece.header_path
+        return path[:len(anchor)] == anchor or \
+            (len(path) == len(anchor) > 1 and path[:-1] == anchor[:-1])
+
+    @staticmethod
+    def _join(pieces: Sequence["_Piece"]) -> Tuple[str, Tuple[str, ...]]:
+        text = "\n\n".join(block for piece in pieces for block in piece.blocks)
+        header_paths = [piece.header_path for piece in pieces if piece.header_path]
+        return text, _common_prefix(header_paths) if header_paths else ()
+
+    def _split_section(self, section: MarkdownSection, budget: int,
+                       separator_tokens: int) -> List[Tuple[List[str], int]]:
+        """
+        Splits a section into parts of at most `budget` tokens between its blocks, and oversized blocks between
+        their lines. A section that fits is returned as a single part.
+        """
+        parts: List[Tuple[List[str], int]] = []
+        blocks: List[str] = []
+        tokens = 0
+        for block in section.blocks:
+            block_tokens = self.count_tokens(block.text)
+            if block_tokens > budget:
+                # headings stay with the start of the block they introduce
+                headings = bool(blocks) and not parts and \
+                    all(heading.kind == "heading" for heading in section.blocks[:len(blocks)])
+                if blocks and not headings:
+                    parts.append((blocks, tokens))
+                block_pieces = self._split_block(block, budget - tokens - separator_tokens if headings else budget)
+                if headings:
+                    block_pieces[0] = "\n\n".join(blocks + block_pieces[:1])
+                parts.extend(([piece], self.count_tokens(piece)) for piece in block_pieces)
+                blocks, tokens = [], 0
+                continue
+            if blocks and tokens + separator_tokens + block_tokens > budget:
+                parts.append((blocks, tokens))
+                blocks, tokens = [], 0
+            tokens += (separator_tokens if blocks else 0) + block_tokens
+            blocks.append(block.text)
+        if blocks:
+            parts.append((blocks, tokens))
+        return parts
+
+    def _split_block(self, block: MarkdownBlock, budget: int) -> List[str]:
+        lines = block.text.split("\n")
+        # every piece of a code block is fenced, every piece of a table repeats the header rows
+        head: List[str] = []
+        tail: List[str] = []
+        if block.kind == "code":
+            head = lines[:1]
+            marker = _FENCE_RE.match(lines[0]).group(1)
+            tail = [marker]
+            closed = len(lines) > 1 and set(lines[-1].strip()) == {marker[0]}
+            lines = lines[1:-1] if closed else lines[1:]
+        elif block.kind == "table" and len(lines) > 2:
+            head, lines = lines[:2], lines[2:]
+
+        frame_tokens = sum(self.count_tokens(line) + 1 for line in head + tail)
+        pieces: List[str] = []
+        current: List[str] = []
+        tokens = frame_tokens
+        for line in lines:
+            for part in self._split_line(line, budget - frame_tokens - 1):
+                part_tokens = self.count_tokens(part) + 1
+                if current and tokens + part_tokens > budget:
+                    pieces.append("\n".join(head + current + tail))
+                    current, tokens = [], frame_tokens
+                current.append(part)
+                tokens += part_tokens
+        if current:
+            pieces.append("\n".join(head + current + tail))
+        return pieces
+
+    def _split_line(self, line: str, budget: int) -> List[str]:
+        """
+        Splits a line longer than `budget` tokens between its sentences, and a sentence that is still too long
+        between its words. Scraped pages often hold a whole paragraph in one line.
+        """
+        if self.count_tokens(line) <= budget:
+            return [line]
+
+        units: List[str] = []
+        for sentence in _SENTENCE_END_RE.split(line):
+            units.extend([sentence] if self.count_tokens(sentence) <= budget else sentence.split(" "))
+
+        parts: List[str] = []
+        current: List[str] = []
+        tokens = 0
+        for unit in units:
+            unit_tokens = self.count_tokens(unit)
+            if current and tokens + unit_tokens > budget:
+                parts.append(" ".join(current))
+                current, tokens = [], 0
+            current.append(unit)
+            tokens += unit_tokens
+        if current:
+            parts.append(" ".join(current))
+        return parts
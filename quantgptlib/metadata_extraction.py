@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+from tqdm import tqdm
+from llama_index.node_parser.extractors import (
+    EntityExtractor,
+    KeywordExtractor,
+    MetadataExtractor,
+    MetadataFeatureExtractor,
+    QuestionsAnsweredExtractor,
+    SummaryExtractor,
+)
+from llama_index.node_parser.extractors.metadata_extractors import DEFAULT_NODE_TEXT_TEMPLATE
+from llama_index.schema import BaseNode, TextNode
+from llama_index.utils import globals_helper
+
+from quantgptlib.async_utils import RETRYABLE_ERRORS, TokenRateLimiter, retry_async, run_sync
+from quantgptlib.index_manifest import hash_text
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# extractors whose result for a node depends on that node alone; the others (titles per document, summaries of the
+# neighbours) see all nodes at once and are neither parallelized nor cached
+NODE_LEVEL_EXTRACTORS = (QuestionsAnsweredExtractor, KeywordExtractor, EntityExtractor)
+
+
+class MetadataCache:
+    """
+    A persistent cache of extracted metadata in a local SQLite file, keyed by (extractor, prompt version, sha256 of
+    the chunk content the extractor reads). Every entry holds the metadata dict and, if the extractor changed them,
+    the metadata keys it excluded from the embedding or LLM content of the node. The cache can be shared by threads
+    of one process.
+
+    Attributes:
+            path (str): The SQLite database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " extractor TEXT NOT NULL,"
+            " prompt_version TEXT NOT NULL,"
+            " chunk_hash TEXT NOT NULL,"
+            " entry TEXT NOT NULL,"
+            " PRIMARY KEY (extractor, prompt_version, chunk_hash))"
+        )
+        self._conn.commit()
+
+    def get_many(self, extractor: str, prompt_version: str, chunk_hashes: Sequence[str]) -> Dict[str, dict]:
+        """
+        Returns the cached entries of the given chunk hashes. Missing hashes are left out of the result.
+        """
+        found: Dict[str, dict] = {}
+        # stay below SQLite's limit of host parameters per statement
+        for start in range(0, len(chunk_hashes), 500):
+            chunk = list(chunk_hashes[start:start + 500])
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT chunk_hash, entry FROM metadata"
+                    f" WHERE extractor = ? AND prompt_version = ? AND chunk_hash IN ({placeholders})",
+                    [extractor, prompt_version, *chunk],
+                ).fetchall()
+            for chunk_hash, entry in rows:
+                found[chunk_hash] = json.loads(entry)
+        return found
+
+    def put(self, extractor: str, prompt_version: str, chunk_hash: str, entry: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                (extractor, prompt_version, chunk_hash, json.dumps(entry)),
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def extractor_name(extractor: MetadataFeatureExtractor) -> str:
+    """
+    Identifies an extractor and the LLM behind it, the first part of the cache key.
+    """
+    llm_predictor = getattr(extractor, "llm_predictor", None)
+    model_name = llm_predictor.metadata.model_name if llm_predictor is not None else ""
+    return f"{extractor.class_name()}:{model_name}"
+
+
+def prompt_version(extractor: MetadataFeatureExtractor) -> str:
+    """
+    A short hash of the extractor's settings (prompt template, number of questions, ...), the second part of the
+    cache key. Editing the prompt invalidates the cached results of the extractor.
+    """
+    settings = extractor.dict(exclude={"llm_predictor", "show_progress"})
+    return hash_text(json.dumps(settings, sort_keys=True, default=str))[:16]
+
+
+@dataclass
+class ExtractionStats:
+    """
+    Counters of one `MetadataExtractionScheduler` run.
+    """
+    nodes: int = 0
+    jobs: int = 0
+    cache_hits: int = 0
+    extracted: int = 0
+    retries: int = 0
+    rate_limited_seconds: float = 0.0
+    seconds: float = 0.0
+
+    def __str__(self) -> str:
+        return f"{self.nodes} nodes, {self.jobs} jobs, {self.cache_hits} from cache, {self.extracted} extracted " \
+               f"({self.retries} retries, {self.rate_limited_seconds:.1f}s rate limited), {self.seconds:.1f}s"
+
+
+class MetadataExtractionScheduler:
+    """
+    Runs the extractors of a MetadataExtractor as a job scheduler instead of one blocking LLM call after another.
+
+    For every node-level extractor, each distinct chunk is one job. Jobs run concurrently, at most `max_concurrency`
+    at a time, and each job waits for its estimated prompt and completion tokens in a shared TokenRateLimiter.
+    Rate-limited and failed requests are retried with exponential backoff.
+
+    Each result is written to the cache as soon as its job finishes, so an interrupted run resumes where it stopped
+    and an unchanged chunk is never sent to the LLM again. The extractors run in order, and each one sees the
+    metadata added by the ones before it, the same as in MetadataExtractor.
+
+    llama_index's extractors only have blocking `extract` methods. A job calls `extract` with its single node in
+    the scheduler's thread pool.
+
+    Attributes:
+            extractors (Sequence[MetadataFeatureExtractor]): The extractors, applied in order.
+            cache (Optional[MetadataCache]): The persistent cache, or None to always extract.
+            max_concurrency (int): The maximum number of LLM requests in flight.
+            tokens_per_minute (Optional[float]): The token rate limit of all requests together, None for no limit.
+            completion_tokens (int): The completion size assumed for the rate limit.
+            max_retries (int): How many times a failed request is repeated.
+            retry_on (Tuple[Type[BaseException], ...]): The exception types that trigger a retry.
+            node_text_template (Optional[str]): The text template set on the nodes afterwards, as MetadataExtractor
+                does. None leaves the templates unchanged.
+            show_progress (bool): Whether to show a progress bar.
+    """
+
+    def __init__(
+        self,
+        extractors: Sequence[MetadataFeatureExtractor],
+        cache: Optional[MetadataCache] = None,
+        max_concurrency: int = 8,
+        tokens_per_minute: Optional[float] = 90000,
+        completion_tokens: int = 256,
+        max_retries: int = 6,
+        retry_on: Tuple[Type[BaseException], ...] = RETRYABLE_ERRORS,
+        node_text_template: Optional[str] = DEFAULT_NODE_TEXT_TEMPLATE,
+        show_progress: bool = False,
+        tokenizer: Optional[Callable[[str], List]] = None,
+    ):
+        self.extractors = extractors
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.completion_tokens = completion_tokens
+        self.max_retries = max_retries
+        self.retry_on = retry_on
+        self.node_text_template = node_text_template
+        self.show_progress = show_progress
+        self.progress_callback: Optional[Callable[[int, int], None]] = None
+        self.last_stats = ExtractionStats()
+
+        self._tokenizer = tokenizer or globals_helper.tokenizer
+
+    @classmethod
+    def from_metadata_extractor(cls, metadata_extractor: MetadataExtractor, cache_path: Optional[str] = None,
+                                **kwargs) -> "MetadataExtractionScheduler":
+        """
+        Creates a scheduler that runs the extractors of a MetadataExtractor with its node text template.
+
+        Args:
+            metadata_extractor (MetadataExtractor): The extraction pipeline.
+            cache_path (Optional[str]): The SQLite cache file, or None to disable the cache.
+            **kwargs: Passed to the constructor.
+        """
+        kwargs.setdefault(
+            "node_text_template",
+            None if metadata_extractor.disable_template_rewrite else metadata_extractor.node_text_template,
+        )
+        return cls(
+            extractors=list(metadata_extractor.extractors),
+            cache=MetadataCache(cache_path) if cache_path else None,
+            **kwargs,
+        )
+
+    def estimate_tokens(self, extractor: MetadataFeatureExtractor, context_str: str) -> int:
+        prompt_template = getattr(extractor, "prompt_template", "")
+        return len(self._tokenizer(prompt_template)) + len(self._tokenizer(context_str)) + self.completion_tokens
+
+    async def aprocess_nodes(self, nodes: Sequence[BaseNode]) -> Sequence[BaseNode]:
+        """
+        Extracts the metadata of the nodes and adds it to them in place.
+        """
+        started = time.perf_counter()
+        stats = ExtractionStats(nodes=len(nodes))
+        limiter = TokenRateLimiter(self.tokens_per_minute) if self.tokens_per_minute else None
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="metadata-extraction")
+        try:
+            for extractor in self.extractors:
+                if isinstance(extractor, NODE_LEVEL_EXTRACTORS) or \
+                        (isinstance(extractor, SummaryExtractor) and extractor.summaries == ["self"]):
+                    await self._run_node_level(extractor, nodes, stats, limiter, executor)
+                else:
+                    logger.info(f"{extractor.class_name()} reads all nodes at once, it runs without the cache.")
+                    loop = asyncio.get_running_loop()
+                    results = await loop.run_in_executor(executor, extractor.extract, nodes)
+                    for node, metadata in zip(nodes, results):
+                        node.metadata.update(metadata)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            stats.rate_limited_seconds = limiter.waited if limiter is not None else 0.0
+            stats.seconds = time.perf_counter() - started
+            self.last_stats = stats
+            logger.info(f"Metadata extraction: {stats}")
+
+        if self.node_text_template is not None:
+            for node in nodes:
+                if isinstance(node, TextNode):
+                    node.text_template = self.node_text_template
+        return nodes
+
+    async def _run_node_level(self, extractor: MetadataFeatureExtractor, nodes: Sequence[BaseNode],
+                              stats: ExtractionStats, limiter: Optional[TokenRateLimiter],
+                              executor: ThreadPoolExecutor):
+        name, version = extractor_name(extractor), prompt_version(extractor)
+        # the scheduler shows the progress, not every single-node call
+        extractor = extractor.copy(update={"show_progress": False})
+
+        targets = [node for node in nodes if isinstance(node, TextNode) or not extractor.is_text_node_only]
+        contexts = [node.get_content(metadata_mode=extractor.metadata_mode) for node in targets]
+        hashes = [hash_text(context) for context in contexts]
+        entries: Dict[str, dict] = {}
+        if self.cache is not None:
+            entries.update(self.cache.get_many(name, version, sorted(set(hashes))))
+        stats.cache_hits += sum(1 for chunk_hash in hashes if chunk_hash in entries)
+
+        # every distinct missing chunk is extracted once
+        jobs: Dict[str, Tuple[BaseNode, str]] = {}
+        for node, context, chunk_hash in zip(targets, contexts, hashes):
+            if chunk_hash not in entries:
+                jobs.setdefault(chunk_hash, (node, context))
+        stats.jobs += len(jobs)
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        progress = tqdm(total=len(jobs), desc=f"Extracting {extractor.class_name()}", disable=not self.show_progress)
+        loop = asyncio.get_running_loop()
+        done = 0
+
+        def on_retry(attempt: int, error: BaseException):
+            stats.retries += 1
+
+        async def run_job(chunk_hash: str, node: BaseNode, context: str):
+            nonlocal done
+            async with semaphore:
+                if limiter is not None:
+                    await limiter.acquire(self.estimate_tokens(extractor, context))
+                excluded_before = (list(node.excluded_embed_metadata_keys), list(node.excluded_llm_metadata_keys))
+                metadata = await retry_async(
+                    lambda: loop.run_in_executor(executor, extractor.extract, [node]),
+                    retry_on=self.retry_on,
+                    max_retries=self.max_retries,
+                    on_retry=on_retry,
+                )
+            entry = {"metadata": metadata[0]}
+            # e.g. QuestionsAnsweredExtractor hides its questions from the LLM by editing the node
+            if (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys) != excluded_before:
+                entry["excluded_embed_metadata_keys"] = node.excluded_embed_metadata_keys
+                entry["excluded_llm_metadata_keys"] = node.excluded_llm_metadata_keys
+            entries[chunk_hash] = entry
+            # every finished job is a checkpoint, an interrupted run keeps what it already paid for
+            if self.cache is not None:
+                self.cache.put(name, version, chunk_hash, entry)
+            stats.extracted += 1
+            done += 1
+            progress.update(1)
+            if self.progress_callback is not None:
+                self.progress_callback(done, len(jobs))
+
+        try:
+            await asyncio.gather(*(run_job(chunk_hash, node, context) for chunk_hash, (node, context) in jobs.items()))
+        finally:
+            progress.close()
+
+        for node, chunk_hash in zip(targets, hashes):
+            entry = entries[chunk_hash]
+            node.metadata.update(entry["metadata"])
+            if "excluded_embed_metadata_keys" in entry:
+                node.excluded_embed_metadata_keys = list(entry["excluded_embed_metadata_keys"])
+                node.excluded_llm_metadata_keys = list(entry["excluded_llm_metadata_keys"])
+
+    def process_nodes(self, nodes: Sequence[BaseNode]) -> Sequence[BaseNode]:
+        """
+        Synchronous version of `aprocess_nodes`.
+        """
+        return run_sync(self.aprocess_nodes(nodes))
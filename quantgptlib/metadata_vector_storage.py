@@ -1,6 +1,6 @@
 import os
 import logging
-from typing import Iterator
+from typing import Any, Iterator, Optional
 from llama_index import (
     LLMPredictor,
     StorageContext,
@@ -16,10 +16,16 @@ from llama_index.retrievers import VectorIndexRetriever
 from llama_index.callbacks.base import CallbackManager
 from llama_index.callbacks.base import BaseCallbackHandler
 from llama_index import SimpleDirectoryReader
-from llama_index.node_parser import SimpleNodeParser
-from llama_index.text_splitter import TokenTextSplitter
+from llama_index.vector_stores.types import VectorStore
+from llama_index.embeddings import OpenAIEmbedding
+from llama_index.embeddings.base import BaseEmbedding
 from llama_index.llms import OpenAI
 
+from quantgptlib.numpy_vector_store import NumpyVectorStore
+from quantgptlib.embedding_pipeline import EmbeddingPipeline
+from quantgptlib.markdown_chunker import MarkdownDocumentReader, MarkdownSectionNodeParser
+from quantgptlib.metadata_extraction import MetadataExtractionScheduler
+
 from llama_index.node_parser.extractors import (
     MetadataExtractor,
     QuestionsAnsweredExtractor,
@@ -29,6 +35,10 @@ from llama_index.node_parser.extractors import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+METADATA_CACHE_FNAME = "metadata_cache.sqlite"
+# the default of `metadata_cache_path`, a METADATA_CACHE_FNAME file in the persist directory
+_PERSIST_DIR_CACHE: Any = object()
+
 
 class QuantSimpleVectorStorage:
     """
@@ -39,20 +49,58 @@ class QuantSimpleVectorStorage:
             gpt_model (str): The name of the GPT model to use for predictions.
             gpt_temperature (float): The temperature to use for GPT predictions.
             source_folder (str): The folder containing the markdown files to use for indexing.
+            vector_store_type (str): The vector store backend, "simple" for llama_index's JSON store or "numpy"
+                for the memory-mapped NumpyVectorStore.
+            embed_model (Optional[BaseEmbedding]): The embedding model, defaults to OpenAIEmbedding.
+            embed_batch_size (int): The number of texts sent in one embedding request.
+            embed_concurrency (int): The maximum number of embedding requests in flight while indexing.
+            embedding_cache_path (Optional[str]): A SQLite file that caches embeddings across index builds.
+            ann (Optional[str]): Approximate nearest-neighbour search for the "numpy" vector store, "ivf" or None
+                for exact search. Stores below `ann_exact_search_threshold` vectors are always searched exactly.
+            ann_nprobe (int): The number of IVF clusters scanned per query, higher is slower but more accurate.
+            ann_exact_search_threshold (int): The store size from which approximate search is used.
+            metadata_cache_path (Optional[str]): A SQLite file that caches the extracted metadata of every chunk
+                across index builds, and lets an interrupted extraction resume. Defaults to
+                `<persist_dir>/metadata_cache.sqlite`, None disables the cache.
+            extraction_concurrency (int): The maximum number of metadata extraction requests in flight.
+            extraction_tokens_per_minute (Optional[float]): The token rate limit of the metadata extraction
+                requests, None for no limit.
     """
 
 
 class QuantMetadataVectorStorage:
-    def __init__(self, persist_dir: str, gpt_model: str, gpt_temperature: float, source_folder: str):
+    def __init__(self, persist_dir: str, gpt_model: str, gpt_temperature: float, source_folder: str,
+                 vector_store_type: str = "simple", embed_model: Optional[BaseEmbedding] = None,
+                 embed_batch_size: int = 100, embed_concurrency: int = 4, embedding_cache_path: Optional[str] = None,
+                 ann: Optional[str] = None, ann_nprobe: int = 16, ann_exact_search_threshold: int = 20000,
+                 metadata_cache_path: Optional[str] = _PERSIST_DIR_CACHE, extraction_concurrency: int = 8,
+                 extraction_tokens_per_minute: Optional[float] = 90000):
         # collect arguments
         self.persist_dir = persist_dir
         self.gpt_model = gpt_model
         self.gpt_temperature = gpt_temperature
         self.source_folder = source_folder
+        self.vector_store_type = vector_store_type
+        self.embed_batch_size = embed_batch_size
+        self.ann = ann
+        self.ann_nprobe = ann_nprobe
+        self.ann_exact_search_threshold = ann_exact_search_threshold
+        if metadata_cache_path is _PERSIST_DIR_CACHE:
+            metadata_cache_path = os.path.join(persist_dir, METADATA_CACHE_FNAME)
+        self.metadata_cache_path = metadata_cache_path
+        self.extraction_concurrency = extraction_concurrency
+        self.extraction_tokens_per_minute = extraction_tokens_per_minute
 
         # initialize attributes
         self.index = None
         self.llm_predictor = self.create_llm_predictor()
+        self.embed_model = embed_model or self.create_embed_model()
+        self.embedding_pipeline = EmbeddingPipeline.from_embed_model(
+            self.embed_model,
+            cache_path=embedding_cache_path,
+            max_concurrency=embed_concurrency,
+            show_progress=True,
+        )
 
         # setup index
         self.setup_index()
@@ -102,41 +150,90 @@ class QuantMetadataVectorStorage:
         """
         return OpenAI(temperature=0.1, model="gpt-3.5-turbo", max_tokens=512)
 
+    def create_embed_model(self) -> BaseEmbedding:
+        """
+        Sets up and returns the OpenAI embedding model used for both indexing and queries.
+
+        Returns:
+                An instance of the OpenAIEmbedding class.
+        """
+        return OpenAIEmbedding(embed_batch_size=self.embed_batch_size)
+
     def load_index_nodes(self):
         logger.info('Loading documents...')
         llm_indexer = self.get_llm_indexer()
 
-        text_splitter = TokenTextSplitter(
-            separator="\n## ", chunk_size=1024, chunk_overlap=0)
-
         metadata_extractor = MetadataExtractor(
             extractors=[
-                # QuestionsAnsweredExtractor(questions=3, llm=llm_indexer),
+                QuestionsAnsweredExtractor(questions=3, llm=llm_indexer),
             ],
         )
 
-        node_parser = SimpleNodeParser.from_defaults(
-            text_splitter=text_splitter,
-            metadata_extractor=metadata_extractor,
+        # the extractors run concurrently and rate limited after parsing, unchanged chunks come from the cache
+        metadata_scheduler = MetadataExtractionScheduler.from_metadata_extractor(
+            metadata_extractor,
+            cache_path=self.metadata_cache_path,
+            max_concurrency=self.extraction_concurrency,
+            tokens_per_minute=self.extraction_tokens_per_minute,
+            show_progress=True,
         )
 
+        # chunks follow the markdown sections and carry their heading path
+        node_parser = MarkdownSectionNodeParser(chunk_size=1024)
+
         documents = SimpleDirectoryReader(
-            input_files=self.list_sources()).load_data()
+            input_files=self.list_sources(),
+            file_extractor={".md": MarkdownDocumentReader()}).load_data()
 
         index_nodes = node_parser.get_nodes_from_documents(
             documents, show_progress=True)
 
+        logger.info('Extracting metadata...')
+        metadata_scheduler.process_nodes(index_nodes)
+
         return index_nodes
 
+    def create_vector_store(self, load: bool = False) -> Optional[VectorStore]:
+        """
+        Returns the vector store selected by `vector_store_type`.
+
+        Args:
+            load (bool): If True, the store is opened from `persist_dir` instead of created empty.
+
+        Returns:
+                The vector store, or None for the llama_index default store.
+        """
+        if self.vector_store_type == "simple":
+            if self.ann is not None:
+                raise ValueError("Approximate search needs the \"numpy\" vector store type.")
+            return None
+        if self.vector_store_type == "numpy":
+            search_kwargs = dict(
+                ann=self.ann,
+                nprobe=self.ann_nprobe,
+                exact_search_threshold=self.ann_exact_search_threshold,
+            )
+            if load:
+                return NumpyVectorStore.from_persist_dir(self.persist_dir, **search_kwargs)
+            return NumpyVectorStore(**search_kwargs)
+        raise ValueError(f"Unknown vector store type: {self.vector_store_type}")
+
     def create_index(self):
         logger.info('Building index...')
 
+        index_nodes = self.load_index_nodes()
+        self.embedding_pipeline.embed_nodes(index_nodes)
+
         index = VectorStoreIndex(
-            nodes=self.load_index_nodes(),
+            nodes=index_nodes,
             show_progress=True,
             service_context=ServiceContext.from_defaults(
                 llm_predictor=self.llm_predictor,
-            )
+                embed_model=self.embed_model,
+            ),
+            storage_context=StorageContext.from_defaults(
+                vector_store=self.create_vector_store(),
+            ),
         )
 
         return index
@@ -150,8 +247,14 @@ class QuantMetadataVectorStorage:
         try:
             logger.info('Loading index...')
             storage_context = StorageContext.from_defaults(
-                persist_dir=self.persist_dir)
-            self.index = load_index_from_storage(storage_context)
+                persist_dir=self.persist_dir,
+                vector_store=self.create_vector_store(load=True))
+            self.index = load_index_from_storage(
+                storage_context,
+                service_context=ServiceContext.from_defaults(
+                    llm_predictor=self.llm_predictor,
+                    embed_model=self.embed_model,
+                ))
         except Exception as e:
             logger.info('Persisted Index not found, building new one.')
 
@@ -172,8 +275,9 @@ class QuantMetadataVectorStorage:
 
         return ServiceContext.from_defaults(
             llm_predictor=llm_predictor,
+            embed_model=self.embed_model,
             chunk_size=1024,
-            callback_manager=CallbackManager([callback_handler])
+            callback_manager=CallbackManager([callback_handler] if callback_handler is not None else [])
         )
 
     def create_query_engine(self, callback_handler: BaseCallbackHandler = None) -> RetrieverQueryEngine:
@@ -0,0 +1,336 @@
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from llama_index.callbacks.base import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.utils import globals_helper
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# seconds, from a fast BM25 lookup to a slow multi-level tree_summarize answer
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = "quantgpt_stage_duration_seconds"
+REQUEST_SECONDS = "quantgpt_request_duration_seconds"
+LLM_PROMPT_TOKENS = "quantgpt_llm_prompt_tokens_total"
+LLM_COMPLETION_TOKENS = "quantgpt_llm_completion_tokens_total"
+EMBEDDING_TOKENS = "quantgpt_embedding_tokens_total"
+CACHE_REQUESTS = "quantgpt_cache_requests_total"
+ERRORS = "quantgpt_errors_total"
+LLM_QUEUE_SECONDS = "quantgpt_llm_queue_seconds"
+
+# the callback events that are timed, by the stage they are reported as
+EVENT_STAGES = {
+    CBEventType.EMBEDDING: "embedding",
+    CBEventType.RETRIEVE: "retrieval",
+    CBEventType.RERANKING: "postprocessing",
+    CBEventType.LLM: "llm",
+    CBEventType.SYNTHESIZE: "synthesis",
+    CBEventType.QUERY: "query",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms with labels, rendered in the Prometheus text format. There is no
+    dependency on a Prometheus client, the registry only needs to be scraped.
+
+    Every update can also be appended to a JSONL file, one line per observation with a timestamp, for offline
+    analysis of where the time and tokens of a load test went.
+
+    Attributes:
+            jsonl_path (Optional[str]): The file observations are appended to, or None.
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = None):
+        self.jsonl_path = jsonl_path
+
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+
+    def counter(self, name: str, description: str):
+        """
+        Declares a counter, its samples are created by `inc`.
+        """
+        with self._lock:
+            self._help[name] = ("counter", description)
+            self._counters.setdefault(name, {})
+
+    def histogram(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        """
+        Declares a histogram, its samples are created by `observe`.
+        """
+        with self._lock:
+            self._help[name] = ("histogram", description)
+            self._buckets[name] = tuple(sorted(buckets))
+            self._histograms.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any):
+        key = _labels(labels)
+        with self._lock:
+            samples = self._counters[name]
+            samples[key] = samples.get(key, 0.0) + value
+            self._dump(name, key, value)
+
+    def observe(self, name: str, value: float, **labels: Any):
+        key = _labels(labels)
+        with self._lock:
+            samples = self._histograms[name]
+            if key not in samples:
+                samples[key] = _Histogram(self._buckets[name])
+            samples[key].observe(value)
+            self._dump(name, key, value)
+
+    @contextmanager
+    def time(self, name: str, **labels: Any) -> Iterator[None]:
+        """
+        Observes the duration of the block in the histogram `name`, also when it raises.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def _dump(self, name: str, labels: Labels, value: float):
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps({"ts": time.time(), "metric": name, "labels": dict(labels),
+                                         "value": value}) + "\n")
+            self._jsonl.flush()
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, description) in sorted(self._help.items()):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for labels, value in sorted(self._counters[name].items()):
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                for labels, histogram in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels, [('le', repr(bound))])} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns the counters and the count, sum and mean of the histograms, for logging.
+        """
+        with self._lock:
+            snapshot: Dict[str, Any] = {}
+            for name, samples in self._counters.items():
+                for labels, value in samples.items():
+                    snapshot[f"{name}{_format_labels(labels)}"] = value
+            for name, samples in self._histograms.items():
+                for labels, histogram in samples.items():
+                    snapshot[f"{name}{_format_labels(labels)}"] = {
+                        "count": histogram.count,
+                        "sum": round(histogram.sum, 6),
+                        "mean": round(histogram.sum / histogram.count, 6) if histogram.count else None,
+                    }
+            return snapshot
+
+    def close(self):
+        with self._lock:
+            if self._jsonl is not None:
+                self._jsonl.close()
+                self._jsonl = None
+
+
+def create_registry(jsonl_path: Optional[str] = None) -> MetricsRegistry:
+    """
+    Creates a registry with the metrics of the app declared.
+    """
+    registry = MetricsRegistry(jsonl_path=jsonl_path)
+    registry.histogram(STAGE_SECONDS, "Duration of a pipeline stage (embedding, retrieval, postprocessing, one "
+                                      "LLM call, synthesis, query).")
+    registry.histogram(REQUEST_SECONDS, "End-to-end duration of a chat message, from receipt to the last token.")
+    registry.counter(LLM_PROMPT_TOKENS, "Tokens sent to the LLM.")
+    registry.counter(LLM_COMPLETION_TOKENS, "Tokens generated by the LLM.")
+    registry.counter(EMBEDDING_TOKENS, "Tokens sent to the embedding model.")
+    registry.counter(CACHE_REQUESTS, "Cache lookups by cache and result (hit or miss).")
+    registry.counter(ERRORS, "Errors by the stage they were raised in.")
+    registry.histogram(LLM_QUEUE_SECONDS, "Time an LLM call waited for a slot of the scheduler.")
+    return registry
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Feeds the llama_index callback events into a MetricsRegistry: the duration of every timed event (see
+    `EVENT_STAGES`), the prompt and completion tokens of every LLM call, the tokens of every embedding request
+    and the exceptions raised inside events.
+
+    Events are matched by id, so a single handler can be shared by all sessions and threads. An event nested in
+    an event of the same stage is not timed on its own.
+
+    Attributes:
+            registry (MetricsRegistry): Where the metrics are recorded, see `create_registry`.
+    """
+
+    def __init__(self, registry: MetricsRegistry):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.registry = registry
+        self._lock = threading.Lock()
+        # event id -> (stage, start time) of the events in flight
+        self._started: Dict[str, Tuple[str, float]] = {}
+
+    def _count_tokens(self, text: str) -> int:
+        return len(globals_helper.tokenizer(text)) if text else 0
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                       event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        if event_type == CBEventType.EXCEPTION:
+            # the exception is reported inside the event that raised it
+            with self._lock:
+                stage = self._started.get(parent_id, ("unknown", 0.0))[0]
+            self.registry.inc(ERRORS, stage=stage)
+        elif event_type in EVENT_STAGES:
+            stage = EVENT_STAGES[event_type]
+            with self._lock:
+                # an event inside an event of the same stage, e.g. a postprocessor's own RERANKING event, is
+                # already part of the outer duration
+                parent = self._started.get(parent_id)
+                if parent is None or parent[0] != stage:
+                    self._started[event_id] = (stage, time.perf_counter())
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                     event_id: str = "", **kwargs: Any) -> None:
+        with self._lock:
+            started = self._started.pop(event_id, None)
+        if started is None:
+            return
+        stage, started_at = started
+        self.registry.observe(STAGE_SECONDS, time.perf_counter() - started_at, stage=stage)
+
+        payload = payload or {}
+        if event_type == CBEventType.LLM:
+            self._record_llm_tokens(payload)
+        elif event_type == CBEventType.EMBEDDING and EventPayload.CHUNKS in payload:
+            chunks = payload[EventPayload.CHUNKS]
+            self.registry.inc(EMBEDDING_TOKENS, sum(self._count_tokens(chunk) for chunk in chunks))
+
+    def _record_llm_tokens(self, payload: Dict[str, Any]):
+        if EventPayload.MESSAGES in payload:
+            prompt = "\n".join(str(message.content or "") for message in payload[EventPayload.MESSAGES])
+        else:
+            prompt = str(payload.get(EventPayload.PROMPT, ""))
+        if EventPayload.RESPONSE in payload:
+            response = payload[EventPayload.RESPONSE]
+            completion = getattr(getattr(response, "message", None), "content", None) or ""
+        else:
+            completion = getattr(payload.get(EventPayload.COMPLETION), "text", None) or ""
+        self.registry.inc(LLM_PROMPT_TOKENS, self._count_tokens(prompt))
+        self.registry.inc(LLM_COMPLETION_TOKENS, self._count_tokens(completion))
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
+
+
+class MetricsServer:
+    """
+    Serves the metrics of a registry at `/metrics` for Prometheus to scrape, from a daemon thread. If the port can not
+    be bound, `start` logs a warning and the metrics are only kept in the registry.
+
+    Attributes:
+            registry (MetricsRegistry): The metrics that are served.
+            host (str): The interface to listen on, local only by default.
+            port (int): The port to listen on.
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> "MetricsServer":
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any):
+                # scrapes every few seconds would flood the app log
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            # e.g. the port of another app instance, the metrics are optional and the app keeps running without them
+            logger.warning(f"Could not serve metrics on {self.host}:{self.port}, the endpoint is disabled: {e}")
+            return self
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving metrics at http://{self.host}:{self.port}/metrics")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,476 @@
+import os
+import io
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import fsspec
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.types import (
+    DEFAULT_PERSIST_DIR,
+    DEFAULT_PERSIST_FNAME,
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+from quantgptlib.ivf_index import IVFIndex
+from quantgptlib.quantization import ScalarQuantizer
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    A vector store that keeps all embeddings in one contiguous float32 matrix.
+
+    The matrix is persisted as a `.npy` file and memory-mapped on load, so opening the store costs the same no
+    matter how many vectors it holds and pages are only read from disk when they are first scanned. Node ids,
+    reference document ids and vector norms are kept in compact NumPy arrays next to it, memory-mapped as well, so
+    processes that open the same store share one copy in the page cache. A query is answered
+    with a single matrix-vector product followed by `argpartition`.
+
+    With `ann="ivf"` the store also keeps an IVFIndex (k-means coarse quantizer) and, once it holds at least
+    `exact_search_threshold` vectors, only scores the vectors of the `nprobe` closest clusters. Smaller stores
+    are always searched exactly. `nprobe` can be overridden per query through the retriever's
+    `vector_store_kwargs={"nprobe": ...}`.
+
+    With `quantization="float16"` or `"int8"` the store also keeps a ScalarQuantizer code of every vector, 2x or 4x
+    smaller than the float32 matrix. A query scans the codes (of the probed clusters with IVF) and scores only the
+    `similarity_top_k * rerank_factor` best candidates exactly from the float32 vectors, so a loaded store only
+    pages in the codes. The rows of the candidates are read from the `.npy` file with `pread` rather than through
+    the memory map, so they do not add to the resident memory either; `close()` releases that file. The quantizer
+    is trained on the first persist and retrained like the IVF index, once the store has more than doubled.
+
+    Given the persist path `<dir>/vector_store.json` that StorageContext hands out, the store writes:
+        - `<dir>/vector_store.npy`: the (n, dim) float32 embeddings
+        - `<dir>/vector_store_norms.npy`: the (n,) float32 L2 norm of every embedding
+        - `<dir>/vector_store_ids.npy`: the node ids
+        - `<dir>/vector_store_ref_doc_ids.npy`: the reference document ids
+        - `<dir>/vector_store_ivf.npz`: the IVF centroids and cluster assignments, if enabled
+        - `<dir>/vector_store_codes.npy`: the (n, dim) quantized codes, if enabled
+        - `<dir>/vector_store_quantizer.npz`: the quantizer parameters, if enabled
+    """
+
+    stores_text: bool = False
+
+    def __init__(
+        self,
+        embeddings: Optional[np.ndarray] = None,
+        norms: Optional[np.ndarray] = None,
+        ids: Optional[np.ndarray] = None,
+        ref_doc_ids: Optional[np.ndarray] = None,
+        ann: Optional[str] = None,
+        nprobe: int = 16,
+        nlist: Optional[int] = None,
+        exact_search_threshold: int = 20000,
+        ivf: Optional[IVFIndex] = None,
+        quantization: Optional[str] = None,
+        rerank_factor: int = 4,
+        codes: Optional[np.ndarray] = None,
+        quantizer: Optional[ScalarQuantizer] = None,
+        embeddings_file: Optional[io.RawIOBase] = None,
+        **kwargs: Any,
+    ) -> None:
+        if ann not in (None, "ivf"):
+            raise ValueError(f"Unknown approximate search method: {ann}")
+        if quantization not in (None, *ScalarQuantizer.KINDS):
+            raise ValueError(f"Unknown quantization: {quantization}")
+
+        self._embeddings = embeddings
+        self._norms = norms
+        self._ids = ids if ids is not None else np.empty(0, dtype=np.str_)
+        self._ref_doc_ids = ref_doc_ids if ref_doc_ids is not None else np.empty(0, dtype=np.str_)
+
+        # nodes added since the last materialization, merged into the arrays on first use
+        self._pending_embeddings: List[np.ndarray] = []
+        self._pending_ids: List[str] = []
+        self._pending_ref_doc_ids: List[str] = []
+
+        # rows deleted since the last compaction, dropped from the arrays at once on first use
+        self._deleted: Optional[np.ndarray] = None
+
+        self._id_to_row: Optional[Dict[str, int]] = None
+        self._ref_doc_to_rows: Optional[Dict[str, List[int]]] = None
+
+        self.ann = ann
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self.exact_search_threshold = exact_search_threshold
+        self._ivf = ivf
+        self.quantization = quantization
+        self.rerank_factor = max(1, rerank_factor)
+        self._quantizer = quantizer
+        self._codes = codes
+        # the persisted file behind a memory-mapped `embeddings`, the candidates are read from it
+        self._embeddings_file = embeddings_file
+
+    @staticmethod
+    def _file_paths(persist_path: str) -> Dict[str, str]:
+        stem = os.path.splitext(persist_path)[0]
+        return {
+            "embeddings": f"{stem}.npy",
+            "norms": f"{stem}_norms.npy",
+            "ids": f"{stem}_ids.npy",
+            "ref_doc_ids": f"{stem}_ref_doc_ids.npy",
+            "ivf": f"{stem}_ivf.npz",
+            "codes": f"{stem}_codes.npy",
+            "quantizer": f"{stem}_quantizer.npz",
+        }
+
+    @staticmethod
+    def fingerprint(ids: np.ndarray, block_size: int = 65536) -> str:
+        """
+        Returns a hash of the node ids and their number. The IVF index and the quantizer are persisted with the
+        fingerprint of the rows they were built for, so files left over from other vectors are never attached to
+        these.
+        """
+        digest = hashlib.sha256(f"{len(ids)}:{ids.dtype.str}\n".encode("utf-8"))
+        for start in range(0, len(ids), block_size):
+            digest.update(np.ascontiguousarray(ids[start:start + block_size]).tobytes())
+        return digest.hexdigest()[:32]
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str = DEFAULT_PERSIST_DIR, **kwargs: Any) -> "NumpyVectorStore":
+        """Load from persist dir."""
+        return cls.from_persist_path(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME), **kwargs)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, **kwargs: Any) -> "NumpyVectorStore":
+        """
+        Opens a persisted store. The arrays are memory-mapped read-only, nothing is copied into memory.
+
+        Args:
+            persist_path (str): The vector store path inside the persist directory.
+            **kwargs: Search options passed to the constructor, e.g. `ann`, `nprobe` and `quantization`.
+        """
+        paths = cls._file_paths(persist_path)
+        if not os.path.exists(paths["embeddings"]):
+            raise ValueError(f"No existing {__name__} found at {paths['embeddings']}, skipping load.")
+
+        logger.debug(f"Loading {__name__} from {paths['embeddings']}.")
+        ids = np.load(paths["ids"], mmap_mode="r")
+        # the IVF index and the codes must have been persisted together with these ids
+        fingerprint = cls.fingerprint(ids) if kwargs.get("ann") or kwargs.get("quantization") else None
+
+        ivf = None
+        if kwargs.get("ann") == "ivf" and os.path.exists(paths["ivf"]):
+            ivf = IVFIndex.from_path(paths["ivf"])
+            if ivf.fingerprint != fingerprint or len(ivf.assignments) != len(ids):
+                logger.warning("IVF index does not match the vectors, it will be retrained on the next persist.")
+                ivf = None
+
+        codes, quantizer = None, None
+        quantization = kwargs.get("quantization")
+        if quantization is not None and os.path.exists(paths["quantizer"]) and os.path.exists(paths["codes"]):
+            quantizer = ScalarQuantizer.from_path(paths["quantizer"])
+            codes = np.load(paths["codes"], mmap_mode="r")
+            if quantizer.kind != quantization or quantizer.fingerprint != fingerprint or len(codes) != len(ids):
+                codes, quantizer = None, None
+        if quantization is not None and quantizer is None:
+            logger.warning(f"No {quantization} codes match the vectors, the store is searched at full precision "
+                           f"until the next persist.")
+
+        embeddings = np.load(paths["embeddings"], mmap_mode="r")
+        embeddings_file = None
+        if quantizer is not None and hasattr(os, "pread"):
+            # opened with the mapping, so the candidates are read from the same snapshot after a persist replaces it
+            embeddings_file = open(paths["embeddings"], "rb", buffering=0)
+
+        return cls(
+            embeddings=embeddings,
+            embeddings_file=embeddings_file,
+            norms=np.load(paths["norms"], mmap_mode="r"),
+            ids=ids,
+            ref_doc_ids=np.load(paths["ref_doc_ids"], mmap_mode="r"),
+            ivf=ivf,
+            codes=codes,
+            quantizer=quantizer,
+            **kwargs,
+        )
+
+    @property
+    def client(self) -> None:
+        """Get client."""
+        return
+
+    @property
+    def is_quantized(self) -> bool:
+        """
+        Whether queries scan quantized codes. With `quantization` set, this is False until the store is persisted.
+        """
+        return self._codes is not None
+
+    def close(self):
+        """
+        Closes the file the re-scored rows of a loaded quantized store are read from. The store stays usable, the
+        rows are then read through the memory map.
+        """
+        if self._embeddings_file is not None:
+            self._embeddings_file.close()
+            self._embeddings_file = None
+
+    def _materialize(self):
+        """
+        Drops the deleted rows and merges the pending nodes into the arrays. Adding and deleting in batches and
+        updating the arrays once keeps index builds and updates linear.
+        """
+        if self._deleted is not None:
+            self._compact()
+        if not self._pending_ids:
+            return
+
+        new_embeddings = np.vstack(self._pending_embeddings).astype(np.float32, copy=False)
+        new_norms = np.linalg.norm(new_embeddings, axis=1).astype(np.float32)
+
+        # the rows no longer match the file
+        self.close()
+        if self._embeddings is None or len(self._embeddings) == 0:
+            self._embeddings = new_embeddings
+            self._norms = new_norms
+        else:
+            self._embeddings = np.concatenate([self._embeddings, new_embeddings])
+            self._norms = np.concatenate([self._norms, new_norms])
+        self._ids = np.concatenate([self._ids, np.array(self._pending_ids, dtype=np.str_)])
+        self._ref_doc_ids = np.concatenate([self._ref_doc_ids, np.array(self._pending_ref_doc_ids, dtype=np.str_)])
+        if self._ivf is not None:
+            self._ivf.add(new_embeddings, new_norms)
+        if self._quantizer is not None:
+            self._codes = np.concatenate([self._codes, self._quantizer.encode(new_embeddings, new_norms)])
+
+        self._pending_embeddings = []
+        self._pending_ids = []
+        self._pending_ref_doc_ids = []
+        self._id_to_row = None
+        self._ref_doc_to_rows = None
+
+    def _compact(self):
+        """
+        Drops the rows marked by `delete` from every array with one copy.
+        """
+        keep = ~self._deleted
+        self._deleted = None
+
+        # the rows no longer match the file
+        self.close()
+        self._embeddings = self._embeddings[keep]
+        self._norms = self._norms[keep]
+        self._ids = self._ids[keep]
+        self._ref_doc_ids = self._ref_doc_ids[keep]
+        if self._ivf is not None:
+            self._ivf.keep(keep)
+        if self._codes is not None:
+            self._codes = self._codes[keep]
+        self._id_to_row = None
+        self._ref_doc_to_rows = None
+
+    def _row(self, text_id: str) -> Optional[int]:
+        if self._id_to_row is None:
+            self._id_to_row = {text_id: row for row, text_id in enumerate(self._ids.tolist())}
+        return self._id_to_row.get(text_id)
+
+    def get(self, text_id: str) -> List[float]:
+        """Get embedding."""
+        self._materialize()
+        row = self._row(text_id)
+        if row is None:
+            raise KeyError(text_id)
+        return self._embeddings[row].tolist()
+
+    def add(self, nodes: List[BaseNode]) -> List[str]:
+        """Add nodes to index."""
+        if not nodes:
+            return []
+
+        self._pending_embeddings.append(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        self._pending_ids.extend(node.node_id for node in nodes)
+        self._pending_ref_doc_ids.extend(node.ref_doc_id or "None" for node in nodes)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Delete nodes using with ref_doc_id.
+
+        The rows are only marked, the arrays are compacted once on the next query, lookup or persist, so deleting
+        many documents costs one copy of the store rather than one per document.
+
+        Args:
+            ref_doc_id (str): The doc_id of the document to delete.
+        """
+        if self._pending_ids:
+            # the pending nodes may belong to the document as well
+            self._materialize()
+        if self._ref_doc_to_rows is None:
+            self._ref_doc_to_rows = {}
+            for row, row_ref_doc_id in enumerate(self._ref_doc_ids.tolist()):
+                self._ref_doc_to_rows.setdefault(row_ref_doc_id, []).append(row)
+
+        rows = self._ref_doc_to_rows.pop(ref_doc_id, None)
+        if not rows:
+            return
+        if self._deleted is None:
+            self._deleted = np.zeros(len(self._ids), dtype=bool)
+        self._deleted[rows] = True
+
+    def similarities(self, query_embedding: List[float], rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Returns the cosine similarity of the query with every stored vector, or with the given rows only.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = max(float(np.linalg.norm(query)), 1e-12)
+
+        if rows is None:
+            embeddings, norms = self._embeddings, self._norms
+        else:
+            embeddings, norms = self._read_rows(rows), self._norms[rows]
+        return (embeddings @ query) / (np.maximum(norms, 1e-12) * query_norm)
+
+    def _read_rows(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the embeddings of the given rows. Without codes, or once the store changed in memory, they are taken
+        from the array. A quantized store reads the few re-scored rows from the file instead, since faulting in a
+        page of the memory map can map a whole cached folio around it into the process.
+        """
+        if self._embeddings_file is None or self._codes is None:
+            return self._embeddings[rows]
+
+        dim = self._embeddings.shape[1]
+        row_bytes = dim * self._embeddings.itemsize
+        result = np.empty((len(rows), dim), dtype=np.float32)
+        buffer = result.view(np.uint8).reshape(len(rows), row_bytes)
+        fd = self._embeddings_file.fileno()
+        for i, row in enumerate(rows.tolist()):
+            buffer[i] = np.frombuffer(os.pread(fd, row_bytes, self._embeddings.offset + row * row_bytes), np.uint8)
+        return result
+
+    @staticmethod
+    def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Returns the positions of the `k` highest scores, best first, in O(n + k log k).
+        """
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Get nodes for response."""
+        if query.filters is not None:
+            raise ValueError("Metadata filters not implemented for NumpyVectorStore yet.")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+
+        self._materialize()
+        if len(self._ids) == 0:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        query_embedding = query_embedding / max(float(np.linalg.norm(query_embedding)), 1e-12)
+
+        rows = None
+        if query.node_ids is not None:
+            rows = np.array([row for row in map(self._row, query.node_ids) if row is not None], dtype=np.int64)
+        elif self._ivf is not None and len(self._ids) >= self.exact_search_threshold:
+            rows = self._ivf.candidates(query_embedding, kwargs.get("nprobe", self.nprobe))
+            # the probed clusters may be too small to fill the top k, search exactly then
+            if len(rows) < query.similarity_top_k:
+                rows = None
+
+        if self._codes is not None:
+            # rank by the codes, then read the float32 vectors of the best candidates only, in file order
+            approximate = self._quantizer.similarities(self._codes, query_embedding, rows)
+            rerank_factor = kwargs.get("rerank_factor", self.rerank_factor)
+            candidates = self.top_k(approximate, query.similarity_top_k * rerank_factor)
+            rows = np.sort(candidates if rows is None else rows[candidates])
+
+        scores = self.similarities(query.query_embedding, rows)
+        top = self.top_k(scores, query.similarity_top_k)
+        top_rows = top if rows is None else rows[top]
+
+        return VectorStoreQueryResult(
+            similarities=scores[top].tolist(),
+            ids=self._ids[top_rows].tolist(),
+        )
+
+    def persist(
+        self,
+        persist_path: str = os.path.join(DEFAULT_PERSIST_DIR, DEFAULT_PERSIST_FNAME),
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> None:
+        """
+        Persist the arrays next to `persist_path`. Every file is written to a temporary name and moved into place,
+        so processes that have the previous version memory-mapped keep reading a consistent snapshot.
+        """
+        if fs is not None:
+            raise ValueError("NumpyVectorStore only persists to the local filesystem.")
+
+        self._materialize()
+        os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+        paths = self._file_paths(persist_path)
+
+        self._refresh_ivf()
+        ivf_path = paths.pop("ivf")
+        if self._ivf is not None:
+            self._ivf.fingerprint = self.fingerprint(self._ids)
+            self._ivf.persist(ivf_path)
+        elif os.path.exists(ivf_path):
+            # the assignments belong to the vectors of an earlier persist
+            os.remove(ivf_path)
+
+        self._refresh_quantizer()
+        quantizer_path = paths.pop("quantizer")
+        if self._quantizer is None:
+            # the codes of an earlier persist belong to other vectors
+            for path in (paths.pop("codes"), quantizer_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        embeddings = self._embeddings if self._embeddings is not None else np.empty((0, 0), dtype=np.float32)
+        norms = self._norms if self._norms is not None else np.empty(0, dtype=np.float32)
+        arrays = {
+            "embeddings": embeddings,
+            "norms": norms,
+            "ids": self._ids,
+            "ref_doc_ids": self._ref_doc_ids,
+            "codes": self._codes,
+        }
+        for name, path in paths.items():
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(arrays[name]))
+            os.replace(tmp_path, path)
+        if self._quantizer is not None:
+            # written last, a load only attaches codes whose quantizer carries the fingerprint of these ids
+            self._quantizer.fingerprint = self.fingerprint(self._ids)
+            self._quantizer.persist(quantizer_path)
+
+    def _refresh_ivf(self):
+        """
+        (Re)trains the IVF index when approximate search is enabled and the store is large enough, or when the
+        store has more than doubled since the centroids were trained.
+        """
+        num_vectors = len(self._ids)
+        if self.ann != "ivf" or num_vectors < self.exact_search_threshold:
+            self._ivf = None
+            return
+        if self._ivf is None or num_vectors > 2 * self._ivf.trained_size:
+            self._ivf = IVFIndex.train(self._embeddings, self._norms, nlist=self.nlist)
+
+    def _refresh_quantizer(self):
+        """
+        (Re)trains the quantizer and re-encodes every vector when quantization is enabled and the codes are
+        missing, of another kind, or the store has more than doubled since the quantizer was trained.
+        """
+        num_vectors = len(self._ids)
+        if self.quantization is None or num_vectors == 0:
+            self._quantizer, self._codes = None, None
+            return
+        if (self._quantizer is None or self._quantizer.kind != self.quantization
+                or num_vectors > 2 * self._quantizer.trained_size):
+            logger.info(f"Encoding {num_vectors} vectors as {self.quantization} codes...")
+            self._quantizer = ScalarQuantizer.train(self.quantization, self._embeddings, self._norms)
+            self._codes = self._quantizer.encode(self._embeddings, self._norms)
@@ -0,0 +1,157 @@
+import os
+import time
+import uuid
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from tqdm import tqdm
+from llama_index import SimpleDirectoryReader
+from llama_index.node_parser import NodeParser, SimpleNodeParser
+from llama_index.schema import BaseNode, NodeRelationship
+from llama_index.text_splitter import TokenTextSplitter
+
+from quantgptlib.markdown_chunker import MarkdownDocumentReader, MarkdownSectionNodeParser
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# (file path, nodes of the file, seconds spent reading and splitting it)
+FileNodes = Tuple[str, List[BaseNode], float]
+
+
+def create_node_parser(chunk_size: int = 1024) -> NodeParser:
+    """
+    Creates the node parser of the source files, which chunks them along their markdown sections. It is a module
+    level function so worker processes can build the same parser, use `functools.partial` to set the chunk size.
+    """
+    return MarkdownSectionNodeParser(chunk_size=chunk_size)
+
+
+def create_token_node_parser(chunk_size: int = 1024) -> NodeParser:
+    """
+    Creates the previous node parser, which splits the files by token count at "## " headings.
+    """
+    text_splitter = TokenTextSplitter(
+        separator="\n## ", chunk_size=chunk_size, chunk_overlap=0)
+
+    return SimpleNodeParser.from_defaults(
+        text_splitter=text_splitter,
+    )
+
+
+# the node parser factories selectable by name, e.g. by the `chunker` option of the storage classes
+NODE_PARSER_FACTORIES = {
+    "markdown": create_node_parser,
+    "token": create_token_node_parser,
+}
+
+
+def assign_stable_ids(nodes: Sequence[BaseNode]) -> Sequence[BaseNode]:
+    """
+    Replaces the random node ids with ids derived from the document id and the position of the node in its
+    document, so parsing the same file twice, in any process, yields the same ids. Previous/next relationships
+    are rewritten to the new ids.
+    """
+    new_ids = {}
+    positions = {}
+    for node in nodes:
+        position = positions.get(node.ref_doc_id, 0)
+        positions[node.ref_doc_id] = position + 1
+        new_ids[node.node_id] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{node.ref_doc_id}#{position}"))
+
+    for node in nodes:
+        node.id_ = new_ids[node.node_id]
+        for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+            related = node.relationships.get(relationship)
+            if related is not None and related.node_id in new_ids:
+                related.node_id = new_ids[related.node_id]
+    return nodes
+
+
+def parse_file(path: str, node_parser_factory: Callable[[], NodeParser] = create_node_parser) -> FileNodes:
+    """
+    Reads one source file and splits it into nodes with stable ids.
+    """
+    started = time.perf_counter()
+    node_parser = node_parser_factory()
+    # the section parser needs the whole file, MarkdownReader would split it at every heading
+    file_extractor = {".md": MarkdownDocumentReader()} if isinstance(node_parser, MarkdownSectionNodeParser) else None
+    documents = SimpleDirectoryReader(
+        input_files=[path], filename_as_id=True, file_extractor=file_extractor).load_data()
+    nodes = node_parser.get_nodes_from_documents(documents)
+    assign_stable_ids(nodes)
+    return path, nodes, time.perf_counter() - started
+
+
+def _parse_files(paths: List[str], node_parser_factory: Callable[[], NodeParser]) -> List[FileNodes]:
+    # one parser per batch of files, building it costs more than splitting a small file
+    node_parser = node_parser_factory()
+    return [parse_file(path, lambda: node_parser) for path in paths]
+
+
+def iter_file_nodes(paths: Sequence[str], workers: int = 1,
+                    node_parser_factory: Callable[[], NodeParser] = create_node_parser,
+                    batch_size: int = 8) -> Iterator[FileNodes]:
+    """
+    Reads and splits the files, in a pool of `workers` processes if `workers` is above 1, and yields the nodes of
+    every file in the order of `paths` as soon as they are ready.
+
+    The pool uses the "spawn" start method: the app loads the index from a background thread, and forking a
+    process with running threads can deadlock the child. Spawned workers re-import the main module of the program
+    (as `__mp_main__`), so that module must be safe to import: whatever it runs at import time, such as starting
+    an index build or binding a port, runs again in every worker. Keep that setup behind an
+    `if __name__ == "__main__":` guard, or parse with `workers=1`.
+
+    Args:
+        paths (Sequence[str]): The files to parse.
+        workers (int): The number of worker processes, 1 parses in the calling process.
+        node_parser_factory (Callable[[], NodeParser]): Creates the node parser, must be picklable (a module level
+            function) when workers are used.
+        batch_size (int): The number of files sent to a worker at once.
+    """
+    if workers <= 1 or len(paths) <= 1:
+        node_parser = node_parser_factory()
+        for path in paths:
+            yield parse_file(path, lambda: node_parser)
+        return
+
+    batches = [list(paths[i:i + batch_size]) for i in range(0, len(paths), batch_size)]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        # map keeps the input order, results are yielded while later batches are still being parsed
+        for results in executor.map(_parse_files, batches, [node_parser_factory] * len(batches)):
+            yield from results
+
+
+def load_nodes(paths: Sequence[str], workers: int = 1,
+               node_parser_factory: Callable[[], NodeParser] = create_node_parser,
+               progress_callback: Optional[Callable[[int, int], None]] = None) -> List[BaseNode]:
+    """
+    Parses the files with `iter_file_nodes` and returns all nodes in a deterministic order: the files sorted by
+    path, the nodes of a file in document order. Shows a progress bar and logs the slowest files.
+    """
+    paths = sorted(paths)
+    started = time.perf_counter()
+    nodes: List[BaseNode] = []
+    timings: List[Tuple[float, str]] = []
+
+    progress = tqdm(total=len(paths), desc=f"Parsing documents ({workers} workers)")
+    try:
+        for path, file_nodes, seconds in iter_file_nodes(paths, workers, node_parser_factory):
+            nodes.extend(file_nodes)
+            timings.append((seconds, path))
+            logger.debug(f"Parsed {path} into {len(file_nodes)} nodes in {seconds * 1000:.0f}ms.")
+            progress.update(1)
+            if progress_callback is not None:
+                progress_callback(len(timings), len(paths))
+    finally:
+        progress.close()
+
+    elapsed = time.perf_counter() - started
+    busy = sum(seconds for seconds, _ in timings)
+    slowest = ", ".join(f"{os.path.basename(path)} {seconds:.2f}s" for seconds, path in sorted(timings)[-3:][::-1])
+    logger.info(f"Parsed {len(paths)} files into {len(nodes)} nodes in {elapsed:.1f}s "
+                f"({busy:.1f}s of parsing, {workers} workers). Slowest: {slowest or '-'}")
+    return nodes
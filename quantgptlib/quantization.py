@@ -0,0 +1,115 @@
+import os
+import logging
+from typing import Optional
+
+import numpy as np
+
+from quantgptlib.ivf_index import normalize_rows
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class ScalarQuantizer:
+    """
+    Compresses embeddings into small codes for a fast first scan of the vector store, in pure NumPy.
+
+    The rows are scaled to unit length first, so the dot product of a code with a unit-length query approximates
+    the cosine similarity. "float16" halves the size of every value. "int8" keeps one signed byte per value, with a
+    per-dimension step of max(|x|) / 127 over the trained rows, a quarter of the float32 size; values of rows added
+    later that fall outside the trained range are clipped. NumPy widens float16 much slower than int8, so "int8" is
+    also the faster one to scan.
+
+    The codes only rank candidates, the vector store scores the best of them exactly from the float32 vectors.
+
+    Attributes:
+            kind (str): "float16" or "int8".
+            scale (Optional[np.ndarray]): The (dim,) float32 step of the int8 codes, None for float16.
+            trained_size (int): The number of rows the scale was trained on.
+            fingerprint (str): Identifies the rows the codes belong to, set by the vector store when it persists the
+                quantizer and checked when it loads the codes.
+    """
+
+    KINDS = ("float16", "int8")
+
+    def __init__(self, kind: str, scale: Optional[np.ndarray] = None, trained_size: int = 0, fingerprint: str = ""):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown quantization: {kind}")
+        if kind == "int8" and scale is None:
+            raise ValueError("int8 quantization needs a trained scale.")
+        self.kind = kind
+        self.scale = scale
+        self.trained_size = trained_size
+        self.fingerprint = fingerprint
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(np.float16 if self.kind == "float16" else np.int8)
+
+    @classmethod
+    def train(cls, kind: str, embeddings: np.ndarray, norms: Optional[np.ndarray] = None,
+              block_size: int = 65536) -> "ScalarQuantizer":
+        """
+        Fits the quantizer to the vectors, the per-dimension range of int8 codes.
+
+        Args:
+            kind (str): "float16" or "int8".
+            embeddings (np.ndarray): The (n, dim) vectors, may be memory-mapped.
+            norms (Optional[np.ndarray]): The precomputed L2 norm of every vector.
+            block_size (int): The number of rows normalized at once.
+        """
+        if kind != "int8":
+            return cls(kind, trained_size=len(embeddings))
+
+        max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+        for start in range(0, len(embeddings), block_size):
+            block_norms = norms[start:start + block_size] if norms is not None else None
+            block = normalize_rows(embeddings[start:start + block_size], block_norms)
+            np.maximum(max_abs, np.abs(block).max(axis=0), out=max_abs)
+        return cls(kind, scale=np.maximum(max_abs, 1e-12) / 127.0, trained_size=len(embeddings))
+
+    def encode(self, embeddings: np.ndarray, norms: Optional[np.ndarray] = None,
+               block_size: int = 65536) -> np.ndarray:
+        """
+        Returns the codes of the vectors, one row per vector.
+        """
+        codes = np.empty(embeddings.shape, dtype=self.dtype)
+        for start in range(0, len(embeddings), block_size):
+            block_norms = norms[start:start + block_size] if norms is not None else None
+            block = normalize_rows(embeddings[start:start + block_size], block_norms)
+            if self.kind == "int8":
+                block = np.clip(np.rint(block / self.scale), -127, 127)
+            codes[start:start + block_size] = block
+        return codes
+
+    def similarities(self, codes: np.ndarray, query: np.ndarray, rows: Optional[np.ndarray] = None,
+                     block_size: int = 1024) -> np.ndarray:
+        """
+        Returns the approximate cosine similarity of the unit-length query with every code, or with the given rows
+        only. The codes are widened to float32 a block at a time, so no float32 copy of the whole matrix is made.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        if self.kind == "int8":
+            # code * scale approximates the vector, the step is folded into the query once
+            query = query * self.scale
+
+        num_rows = len(codes) if rows is None else len(rows)
+        scores = np.empty(num_rows, dtype=np.float32)
+        for start in range(0, num_rows, block_size):
+            block = codes[start:start + block_size] if rows is None else codes[rows[start:start + block_size]]
+            scores[start:start + block_size] = block.astype(np.float32) @ query
+        return scores
+
+    def persist(self, path: str):
+        tmp_path = f"{path}.tmp"
+        scale = self.scale if self.scale is not None else np.empty(0, dtype=np.float32)
+        with open(tmp_path, "wb") as f:
+            np.savez(f, kind=self.kind, scale=scale, trained_size=self.trained_size, fingerprint=self.fingerprint)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_path(cls, path: str) -> "ScalarQuantizer":
+        with np.load(path) as data:
+            kind = str(data["kind"])
+            fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else ""
+            return cls(kind, data["scale"] if kind == "int8" else None, int(data["trained_size"]), fingerprint)
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+
+from quantgptlib.async_utils import retry_async
+from quantgptlib.embedding_pipeline import EmbedFn, EmbeddingCache
+from quantgptlib.index_manifest import hash_text
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Returns the query in the form it is cached and embedded in: NFKC-normalized, with runs of whitespace collapsed
+    and no leading or trailing whitespace. Case is kept, API names are case-sensitive.
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+
+def query_batch_fn(embed_model: BaseEmbedding) -> EmbedFn:
+    """
+    Returns a function that embeds several queries at once. Models that embed queries like documents, such as
+    OpenAI's ada-002, get them in one batch request; other models get one request per query, sent concurrently.
+    """
+    query_engine = getattr(embed_model, "_query_engine", None)
+    if query_engine is not None and query_engine == getattr(embed_model, "_text_engine", None):
+        return embed_model._aget_text_embeddings
+
+    async def embed_each(queries: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*(embed_model._aget_query_embedding(query) for query in queries)))
+
+    return embed_each
+
+
+class CachedQueryEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model with an LRU cache of query embeddings, so a question asked again, in any chat
+    session, is not sent to the embedding API. Queries are normalized (see `normalize_query`) before they are
+    looked up and embedded. Misses are also looked up in the persistent `EmbeddingCache`, if one is given, under the
+    model name with a ":query" suffix.
+
+    Concurrent async misses are combined: the first one waits `batch_window` seconds for others to arrive, then
+    all of them are looked up in the persistent cache with one query and the rest are embedded in a single request,
+    and a query that is already being embedded waits for that request instead of sending its own. The persistent
+    cache is read and written in a worker thread, so the event loop never waits for the disk. The synchronous
+    methods look up and embed a miss on their own.
+
+    Document embeddings are passed through to the wrapped model untouched.
+
+    Attributes:
+            max_entries (int): The number of query embeddings kept in memory.
+            batch_window (float): How long the first miss waits for more queries before the request is sent.
+            max_batch_size (int): The most queries in one request, a full batch is sent right away.
+            max_retries (int): How many times a rate-limited request is repeated, a user is waiting for it.
+            lookup_callback (Optional[Callable[[str], None]]): Called with "hit", "miss" or "coalesced" (a miss
+                already being embedded) on every lookup, e.g. to count them in the metrics.
+    """
+
+    max_entries: int = Field(default=1024, description="The number of query embeddings kept in memory.")
+    batch_window: float = Field(default=0.01, description="Seconds a miss waits for concurrent misses.")
+    max_batch_size: int = Field(default=64, description="The most queries embedded in one request.")
+    max_retries: int = Field(default=2, description="Retries of a rate-limited request.")
+    lookup_callback: Optional[Callable[[str], None]] = Field(default=None, exclude=True)
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _embed_queries: EmbedFn = PrivateAttr()
+    _cache: Optional[EmbeddingCache] = PrivateAttr()
+    _entries: "OrderedDict[str, Embedding]" = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    # per event loop, the misses waiting for the next request: normalized query -> future of its embedding
+    _pending: Dict[asyncio.AbstractEventLoop, Dict[str, asyncio.Future]] = PrivateAttr()
+    _tasks: Set[asyncio.Task] = PrivateAttr()
+    _stats: Dict[str, int] = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: Optional[EmbeddingCache] = None, **kwargs: Any):
+        kwargs.setdefault("model_name", embed_model.model_name)
+        kwargs.setdefault("embed_batch_size", embed_model.embed_batch_size)
+        super().__init__(**kwargs)
+        self._embed_model = embed_model
+        self._embed_queries = query_batch_fn(embed_model)
+        self._cache = cache
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._tasks = set()
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "requests": 0}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedQueryEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model
+
+    @property
+    def cache_model_name(self) -> str:
+        # some models embed queries and documents differently, they are cached apart
+        return f"{self.model_name}:query"
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _report(self, result: str):
+        with self._lock:
+            self._stats[{"hit": "hits", "miss": "misses"}.get(result, result)] += 1
+        if self.lookup_callback is not None:
+            self.lookup_callback(result)
+
+    def _lookup(self, key: str, persistent: bool = True) -> Optional[Embedding]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                return embedding
+        if persistent and self._cache is not None:
+            text_hash = hash_text(key)
+            embedding = self._cache.get_many(self.cache_model_name, [text_hash]).get(text_hash)
+            if embedding is not None:
+                self._remember([(key, embedding)], persist=False)
+        return embedding
+
+    def _remember(self, items: List[Tuple[str, Embedding]], persist: bool = True):
+        with self._lock:
+            for key, embedding in items:
+                self._entries[key] = embedding
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if persist:
+            self._persist(items)
+
+    def _persist(self, items: List[Tuple[str, Embedding]]):
+        if self._cache is not None:
+            self._cache.put_many(self.cache_model_name, [(hash_text(key), embedding) for key, embedding in items])
+
+    def _cached(self, keys: List[str]) -> Dict[str, Embedding]:
+        """
+        Returns the embeddings of the given queries that are in the persistent cache.
+        """
+        if self._cache is None:
+            return {}
+        hashes = {key: hash_text(key) for key in keys}
+        found = self._cache.get_many(self.cache_model_name, list(hashes.values()))
+        return {key: found[text_hash] for key, text_hash in hashes.items() if text_hash in found}
+
+    def get_query_embedding(self, query: str) -> Embedding:
+        # only requests raise an embedding event, the metrics count the tokens sent to the API
+        key = normalize_query(query)
+        embedding = self._lookup(key)
+        if embedding is not None:
+            self._report("hit")
+            return embedding
+
+        self._report("miss")
+        with self.callback_manager.event(CBEventType.EMBEDDING) as event:
+            embedding = self._embed_model._get_query_embedding(key)
+            event.on_end(payload={EventPayload.CHUNKS: [key], EventPayload.EMBEDDINGS: [embedding]})
+        with self._lock:
+            self._stats["requests"] += 1
+        self._remember([(key, embedding)])
+        return embedding
+
+    async def aget_query_embedding(self, query: str) -> Embedding:
+        key = normalize_query(query)
+        # only the memory is looked up here, the persistent cache is read with the batch of misses
+        embedding = self._lookup(key, persistent=False)
+        if embedding is not None:
+            self._report("hit")
+            return embedding
+
+        loop = asyncio.get_running_loop()
+        pending = self._pending.setdefault(loop, {})
+        future = pending.get(key)
+        if future is not None:
+            self._report("coalesced")
+        else:
+            # reported as a hit or a miss once the batch was looked up in the persistent cache
+            future = pending[key] = loop.create_future()
+            if len(pending) >= self.max_batch_size:
+                self._flush(loop)
+            elif len(pending) == 1:
+                loop.call_later(self.batch_window, self._flush, loop)
+        # a cancelled chat must not cancel the request of the other queries waiting for it
+        return await asyncio.shield(future)
+
+    def _flush(self, loop: asyncio.AbstractEventLoop):
+        batch = self._pending.pop(loop, None)
+        if batch:
+            task = loop.create_task(self._embed_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch: Dict[str, asyncio.Future]):
+        try:
+            cached = await asyncio.to_thread(self._cached, list(batch))
+            keys = [key for key in batch if key not in cached]
+            for key in batch:
+                self._report("hit" if key in cached else "miss")
+
+            embeddings = []
+            if keys:
+                with self.callback_manager.event(CBEventType.EMBEDDING) as event:
+                    embeddings = await retry_async(lambda: self._embed_queries(keys), max_retries=self.max_retries)
+                    event.on_end(payload={EventPayload.CHUNKS: keys, EventPayload.EMBEDDINGS: embeddings})
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        embedded = list(zip(keys, embeddings))
+        if keys:
+            with self._lock:
+                self._stats["requests"] += 1
+            if len(keys) > 1:
+                logger.debug(f"Embedded {len(keys)} concurrent queries in one request.")
+        self._remember(list(cached.items()) + embedded, persist=False)
+        results = {**cached, **dict(embedded)}
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results[key])
+        if embedded:
+            try:
+                await asyncio.to_thread(self._persist, embedded)
+            except Exception:
+                logger.exception("Query embeddings could not be saved to the persistent cache.")
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self.aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed_model._get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return await self._embed_model._aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._embed_model._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._embed_model._aget_text_embeddings(texts)
@@ -0,0 +1,253 @@
+import sys
+import time
+import asyncio
+import types
+import logging
+import threading
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence
+
+from llama_index.callbacks.base import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.query_engine.retriever_query_engine import RetrieverQueryEngine
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.schema import NodeWithScore
+
+from quantgptlib.llm_scheduler import FairLLMScheduler
+from quantgptlib.streaming_synthesizer import AsyncTreeSummarizer
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# the callback handler of the chat session the current thread or task is serving
+_session_handler: ContextVar[Optional[BaseCallbackHandler]] = ContextVar("session_handler", default=None)
+
+
+class SessionCallbackRouter(BaseCallbackHandler):
+    """
+    The only callback handler of the shared query engine. It forwards every event to the handler of the session
+    that is running the query, which `SessionQueryEngine` sets in a context variable for the duration of the call.
+    Events raised outside of a session query are dropped.
+    """
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                       event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        handler = _session_handler.get()
+        if handler is not None and event_type not in handler.event_starts_to_ignore:
+            handler.on_event_start(event_type, payload, event_id=event_id, parent_id=parent_id, **kwargs)
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                     event_id: str = "", **kwargs: Any) -> None:
+        handler = _session_handler.get()
+        if handler is not None and event_type not in handler.event_ends_to_ignore:
+            handler.on_event_end(event_type, payload, event_id=event_id, **kwargs)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        handler = _session_handler.get()
+        if handler is not None:
+            handler.start_trace(trace_id)
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        handler = _session_handler.get()
+        if handler is not None:
+            handler.end_trace(trace_id, trace_map)
+
+
+_NOT_COUNTED = (type, types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType)
+
+
+def approx_size(obj: Any, exclude: Optional[set] = None, max_objects: int = 100000) -> int:
+    """
+    Returns an estimate of the bytes held by `obj` and everything it references, skipping the objects in
+    `exclude` (by id) and everything only reachable through them. Modules, classes and functions are not counted.
+    """
+    seen = set(exclude or ())
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < max_objects:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, _NOT_COUNTED):
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current, 0)
+
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        if hasattr(current, "__dict__"):
+            stack.append(vars(current))
+        for slot in getattr(type(current), "__slots__", ()):
+            if isinstance(slot, str) and hasattr(current, slot):
+                stack.append(getattr(current, slot))
+    return total
+
+
+class SessionQueryEngine:
+    """
+    The lightweight query engine of one chat session. It holds nothing but the session's callback handler and
+    runs queries on the shared engine with that handler active.
+
+    Attributes:
+            engine (RetrieverQueryEngine): The shared query engine.
+            callback_handler (Optional[BaseCallbackHandler]): The handler that receives the events of this session.
+            summarizer (Optional[AsyncTreeSummarizer]): The shared summarizer of the streaming path.
+    """
+
+    def __init__(self, engine: RetrieverQueryEngine, callback_handler: Optional[BaseCallbackHandler] = None,
+                 summarizer: Optional[AsyncTreeSummarizer] = None):
+        self.engine = engine
+        self.callback_handler = callback_handler
+        self.summarizer = summarizer or AsyncTreeSummarizer.from_query_engine(engine)
+
+    @contextmanager
+    def activate(self) -> Iterator[None]:
+        """
+        Routes the callback events of the current thread or task to this session while the block runs.
+        """
+        token = _session_handler.set(self.callback_handler)
+        try:
+            yield
+        finally:
+            # worker threads are reused, the handler must not leak into the next session's query
+            try:
+                _session_handler.reset(token)
+            except ValueError:
+                # an abandoned stream is finalized outside of the context it was started in
+                pass
+
+    def query(self, query: Any):
+        with self.activate():
+            return self.engine.query(query)
+
+    async def aquery(self, query: Any):
+        with self.activate():
+            return await self.engine.aquery(query)
+
+    def retrieve(self, query_bundle: QueryBundle):
+        with self.activate():
+            return self.engine.retrieve(query_bundle)
+
+    def _retrieve_nodes(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # the query engine only reports retrieval as part of a full query, retrieval and post-processing raise
+        # their own RETRIEVE and RERANKING events here, which lets the handlers time them separately
+        callback_manager = self.engine.callback_manager
+        with callback_manager.event(CBEventType.RETRIEVE,
+                                    payload={EventPayload.QUERY_STR: query_bundle.query_str}) as event:
+            nodes = self.engine.retriever.retrieve(query_bundle)
+            event.on_end(payload={EventPayload.NODES: nodes})
+        with callback_manager.event(CBEventType.RERANKING,
+                                    payload={EventPayload.QUERY_STR: query_bundle.query_str}) as event:
+            nodes = self.engine._apply_node_postprocessors(nodes, query_bundle=query_bundle)
+            event.on_end(payload={EventPayload.NODES: nodes})
+        return nodes
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """
+        Retrieves and post-processes the source nodes of a query without blocking the event loop.
+
+        The query is embedded with a native async request, if the bundle has no embedding yet. The vector search,
+        the BM25 lookup and the post-processing are CPU work and run in a worker thread, so the other sessions keep
+        streaming meanwhile; the thread gets a copy of the context, the session's events are still routed to it.
+        """
+        with self.activate():
+            if query_bundle.embedding is None and query_bundle.embedding_strs:
+                embed_model = self.summarizer.service_context.embed_model
+                query_bundle.embedding = await embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs)
+            return await asyncio.to_thread(self._retrieve_nodes, query_bundle)
+
+    async def astream_answer(self, query_str: str, nodes: Sequence[NodeWithScore]) -> AsyncIterator[str]:
+        """
+        Yields the tokens of the answer as the LLM generates them.
+        """
+        with self.activate():
+            async for token in self.summarizer.astream(query_str, nodes):
+                yield token
+
+
+class SharedQueryEngine:
+    """
+    Builds the heavyweight query engine (LLM client and its connection pool, retriever and response synthesizer)
+    once and hands out a `SessionQueryEngine` per chat session. The shared parts hold no per-query state, so any
+    number of sessions can query them concurrently. Callback events are routed to the right session by a
+    `SessionCallbackRouter`.
+
+    Attributes:
+            build_engine (Callable[[BaseCallbackHandler], RetrieverQueryEngine]): Builds the query engine with the
+                given callback handler, e.g. `storage.create_query_engine`.
+            scheduler (Optional[FairLLMScheduler]): Admits the LLM calls of all the sessions' streaming answers.
+            build_seconds (Optional[float]): How long building the shared engine took.
+            sessions_created (int): The number of session engines handed out.
+    """
+
+    def __init__(self, build_engine: Callable[[BaseCallbackHandler], RetrieverQueryEngine],
+                 scheduler: Optional[FairLLMScheduler] = None):
+        self.build_engine = build_engine
+        self.scheduler = scheduler
+        self.router = SessionCallbackRouter()
+        self.build_seconds: Optional[float] = None
+        self.sessions_created = 0
+
+        self._engine: Optional[RetrieverQueryEngine] = None
+        self._summarizer: Optional[AsyncTreeSummarizer] = None
+        self._lock = threading.Lock()
+        self._sessions: "weakref.WeakSet[SessionQueryEngine]" = weakref.WeakSet()
+        self._session_seconds = 0.0
+        self._session_bytes = 0
+
+    @property
+    def engine(self) -> RetrieverQueryEngine:
+        """
+        The shared query engine, built on first use.
+        """
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    started = time.perf_counter()
+                    self._engine = self.build_engine(self.router)
+                    self._summarizer = AsyncTreeSummarizer.from_query_engine(self._engine, scheduler=self.scheduler)
+                    self.build_seconds = time.perf_counter() - started
+                    logger.info(f"Built the shared query engine in {self.build_seconds * 1000:.0f}ms.")
+        return self._engine
+
+    def session(self, callback_handler: Optional[BaseCallbackHandler] = None) -> SessionQueryEngine:
+        """
+        Returns a query engine for one chat session.
+        """
+        engine = self.engine
+
+        started = time.perf_counter()
+        session_engine = SessionQueryEngine(engine, callback_handler, summarizer=self._summarizer)
+        seconds = time.perf_counter() - started
+
+        # the handler is counted shallowly, the Chainlit session it points to exists with or without a query engine
+        shared = {id(engine), id(self._summarizer), id(callback_handler)}
+        session_bytes = approx_size(session_engine, exclude=shared) + \
+            (sys.getsizeof(callback_handler) if callback_handler is not None else 0)
+        with self._lock:
+            self.sessions_created += 1
+            self._session_seconds += seconds
+            self._session_bytes += session_bytes
+            self._sessions.add(session_engine)
+        return session_engine
+
+    def metrics(self) -> dict:
+        """
+        Returns construction time and memory metrics of the shared engine and the session engines.
+        """
+        created = self.sessions_created
+        return {
+            "shared_engine_build_ms": round(self.build_seconds * 1000, 1) if self.build_seconds is not None else None,
+            "sessions_created": created,
+            "sessions_active": len(self._sessions),
+            "session_build_ms_avg": round(self._session_seconds / created * 1000, 3) if created else None,
+            "session_bytes_avg": self._session_bytes // created if created else None,
+        }
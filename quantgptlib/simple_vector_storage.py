@@ -1,6 +1,8 @@
 import os
 import logging
-from typing import Iterator
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable, ContextManager, Iterator, List, Optional, Tuple
 from llama_index import (
     LLMPredictor,
     StorageContext,
@@ -15,9 +17,21 @@ from llama_index.query_engine.retriever_query_engine import RetrieverQueryEngine
 from llama_index.retrievers import VectorIndexRetriever
 from llama_index.callbacks.base import CallbackManager
 from llama_index.callbacks.base import BaseCallbackHandler
-from llama_index import GPTVectorStoreIndex, SimpleDirectoryReader
-from llama_index.node_parser import SimpleNodeParser
-from llama_index.text_splitter import TokenTextSplitter
+from llama_index import GPTVectorStoreIndex
+from llama_index.vector_stores.types import VectorStore
+from llama_index.storage.docstore.types import BaseDocumentStore
+from llama_index.storage.index_store.types import BaseIndexStore
+from llama_index.embeddings import OpenAIEmbedding
+from llama_index.embeddings.base import BaseEmbedding
+
+from quantgptlib.numpy_vector_store import NumpyVectorStore
+from quantgptlib.sqlite_docstore import SQLiteDocumentStore, SQLiteIndexStore, SQLiteKVStore
+from quantgptlib.bm25_index import BM25Index, BM25Retriever, HybridRetriever
+from quantgptlib.context_packing import TokenBudgetPostprocessor
+from quantgptlib.parallel_ingestion import NODE_PARSER_FACTORIES, load_nodes
+from quantgptlib.embedding_pipeline import EmbeddingPipeline
+from quantgptlib.query_embedding import CachedQueryEmbedding
+from quantgptlib.index_manifest import IndexManifest, ManifestDiff, group_nodes_by_file, hash_file, hash_node, normalize_path
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -33,23 +47,146 @@ class QuantSimpleVectorStorage:
             gpt_model (str): The name of the GPT model to use for predictions.
             gpt_temperature (float): The temperature to use for GPT predictions.
             source_folder (str): The folder containing the markdown files to use for indexing.
+            incremental (bool): If True, a loaded index is refreshed in place with the source files that were
+                added, changed or removed since the last build.
+            vector_store_type (str): The vector store backend, "simple" for llama_index's JSON store or "numpy"
+                for the memory-mapped NumpyVectorStore.
+            docstore_type (str): Where the nodes and the index struct are kept, "simple" for llama_index's JSON
+                files loaded whole into memory, or "sqlite" for a SQLite file in WAL mode that nodes are read from
+                on demand, so several serving processes share one index with little memory each.
+            read_only (bool): If True, the storage attaches to the index persisted in `persist_dir` and never builds,
+                updates or writes it, e.g. in serving workers next to the process that maintains the index. With the
+                "numpy" vector store and the "sqlite" docstore every array is memory-mapped and the nodes are read
+                from SQLite, so the workers share one copy of the index in the page cache.
+            embed_model (Optional[BaseEmbedding]): The embedding model, defaults to OpenAIEmbedding.
+            embed_batch_size (int): The number of texts sent in one embedding request.
+            embed_concurrency (int): The maximum number of embedding requests in flight while indexing.
+            embedding_cache_path (Optional[str]): A SQLite file that caches embeddings across index builds, and
+                query embeddings across restarts.
+            query_cache_size (int): The number of query embeddings `embed_model` keeps in memory, see
+                CachedQueryEmbedding, or 0 to embed every query.
+            query_batch_window (float): How long a query embedding waits for concurrent queries to share its
+                request, in seconds.
+            ann (Optional[str]): Approximate nearest-neighbour search for the "numpy" vector store, "ivf" or None
+                for exact search. Stores below `ann_exact_search_threshold` vectors are always searched exactly.
+            ann_nprobe (int): The number of IVF clusters scanned per query, higher is slower but more accurate.
+            ann_exact_search_threshold (int): The store size from which approximate search is used.
+            quantization (Optional[str]): Compressed codes the "numpy" vector store scans first, "float16" or "int8"
+                for 2x or 4x less memory than the float32 vectors, or None to scan the vectors themselves. The best
+                `similarity_top_k * rerank_factor` candidates are scored exactly from the float32 vectors on disk.
+            rerank_factor (int): How many candidates per returned node are re-scored at full precision.
+            retriever_mode (str): "vector" for embedding search only, or "hybrid" to fuse it with a BM25 index over
+                the same nodes, which finds exact API identifiers the embeddings miss.
+            hybrid_top_k (int): The number of fused nodes passed to the response synthesizer in hybrid mode.
+            context_token_budget (Optional[int]): If set, the retrieved nodes are deduplicated, merged and trimmed
+                to at most this many tokens before synthesis, see TokenBudgetPostprocessor.
+            ingestion_workers (int): The number of processes that read and split the source files, 1 parses them
+                in the calling process and 0 uses one process per CPU core.
+            chunker (str): How the source files are split into nodes, "markdown" along their sections with the
+                heading path in the node metadata, or "token" by token count. Changing it re-parses every file on
+                the next incremental update.
+            chunk_size (int): The maximum number of tokens of a node, metadata included.
+            similarity_top_k (int): The number of nodes the vector (and BM25) retriever returns.
+            similarity_cutoff (float): Vector results below this similarity are dropped.
+            callback_handlers (List[BaseCallbackHandler]): Handlers registered in every query engine next to the
+                one passed to `create_query_engine`, e.g. a MetricsCallbackHandler.
+            lazy (bool): If True, the index is not set up in the constructor; call `setup_index` later, e.g. from
+                an IndexWarmup thread.
+            progress_callback (Optional[Callable[[str, Optional[float]], None]]): Called with a stage description
+                and an optional completion fraction while the index is loaded or built.
+            persisted (bool): Whether `setup_index` wrote anything to `persist_dir`, i.e. the index was built or
+                updated. False when a persisted index was loaded and was already up to date.
     """
 
 
 class QuantSimpleVectorStorage:
-    def __init__(self, persist_dir: str, gpt_model: str, gpt_temperature: float, source_folder: str):
+    def __init__(self, persist_dir: str, gpt_model: str, gpt_temperature: float, source_folder: str,
+                 incremental: bool = False, vector_store_type: str = "simple", lazy: bool = False,
+                 embed_model: Optional[BaseEmbedding] = None, embed_batch_size: int = 100, embed_concurrency: int = 4,
+                 embedding_cache_path: Optional[str] = None, ann: Optional[str] = None, ann_nprobe: int = 16,
+                 ann_exact_search_threshold: int = 20000, retriever_mode: str = "vector", hybrid_top_k: int = 10,
+                 context_token_budget: Optional[int] = None, ingestion_workers: int = 1, chunker: str = "markdown",
+                 chunk_size: int = 1024, similarity_top_k: int = 20, similarity_cutoff: float = 0.73,
+                 callback_handlers: Optional[List[BaseCallbackHandler]] = None, docstore_type: str = "simple",
+                 read_only: bool = False, quantization: Optional[str] = None, rerank_factor: int = 4,
+                 query_cache_size: int = 1024, query_batch_window: float = 0.01):
         # collect arguments
         self.persist_dir = persist_dir
         self.gpt_model = gpt_model
         self.gpt_temperature = gpt_temperature
         self.source_folder = source_folder
+        self.incremental = incremental
+        self.vector_store_type = vector_store_type
+        if docstore_type not in ("simple", "sqlite"):
+            raise ValueError(f"Unknown docstore type: {docstore_type}")
+        self.docstore_type = docstore_type
+        self.read_only = read_only
+        if read_only and (vector_store_type, docstore_type) != ("numpy", "sqlite"):
+            logger.warning('Only the "numpy" vector store and the "sqlite" docstore are shared between processes, '
+                           'the other stores are loaded into every process.')
+        self.embed_batch_size = embed_batch_size
+        self.ann = ann
+        self.ann_nprobe = ann_nprobe
+        self.ann_exact_search_threshold = ann_exact_search_threshold
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.retriever_mode = retriever_mode
+        self.hybrid_top_k = hybrid_top_k
+        self.context_token_budget = context_token_budget
+        self.ingestion_workers = ingestion_workers or os.cpu_count() or 1
+        if chunker not in NODE_PARSER_FACTORIES:
+            raise ValueError(f"Unknown chunker: {chunker}")
+        self.chunker = chunker
+        self.chunk_size = chunk_size
+        self.similarity_top_k = similarity_top_k
+        self.similarity_cutoff = similarity_cutoff
+        self.callback_handlers = list(callback_handlers or [])
 
         # initialize attributes
         self.index = None
+        self.manifest = None
+        self.kvstore: Optional[SQLiteKVStore] = None
+        self.bm25_index = None
+        self.persisted = False
+        self.progress_callback: Optional[Callable[[str, Optional[float]], None]] = None
         self.llm_predictor = self.create_llm_predictor()
+        self.embed_model = embed_model or self.create_embed_model()
+        self.embedding_pipeline = EmbeddingPipeline.from_embed_model(
+            self.embed_model,
+            cache_path=embedding_cache_path,
+            max_concurrency=embed_concurrency,
+            show_progress=True,
+        )
+        self.embedding_pipeline.progress_callback = \
+            lambda done, total: self.report_progress('Embedding documents', done / total)
+        if query_cache_size:
+            # the retriever and the app embed queries through the cache, documents go to the model directly
+            self.embed_model = CachedQueryEmbedding(
+                self.embed_model,
+                cache=self.embedding_pipeline.cache,
+                max_entries=query_cache_size,
+                batch_window=query_batch_window,
+            )
 
         # setup index
-        self.setup_index()
+        if not lazy:
+            self.setup_index()
+
+    @property
+    def chunker_id(self) -> str:
+        """
+        Identifies how the nodes were split, the index manifest records it.
+        """
+        return self.chunker if self.chunk_size == 1024 else f"{self.chunker}:{self.chunk_size}"
+
+    def report_progress(self, stage: str, fraction: Optional[float] = None):
+        """
+        Logs the current index setup stage and forwards it to `progress_callback`, if one is set.
+        """
+        if fraction is None:
+            logger.info(f'{stage}...')
+        if self.progress_callback is not None:
+            self.progress_callback(stage, fraction)
 
     def list_sources(self) -> Iterator[str]:
         """
@@ -85,56 +222,262 @@ class QuantSimpleVectorStorage:
             ),
         )
 
-    def load_index_nodes(self):
-        logger.info('Loading documents...')
+    def create_embed_model(self) -> BaseEmbedding:
+        """
+        Sets up and returns the OpenAI embedding model used for both indexing and queries.
+
+        Returns:
+                An instance of the OpenAIEmbedding class.
+        """
+        return OpenAIEmbedding(embed_batch_size=self.embed_batch_size)
+
+    def load_index_nodes(self, input_files: Optional[List[str]] = None):
+        """
+        Loads and splits the source files into nodes. Every document id is derived from its file name, so the
+        nodes of a file can be found and replaced when it changes. With `ingestion_workers` above 1 the files are
+        read and split in a process pool.
 
-        text_splitter = TokenTextSplitter(
-            separator="\n## ", chunk_size=1024, chunk_overlap=0)
+        Args:
+            input_files (Optional[List[str]]): The files to load. Defaults to all the files from `list_sources`.
 
-        node_parser = SimpleNodeParser.from_defaults(
-            text_splitter=text_splitter,
+        Returns:
+            The list of parsed nodes.
+        """
+        self.report_progress('Loading documents')
+
+        # the files are parsed in order with stable node ids, the result is the same for any number of workers
+        return load_nodes(
+            input_files if input_files is not None else list(self.list_sources()),
+            workers=self.ingestion_workers,
+            node_parser_factory=partial(NODE_PARSER_FACTORIES[self.chunker], chunk_size=self.chunk_size),
+            progress_callback=lambda done, total: self.report_progress('Loading documents', done / total),
         )
 
-        documents = SimpleDirectoryReader(
-            input_files=self.list_sources()).load_data()
+    def create_vector_store(self, load: bool = False) -> Optional[VectorStore]:
+        """
+        Returns the vector store selected by `vector_store_type`.
 
-        index_nodes = node_parser.get_nodes_from_documents(
-            documents, show_progress=True)
+        Args:
+            load (bool): If True, the store is opened from `persist_dir` instead of created empty.
 
-        return index_nodes
+        Returns:
+                The vector store, or None for the llama_index default store.
+        """
+        if self.vector_store_type == "simple":
+            if self.ann is not None:
+                raise ValueError("Approximate search needs the \"numpy\" vector store type.")
+            if self.quantization is not None:
+                raise ValueError("Quantization needs the \"numpy\" vector store type.")
+            return None
+        if self.vector_store_type == "numpy":
+            search_kwargs = dict(
+                ann=self.ann,
+                nprobe=self.ann_nprobe,
+                exact_search_threshold=self.ann_exact_search_threshold,
+                quantization=self.quantization,
+                rerank_factor=self.rerank_factor,
+            )
+            if load:
+                return NumpyVectorStore.from_persist_dir(self.persist_dir, **search_kwargs)
+            return NumpyVectorStore(**search_kwargs)
+        raise ValueError(f"Unknown vector store type: {self.vector_store_type}")
 
-    def create_index(self):
-        logger.info('Building index...')
+    def create_docstores(self, load: bool = False) -> Tuple[Optional[BaseDocumentStore], Optional[BaseIndexStore]]:
+        """
+        Returns the docstore and index store selected by `docstore_type`. The "sqlite" stores share one SQLite file
+        in `persist_dir`, which is kept in `kvstore`.
 
-        index = VectorStoreIndex(
-            nodes=self.load_index_nodes(),
-            show_progress=True,
-            service_context=ServiceContext.from_defaults(
-                llm_predictor=self.llm_predictor,
+        Args:
+            load (bool): If True, the stores must already exist in `persist_dir`.
+
+        Returns:
+                The docstore and index store, or None for the llama_index default stores.
+        """
+        if self.docstore_type == "simple":
+            return None, None
+        if load and not SQLiteKVStore.exists(self.persist_dir):
+            raise FileNotFoundError(f"No SQLite docstore in {self.persist_dir}")
+        self.kvstore = SQLiteKVStore.from_persist_dir(self.persist_dir, read_only=self.read_only)
+        return SQLiteDocumentStore(self.kvstore), SQLiteIndexStore(self.kvstore)
+
+    def docstore_transaction(self) -> ContextManager:
+        """
+        Groups the docstore writes of a build or an update. With the "sqlite" docstore they are committed at once,
+        and serving processes keep reading the previous nodes until then.
+        """
+        return self.kvstore.transaction() if self.kvstore is not None else nullcontext()
+
+    def create_index(self):
+        self.report_progress('Building index')
+
+        index_nodes = self.load_index_nodes()
+
+        self.report_progress('Embedding documents')
+        self.embedding_pipeline.embed_nodes(index_nodes)
+
+        docstore, index_store = self.create_docstores()
+        with self.docstore_transaction():
+            if self.kvstore is not None:
+                # a rebuild replaces whatever the file held
+                self.kvstore.clear()
+            index = VectorStoreIndex(
+                nodes=index_nodes,
+                show_progress=True,
+                service_context=ServiceContext.from_defaults(
+                    llm_predictor=self.llm_predictor,
+                    embed_model=self.embed_model,
+                ),
+                storage_context=StorageContext.from_defaults(
+                    docstore=docstore,
+                    index_store=index_store,
+                    vector_store=self.create_vector_store(),
+                ),
             )
-        )
+
+        # remember what was indexed so the next refresh only touches changed files
+        manifest = IndexManifest(chunker=self.chunker_id)
+        nodes_by_file = group_nodes_by_file(index_nodes)
+        for path in self.list_sources():
+            path = normalize_path(path)
+            manifest.record_file(path, hash_file(path), nodes_by_file.get(path, []))
+        self.manifest = manifest
 
         return index
 
+    def update_index(self) -> ManifestDiff:
+        """
+        Refreshes the loaded index in place. Only the source files that were added, changed or removed since
+        the last build are re-parsed, and only the nodes whose content actually changed are re-embedded;
+        the embeddings of unchanged nodes are reused from the vector store. The updated vector store,
+        docstore and manifest are persisted afterwards.
+
+        Returns:
+                ManifestDiff: The files that were re-indexed.
+        """
+        if not IndexManifest.exists(self.persist_dir):
+            # without a manifest there is no way to tell which files the persisted index already holds
+            logger.warning('Persisted index has no manifest, rebuild it to enable incremental updates.')
+            self.manifest = IndexManifest()
+            return ManifestDiff()
+
+        manifest = IndexManifest.from_persist_dir(self.persist_dir)
+        file_hashes = {normalize_path(path): hash_file(path) for path in self.list_sources()}
+        diff = manifest.diff(file_hashes, chunker=self.chunker_id)
+
+        if not diff.has_changes:
+            logger.info('Index is up to date.')
+            self.manifest = manifest
+            store = self.index.vector_store
+            if isinstance(store, NumpyVectorStore) and store.quantization and not store.is_quantized:
+                # quantization was just enabled, the codes are written with the store
+                self.report_progress('Saving index')
+                self.index.storage_context.persist(persist_dir=self.persist_dir)
+                self.persisted = True
+            return diff
+
+        self.report_progress(f'Updating index: {diff}')
+        new_nodes = self.load_index_nodes(input_files=diff.added + diff.changed) \
+            if diff.added or diff.changed else []
+        nodes_by_file = group_nodes_by_file(new_nodes)
+
+        # reuse the embeddings of nodes that did not change, they must be read before the old nodes are deleted
+        reused = 0
+        for path, nodes in nodes_by_file.items():
+            for node in nodes:
+                old_node_id = manifest.find_node(path, hash_node(node))
+                if old_node_id is not None:
+                    node.embedding = self.index.vector_store.get(old_node_id)
+                    reused += 1
+
+        # embed before the docstore is touched, so its transaction does not wait for the embedding requests
+        self.report_progress(f'Inserting {len(new_nodes)} nodes, {len(new_nodes) - reused} of them need new embeddings')
+        self.embedding_pipeline.embed_nodes(new_nodes)
+
+        with self.docstore_transaction():
+            # drop the nodes of changed and removed files from the vector store and docstore
+            for path in diff.changed + diff.removed:
+                for ref_doc_id in manifest.files[path]["ref_doc_ids"]:
+                    self.index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+                manifest.forget_file(path)
+
+            self.index.insert_nodes(new_nodes)
+
+        for path in diff.added + diff.changed:
+            manifest.record_file(path, file_hashes[path], nodes_by_file.get(path, []))
+        manifest.chunker = self.chunker_id
+        self.manifest = manifest
+
+        self.report_progress('Saving index')
+        self.index.storage_context.persist(persist_dir=self.persist_dir)
+        self.manifest.persist(self.persist_dir)
+        self.persisted = True
+
+        return diff
+
     def setup_index(self):
         """
         Sets up the index for the vector store. If the index is already present in the storage context, it is loaded
         from there. Otherwise, a new index is built from the markdown files in the input directory and saved to the
         storage context for future use.
+
+        In incremental mode a loaded index is then brought up to date with the source folder, see `update_index`.
+        In read-only mode the persisted index is only loaded, it must exist.
         """
         try:
-            logger.info('Loading index...')
+            self.report_progress('Loading index')
+            docstore, index_store = self.create_docstores(load=True)
             storage_context = StorageContext.from_defaults(
-                persist_dir=self.persist_dir)
-            self.index = load_index_from_storage(storage_context)
+                persist_dir=self.persist_dir,
+                docstore=docstore,
+                index_store=index_store,
+                vector_store=self.create_vector_store(load=True))
+            self.index = load_index_from_storage(
+                storage_context,
+                service_context=ServiceContext.from_defaults(
+                    llm_predictor=self.llm_predictor,
+                    embed_model=self.embed_model,
+                ))
         except Exception as e:
+            if self.read_only:
+                raise RuntimeError(f'No persisted index to attach to in {self.persist_dir}, build it first.') from e
             logger.info('Persisted Index not found, building new one.')
 
             # create index
             self.index = self.create_index()
 
-            logger.info('Saving index...')
+            self.report_progress('Saving index')
             self.index.storage_context.persist(persist_dir=self.persist_dir)
+            self.manifest.persist(self.persist_dir)
+            self.persisted = True
+        else:
+            if self.incremental and not self.read_only:
+                self.update_index()
+            else:
+                # the node hashes are only needed to update the index
+                self.manifest = IndexManifest.from_persist_dir(self.persist_dir, with_nodes=not self.read_only)
+
+        if self.retriever_mode == "hybrid":
+            self.bm25_index = self.load_bm25_index()
+
+    def load_bm25_index(self) -> BM25Index:
+        """
+        Loads the BM25 index persisted next to the vector index, or builds it from the docstore when it is missing
+        or was built from another version of the corpus.
+        """
+        version = self.manifest.version
+        if BM25Index.exists(self.persist_dir):
+            bm25_index = BM25Index.from_persist_dir(self.persist_dir)
+            if bm25_index.version == version:
+                return bm25_index
+
+        self.report_progress('Building BM25 index')
+        bm25_index = BM25Index.from_docstore(self.index.docstore, version=version)
+        if self.read_only:
+            logger.warning('The persisted BM25 index is missing or outdated, this process uses its own copy.')
+            return bm25_index
+        bm25_index.persist(self.persist_dir)
+        self.persisted = True
+        return bm25_index
 
     def create_service_context(self, callback_handler: BaseCallbackHandler = None) -> ServiceContext:
         """
@@ -147,8 +490,10 @@ class QuantSimpleVectorStorage:
 
         return ServiceContext.from_defaults(
             llm_predictor=llm_predictor,
+            embed_model=self.embed_model,
             chunk_size=1024,
-            callback_manager=CallbackManager([callback_handler])
+            callback_manager=CallbackManager(
+                ([callback_handler] if callback_handler is not None else []) + self.callback_handlers)
         )
 
     def create_query_engine(self, callback_handler: BaseCallbackHandler = None) -> RetrieverQueryEngine:
@@ -164,8 +509,24 @@ class QuantSimpleVectorStorage:
         # Configure retriever within the service context
         retriever = VectorIndexRetriever(
             index=self.index,
-            similarity_top_k=20,
+            similarity_top_k=self.similarity_top_k,
         )
+        node_postprocessors = [SimilarityPostprocessor(similarity_cutoff=self.similarity_cutoff)]
+
+        if self.retriever_mode == "hybrid":
+            # fused scores are ranks, not similarities, so the cutoff is applied to the vector results, and a
+            # question without any vector result above it gets no BM25 results either
+            retriever = HybridRetriever(
+                vector_retriever=retriever,
+                bm25_retriever=BM25Retriever(self.bm25_index, self.index.docstore,
+                                             similarity_top_k=self.similarity_top_k),
+                similarity_top_k=self.hybrid_top_k,
+                vector_similarity_cutoff=self.similarity_cutoff,
+            )
+            node_postprocessors = []
+
+        if self.context_token_budget is not None:
+            node_postprocessors.append(TokenBudgetPostprocessor(token_budget=self.context_token_budget))
 
         # Configure response synthesizer within the service context
         response_synthesizer = get_response_synthesizer(
@@ -177,8 +538,6 @@ class QuantSimpleVectorStorage:
             retriever=retriever,
             response_synthesizer=response_synthesizer,
             service_context=service_context,
-            node_postprocessors=[
-                SimilarityPostprocessor(similarity_cutoff=0.73)
-            ]
+            node_postprocessors=node_postprocessors,
         )
         return query_engine
@@ -0,0 +1,196 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from llama_index.data_structs.data_structs import IndexStruct
+from llama_index.schema import BaseNode
+from llama_index.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.storage.docstore.utils import json_to_doc
+from llama_index.storage.index_store.keyval_index_store import KVIndexStore
+from llama_index.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_PERSIST_FNAME = "docstore.sqlite"
+
+
+class SQLiteKVStore(BaseKVStore):
+    """
+    A llama_index key-value store in a SQLite file in WAL mode. Every value is a JSON row keyed by (collection, key),
+    so one node or index struct is read without loading the others. Each thread opens its own connection, and any
+    number of reader processes keep reading while one writer updates the file.
+
+    Writes are committed one by one, or together at the end of a `transaction`; until then readers see the previous
+    content.
+
+    Attributes:
+            path (str): The SQLite database file.
+            timeout (float): Seconds a writer waits for another writer to commit.
+            read_only (bool): If True, the connections refuse every write, e.g. in serving processes that attach to
+                an index another process maintains.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0, read_only: bool = False):
+        self.path = path
+        self.timeout = timeout
+        self.read_only = read_only
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        if read_only:
+            return
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " collection TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (collection, key)) WITHOUT ROWID"
+        )
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, **kwargs) -> "SQLiteKVStore":
+        return cls(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME), **kwargs)
+
+    @staticmethod
+    def exists(persist_dir: str) -> bool:
+        return os.path.exists(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME))
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit, `transaction` opens the transactions explicitly
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            if self.read_only:
+                conn.execute("PRAGMA query_only=ON")
+            else:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Commits the writes of the calling thread in the block at once, or none of them if it raises. Nested blocks
+        join the outer transaction.
+        """
+        conn = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self._connection().execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (collection, key, json.dumps(val)))
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT value FROM kv WHERE collection = ? AND key = ?", (collection, key)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_many(self, keys: Sequence[str], collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        """
+        Returns the values of the given keys. Missing keys are left out of the result.
+        """
+        found: Dict[str, dict] = {}
+        # stay below SQLite's limit of host parameters per statement
+        for start in range(0, len(keys), 500):
+            chunk = list(keys[start:start + 500])
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._connection().execute(
+                f"SELECT key, value FROM kv WHERE collection = ? AND key IN ({placeholders})",
+                [collection, *chunk],
+            ).fetchall()
+            for key, value in rows:
+                found[key] = json.loads(value)
+        return found
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        rows = self._connection().execute("SELECT key, value FROM kv WHERE collection = ?", (collection,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        cursor = self._connection().execute("DELETE FROM kv WHERE collection = ? AND key = ?", (collection, key))
+        return cursor.rowcount > 0
+
+    def clear(self):
+        """
+        Deletes every collection, e.g. before a rebuild in a `transaction`.
+        """
+        self._connection().execute("DELETE FROM kv")
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class SQLiteDocumentStore(KVDocumentStore):
+    """
+    A docstore in a `SQLiteKVStore`. The nodes stay on disk and are read by ID when they are retrieved, so serving
+    processes sharing one index only hold the nodes they use. Every write is in the SQLite file as soon as it is
+    committed, `persist` has nothing left to do.
+    """
+
+    def __init__(self, kvstore: SQLiteKVStore, namespace: Optional[str] = None):
+        super().__init__(kvstore, namespace=namespace)
+        self.kvstore = kvstore
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: Optional[str] = None) -> "SQLiteDocumentStore":
+        return cls(SQLiteKVStore.from_persist_dir(persist_dir), namespace=namespace)
+
+    def get_nodes(self, node_ids: List[str], raise_error: bool = True) -> List[BaseNode]:
+        # one query for all the retrieved nodes instead of one per node
+        found = self.kvstore.get_many(node_ids, collection=self._node_collection)
+        nodes = []
+        for node_id in node_ids:
+            if node_id not in found:
+                if raise_error:
+                    raise ValueError(f"node_id {node_id} not found.")
+                continue
+            nodes.append(json_to_doc(found[node_id]))
+        return nodes
+
+
+class SQLiteIndexStore(KVIndexStore):
+    """
+    An index store in a `SQLiteKVStore`, usually the one of the SQLiteDocumentStore.
+    """
+
+    def __init__(self, kvstore: SQLiteKVStore, namespace: Optional[str] = None):
+        super().__init__(kvstore, namespace=namespace)
+        self.kvstore = kvstore
+
+    def add_index_struct(self, index_struct: IndexStruct) -> None:
+        # loading an index writes its struct back, which a read-only store has no need for
+        if self.kvstore.read_only:
+            return
+        super().add_index_struct(index_struct)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from contextlib import nullcontext
+from typing import AsyncContextManager, AsyncIterator, List, Optional, Sequence
+
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.indices.service_context import ServiceContext
+from llama_index.llms.base import LLM, ChatMessage, ChatResponse, MessageRole
+from llama_index.llms.langchain import LangChainLLM
+from llama_index.llms.langchain_utils import to_lc_messages
+from llama_index.prompts import BasePromptTemplate
+from llama_index.prompts.default_prompt_selectors import DEFAULT_TREE_SUMMARIZE_PROMPT_SEL
+from llama_index.query_engine.retriever_query_engine import RetrieverQueryEngine
+from llama_index.schema import MetadataMode, NodeWithScore
+from llama_index.utils import globals_helper
+
+from quantgptlib.llm_scheduler import FairLLMScheduler
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class AsyncTreeSummarizer:
+    """
+    An async, token-streaming version of the `tree_summarize` response mode.
+
+    The retrieved chunks are repacked to fill the context window and summarized level by level, every level
+    concurrently, until a single chunk is left. The answer to that chunk is streamed token by token. Every LLM
+    call is a native async request, so a streaming answer holds no worker thread.
+
+    llama_index's LangChain wrapper implements its async methods by calling the blocking ones, so a LangChain
+    model is called directly through its `ainvoke` and `astream`. Every call still emits an LLM callback event
+    with the same payload as llama_index's own calls, so handlers such as TokenCountingHandler see the number
+    of LLM calls and prompt tokens of every answer.
+
+    With a scheduler, every LLM call waits for a slot of the scheduler first, with its prompt tokens and the
+    model's output tokens as the token estimate.
+
+    Attributes:
+            service_context (ServiceContext): Provides the LLM and the prompt helper used for repacking.
+            summary_template (BasePromptTemplate): The tree summarize prompt.
+            scheduler (Optional[FairLLMScheduler]): Admits the LLM calls, None to send them right away.
+    """
+
+    def __init__(self, service_context: ServiceContext,
+                 summary_template: BasePromptTemplate = DEFAULT_TREE_SUMMARIZE_PROMPT_SEL,
+                 scheduler: Optional[FairLLMScheduler] = None):
+        self.service_context = service_context
+        self.summary_template = summary_template
+        self.scheduler = scheduler
+
+    @classmethod
+    def from_query_engine(cls, query_engine: RetrieverQueryEngine,
+                          scheduler: Optional[FairLLMScheduler] = None) -> "AsyncTreeSummarizer":
+        """
+        Creates a summarizer with the LLM and the (possibly customized) summary prompt of a query engine.
+        """
+        synthesizer = query_engine._response_synthesizer
+        prompts = query_engine.get_prompts()
+        return cls(
+            service_context=synthesizer.service_context,
+            summary_template=prompts.get("response_synthesizer:summary_template", DEFAULT_TREE_SUMMARIZE_PROMPT_SEL),
+            scheduler=scheduler,
+        )
+
+    @property
+    def llm(self) -> LLM:
+        return self.service_context.llm
+
+    def _messages(self, template: BasePromptTemplate, context_str: str) -> List[ChatMessage]:
+        return template.format_messages(llm=self.llm, context_str=context_str)
+
+    def _slot(self, messages: List[ChatMessage]) -> AsyncContextManager:
+        if self.scheduler is None:
+            return nullcontext()
+        prompt_tokens = sum(len(globals_helper.tokenizer(message.content or "")) for message in messages)
+        return self.scheduler.slot(tokens=prompt_tokens + max(self.llm.metadata.num_output, 0))
+
+    def _end_payload(self, messages: List[ChatMessage], text: str) -> dict:
+        response = ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=text))
+        return {EventPayload.MESSAGES: messages, EventPayload.RESPONSE: response}
+
+    async def _apredict(self, template: BasePromptTemplate, context_str: str) -> str:
+        messages = self._messages(template, context_str)
+        callback_manager = self.service_context.callback_manager
+        async with self._slot(messages):
+            with callback_manager.event(CBEventType.LLM, payload={EventPayload.MESSAGES: messages}) as event:
+                if isinstance(self.llm, LangChainLLM):
+                    result = await self.llm.llm.ainvoke(to_lc_messages(messages))
+                    text = result.content
+                else:
+                    response = await self.llm.achat(messages)
+                    text = response.message.content or ""
+                event.on_end(payload=self._end_payload(messages, text))
+        return text
+
+    async def _astream(self, template: BasePromptTemplate, context_str: str) -> AsyncIterator[str]:
+        messages = self._messages(template, context_str)
+        callback_manager = self.service_context.callback_manager
+        # the slot is held until the answer is streamed, the request runs as long as that
+        async with self._slot(messages):
+            with callback_manager.event(CBEventType.LLM, payload={EventPayload.MESSAGES: messages}) as event:
+                tokens = []
+                if isinstance(self.llm, LangChainLLM):
+                    async for chunk in self.llm.llm.astream(to_lc_messages(messages)):
+                        if chunk.content:
+                            tokens.append(chunk.content)
+                            yield chunk.content
+                else:
+                    async for response in await self.llm.astream_chat(messages):
+                        if response.delta:
+                            tokens.append(response.delta)
+                            yield response.delta
+                event.on_end(payload=self._end_payload(messages, "".join(tokens)))
+
+    async def astream(self, query_str: str, nodes: Sequence[NodeWithScore]) -> AsyncIterator[str]:
+        """
+        Summarizes the nodes into an answer to the query and yields the answer as it is generated.
+        """
+        template = self.summary_template.partial_format(query_str=query_str)
+        text_chunks = [node.node.get_content(metadata_mode=MetadataMode.LLM) for node in nodes]
+        if not text_chunks:
+            # same as the synchronous synthesizer, the LLM answers from an empty context
+            text_chunks = [""]
+
+        prompt_helper = self.service_context.prompt_helper
+        text_chunks = prompt_helper.repack(template, text_chunks=text_chunks) or [""]
+        while len(text_chunks) > 1:
+            logger.debug(f"Summarizing {len(text_chunks)} chunks before the final answer.")
+            summaries = await asyncio.gather(*(self._apredict(template, chunk) for chunk in text_chunks))
+            text_chunks = prompt_helper.repack(template, text_chunks=summaries) or [""]
+
+        async for token in self._astream(template, text_chunks[0]):
+            yield token
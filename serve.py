@@ -0,0 +1,212 @@
+"""
+Serves QuantGPT from several Chainlit worker processes that share one index.
+
+    python serve.py --workers 4 --port 8000
+
+The index is built or updated first by `python -m quantgptlib.build_index`, then every worker attaches to it
+read-only. With VECTOR_STORE_TYPE="numpy" and DOCSTORE_TYPE="sqlite" the embeddings, node ids and BM25 postings are
+memory-mapped and the chunks are read from docstore.sqlite, so the workers share one copy of the index in the page
+cache and every additional worker only costs its own Python heap.
+
+Every build is published as a new generation, ./index/current points to the latest one (see
+quantgptlib.index_generations). A worker attaches to the generation that is current when it starts and keeps serving
+it, so an update never changes the index under a running worker. The older generations are removed once every worker
+was restarted on the new one.
+
+Worker i listens on `--port` + i and serves its metrics on METRICS_PORT + i. Put a load balancer with sticky
+sessions in front of them, Chainlit keeps a websocket per chat. A worker that exits is restarted. SIGHUP updates the
+index and restarts the workers one at a time, SIGINT or SIGTERM stops them.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+import subprocess
+from typing import List, Optional
+
+# only the standard library, the supervisor never loads the index
+from quantgptlib.index_generations import UNCHANGED_EXIT_CODE, remove_old_generations
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+logger = logging.getLogger("serve")
+
+# the PERSIST_DIR of quantgptlib.build_index
+INDEX_DIR = "./index"
+
+
+class Worker:
+    """
+    One `chainlit run quantgpt.py` process.
+
+    Attributes:
+            worker_id (int): The number of the worker, passed to it as QUANTGPT_WORKER_ID.
+            port (int): The port the worker listens on.
+            process (Optional[subprocess.Popen]): The running process.
+            started_at (float): When the process was started, to hold back restarts of a worker that keeps crashing.
+    """
+
+    def __init__(self, worker_id: int, port: int, host: str, app: str):
+        self.worker_id = worker_id
+        self.port = port
+        self.host = host
+        self.app = app
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+
+    def start(self):
+        env = dict(os.environ, QUANTGPT_WORKER_ID=str(self.worker_id))
+        self.process = subprocess.Popen(
+            ["chainlit", "run", self.app, "--headless", "--host", self.host, "--port", str(self.port)], env=env)
+        self.started_at = time.monotonic()
+        logger.info(f"Worker {self.worker_id} started on port {self.port}, pid {self.process.pid}.")
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout: float = 30.0):
+        if not self.is_running():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Worker {self.worker_id} did not stop in {timeout:.0f}s, killing it.")
+            self.process.kill()
+            self.process.wait()
+
+    def wait_listening(self, timeout: float) -> bool:
+        """
+        Waits until the worker accepts connections, i.e. it can take over the users of a worker that is restarted.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.is_running():
+            try:
+                with socket.create_connection((self.host, self.port), timeout=1.0):
+                    return True
+            except OSError:
+                time.sleep(0.5)
+        return False
+
+
+class Supervisor:
+    """
+    Keeps the index up to date and a fixed number of workers running.
+
+    Attributes:
+            workers (List[Worker]): The supervised workers.
+            restart_delay (float): Seconds to wait before a worker that exited within a minute is restarted.
+    """
+
+    def __init__(self, num_workers: int, port: int, host: str, app: str, restart_delay: float):
+        self.app = app
+        self.workers: List[Worker] = [Worker(i, port + i, host, app) for i in range(num_workers)]
+        self.restart_delay = restart_delay
+        self._stopping = False
+        self._reload = False
+
+    def build_index(self) -> Optional[bool]:
+        """
+        Builds or updates the index in a separate process, which exits once it is persisted so the supervisor
+        itself never holds the index.
+
+        Returns:
+            Optional[bool]: True if a new generation was published, False if the current one was up to date, None
+                if the build failed.
+        """
+        logger.info("Building or updating the index.")
+        env = dict(os.environ)
+        env.pop("QUANTGPT_WORKER_ID", None)
+        returncode = subprocess.run([sys.executable, "-m", "quantgptlib.build_index"], env=env).returncode
+        if returncode == UNCHANGED_EXIT_CODE:
+            return False
+        return True if returncode == 0 else None
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def rolling_restart(self) -> bool:
+        """
+        Restarts the workers one at a time, so the others keep serving the previous generation of the index while
+        a worker attaches to the new one.
+
+        Returns:
+            bool: True if every worker was restarted, False if the supervisor is stopping.
+        """
+        for worker in self.workers:
+            if self._stopping:
+                return False
+            worker.stop()
+            worker.start()
+            if not worker.wait_listening(timeout=120.0):
+                logger.warning(f"Worker {worker.worker_id} is not listening on port {worker.port}.")
+        return True
+
+    def run(self) -> int:
+        if self.build_index() is None:
+            logger.error("The index could not be built, no worker is started.")
+            return 1
+
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._on_reload)
+
+        # no worker runs yet, nothing serves the older generations
+        remove_old_generations(INDEX_DIR)
+        for worker in self.workers:
+            worker.start()
+
+        while not self._stopping:
+            time.sleep(1.0)
+            if self._reload:
+                self._reload = False
+                published = self.build_index()
+                if published:
+                    # once every worker serves the new generation, nothing reads the older ones
+                    if self.rolling_restart():
+                        remove_old_generations(INDEX_DIR)
+                elif published is False:
+                    logger.info("The index is up to date, the workers keep serving it.")
+                else:
+                    logger.error("The index update failed, the workers keep serving the previous index.")
+                continue
+
+            for worker in self.workers:
+                if self._stopping or worker.is_running():
+                    continue
+                logger.warning(f"Worker {worker.worker_id} exited with code {worker.process.returncode}.")
+                if time.monotonic() - worker.started_at < 60.0:
+                    time.sleep(self.restart_delay)
+                worker.start()
+
+        logger.info("Stopping the workers.")
+        for worker in self.workers:
+            if worker.is_running():
+                worker.process.terminate()
+        for worker in self.workers:
+            worker.stop()
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve QuantGPT from several workers that share one index.")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000, help="The port of the first worker.")
+    parser.add_argument("--app", default="quantgpt.py")
+    parser.add_argument("--restart-delay", type=float, default=5.0)
+    args = parser.parse_args()
+
+    supervisor = Supervisor(args.workers, args.port, args.host, args.app, args.restart_delay)
+    sys.exit(supervisor.run())
+
+
+if __name__ == "__main__":
+    main()
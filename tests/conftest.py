@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the app imports `quantgptlib` from the repository root and the crawler runs from `quant_scraper/`
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "quant_scraper")]
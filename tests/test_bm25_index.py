@@ -0,0 +1,88 @@
+from typing import List
+
+import pytest
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import NodeWithScore, TextNode
+from llama_index.storage.docstore import SimpleDocumentStore
+
+from quantgptlib.bm25_index import BM25Index, BM25Retriever, HybridRetriever
+
+TEXTS = {
+    "signals": "Portfolio.from_signals simulates a portfolio from entry and exit signals.",
+    "orders": "Portfolio.from_orders simulates a portfolio from a series of orders.",
+    "indicators": "The IndicatorFactory builds indicators such as the moving average.",
+    "data": "YFData downloads OHLCV data from Yahoo Finance.",
+}
+
+
+class StaticRetriever(BaseRetriever):
+    """Returns the same results for every query, in place of the embedding search."""
+
+    def __init__(self, results: List[NodeWithScore]):
+        self.results = results
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return list(self.results)
+
+
+@pytest.fixture
+def nodes():
+    return {node_id: TextNode(id_=node_id, text=text) for node_id, text in TEXTS.items()}
+
+
+@pytest.fixture
+def bm25_retriever(nodes):
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(list(nodes.values()))
+    return BM25Retriever(BM25Index.from_nodes(nodes.values()), docstore, similarity_top_k=3)
+
+
+def scored(nodes, *ranking):
+    return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in ranking]
+
+
+def test_bm25_ranks_the_node_with_the_identifier_first(bm25_retriever):
+    results = bm25_retriever.retrieve("how does from_orders work")
+    assert results[0].node.node_id == "orders"
+    assert results[0].score > 0
+
+
+def test_fusion_sums_the_reciprocal_ranks(nodes):
+    retriever = HybridRetriever(None, None, similarity_top_k=3, rrf_k=60)
+    fused = retriever.fuse(
+        scored(nodes, ("signals", 0.9), ("indicators", 0.8), ("orders", 0.7)),
+        scored(nodes, ("orders", 12.0), ("data", 3.0)),
+    )
+
+    assert [node.node.node_id for node in fused] == ["orders", "signals", "indicators"]
+    assert fused[0].score == pytest.approx(1 / 63 + 1 / 61)
+    assert fused[1].score == pytest.approx(1 / 61)
+
+
+def test_fusion_drops_vector_results_below_the_cutoff(nodes):
+    retriever = HybridRetriever(None, None, similarity_top_k=4, vector_similarity_cutoff=0.75)
+    fused = retriever.fuse(
+        scored(nodes, ("signals", 0.9), ("indicators", 0.5)),
+        scored(nodes, ("orders", 12.0)),
+    )
+
+    assert {node.node.node_id for node in fused} == {"signals", "orders"}
+
+
+def test_an_off_topic_question_gets_no_context(nodes, bm25_retriever):
+    vector_retriever = StaticRetriever(scored(nodes, ("signals", 0.3), ("data", 0.2)))
+    retriever = HybridRetriever(vector_retriever, bm25_retriever, vector_similarity_cutoff=0.75)
+
+    # BM25 alone matches the query, but no vector result passes the cutoff
+    assert bm25_retriever.retrieve("from_orders")
+    assert retriever.retrieve("from_orders") == []
+
+
+def test_hybrid_retrieval_pulls_up_exact_identifier_matches(nodes, bm25_retriever):
+    vector_retriever = StaticRetriever(scored(nodes, ("signals", 0.9), ("indicators", 0.85), ("orders", 0.8)))
+    retriever = HybridRetriever(vector_retriever, bm25_retriever, similarity_top_k=2, vector_similarity_cutoff=0.75)
+
+    # third by embedding, first by BM25, ahead of the second embedding match that shares no query term
+    assert [node.node.node_id for node in retriever.retrieve("Portfolio.from_orders")] == ["signals", "orders"]
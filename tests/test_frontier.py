@@ -0,0 +1,30 @@
+import pytest
+from scrapy import Request
+
+from quant_scraper.frontier import CanonicalDupeFilter, canonical_url
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://vectorbt.pro/api/portfolio", "https://vectorbt.pro/api/portfolio/"),
+    ("https://vectorbt.pro/api/portfolio/#from-signals", "https://vectorbt.pro/api/portfolio/"),
+    ("https://vectorbt.pro/api/portfolio/index.html?v=2", "https://vectorbt.pro/api/portfolio/"),
+    ("HTTPS://VectorBT.pro/Api/Portfolio/", "https://vectorbt.pro/Api/Portfolio/"),
+    ("https://vectorbt.pro", "https://vectorbt.pro/"),
+    ("https://vectorbt.pro/index.html", "https://vectorbt.pro/"),
+    ("https://vectorbt.pro/assets/logo.svg?v=1", "https://vectorbt.pro/assets/logo.svg"),
+])
+def test_canonical_url(url, expected):
+    assert canonical_url(url) == expected
+
+
+def test_canonical_url_is_idempotent():
+    url = canonical_url("https://vectorbt.pro/tutorials/index.html#top")
+    assert canonical_url(url) == url
+
+
+def test_dupe_filter_drops_other_spellings_of_a_page():
+    dupe_filter = CanonicalDupeFilter()
+    assert not dupe_filter.request_seen(Request("https://vectorbt.pro/api/portfolio"))
+    assert dupe_filter.request_seen(Request("https://vectorbt.pro/api/portfolio/#from-signals"))
+    assert dupe_filter.request_seen(Request("https://VECTORBT.pro/api/portfolio/index.html?v=2"))
+    assert not dupe_filter.request_seen(Request("https://vectorbt.pro/api/records"))
@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+
+from quantgptlib.llm_scheduler import FairLLMScheduler
+
+
+async def settle(rounds: int = 20):
+    # lets the queued tasks run until they wait on the scheduler again
+    for _ in range(rounds):
+        await asyncio.sleep(0)
+
+
+async def call(scheduler, user, log, name=None, on_position=None, release=None, tokens=0):
+    with scheduler.requester(user, on_position):
+        async with scheduler.slot(tokens):
+            log.append(name or user)
+            if release is not None:
+                await release.wait()
+
+
+def test_slots_are_handed_to_the_users_in_turn():
+    async def main():
+        scheduler = FairLLMScheduler(max_concurrent=1)
+        order, release = [], asyncio.Event()
+        blocker = asyncio.create_task(call(scheduler, "blocker", order, release=release))
+        await settle()
+        tasks = [asyncio.create_task(call(scheduler, "a", order, name=f"a{i}")) for i in range(3)]
+        tasks.append(asyncio.create_task(call(scheduler, "b", order, name="b0")))
+        await settle()
+        assert scheduler.running == 1 and scheduler.queued == 4
+
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        return order, scheduler
+
+    order, scheduler = asyncio.run(main())
+    assert order == ["blocker", "a0", "b0", "a1", "a2"]
+    assert scheduler.running == 0 and scheduler.queued == 0 and scheduler.completed == 5
+
+
+def test_queue_positions_are_reported_until_the_call_runs():
+    async def main():
+        scheduler = FairLLMScheduler(max_concurrent=1)
+        log, release = [], asyncio.Event()
+        positions = {"a": [], "b": []}
+
+        def recorder(user):
+            async def on_position(position):
+                positions[user].append(position)
+            return on_position
+
+        release_a = asyncio.Event()
+        blocker = asyncio.create_task(call(scheduler, "blocker", log, release=release))
+        await settle()
+        a = asyncio.create_task(call(scheduler, "a", log, on_position=recorder("a"), release=release_a))
+        await settle()
+        b = asyncio.create_task(call(scheduler, "b", log, on_position=recorder("b")))
+        await settle()
+        assert positions == {"a": [1], "b": [2]}
+
+        release.set()
+        await settle()
+        assert positions == {"a": [1, 0], "b": [2, 1]}
+
+        release_a.set()
+        await asyncio.gather(blocker, a, b)
+        return positions
+
+    positions = asyncio.run(main())
+    assert positions == {"a": [1, 0], "b": [2, 1, 0]}
+
+
+def test_a_failing_position_callback_does_not_fail_the_call():
+    async def main():
+        scheduler = FairLLMScheduler(max_concurrent=1)
+        log, release = [], asyncio.Event()
+
+        async def on_position(position):
+            raise RuntimeError("session closed")
+
+        blocker = asyncio.create_task(call(scheduler, "blocker", log, release=release))
+        await settle()
+        waiting = asyncio.create_task(call(scheduler, "a", log, on_position=on_position))
+        await settle()
+        release.set()
+        await asyncio.gather(blocker, waiting)
+        return log
+
+    assert asyncio.run(main()) == ["blocker", "a"]
+
+
+def test_a_cancelled_call_leaves_the_queue_or_frees_its_slot():
+    async def main():
+        scheduler = FairLLMScheduler(max_concurrent=1)
+        log, release = [], asyncio.Event()
+        running = asyncio.create_task(call(scheduler, "a", log, release=release))
+        await settle()
+        waiting = asyncio.create_task(call(scheduler, "b", log))
+        await settle()
+        assert scheduler.running == 1 and scheduler.queued == 1
+
+        waiting.cancel()
+        await settle()
+        assert scheduler.running == 1 and scheduler.queued == 0
+
+        running.cancel()
+        await settle()
+        assert scheduler.running == 0
+
+        # the freed slot is handed out again
+        await call(scheduler, "c", log)
+        return log, running, waiting
+
+    log, running, waiting = asyncio.run(main())
+    assert log == ["a", "c"]
+    assert running.cancelled() and waiting.cancelled()
+
+
+def test_a_call_waiting_for_tokens_is_not_queued():
+    async def main():
+        scheduler = FairLLMScheduler(max_concurrent=1, tokens_per_minute=60)
+        log = []
+        # the bucket starts full, the second call waits about a second for its tokens
+        await call(scheduler, "a", log, tokens=60)
+        waiting = asyncio.create_task(call(scheduler, "b", log, tokens=60))
+        await settle()
+        assert scheduler.running == 0 and scheduler.queued == 0
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        return log
+
+    assert asyncio.run(main()) == ["a"]
+
+
+def test_max_concurrent_must_be_positive():
+    with pytest.raises(ValueError):
+        FairLLMScheduler(max_concurrent=0)
@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+import pytest
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from quantgptlib.ivf_index import IVFIndex
+from quantgptlib.numpy_vector_store import NumpyVectorStore
+from quantgptlib.quantization import ScalarQuantizer
+
+DIM = 32
+NUM_NODES = 500
+
+
+def make_nodes(prefix: str, seed: int):
+    rng = np.random.default_rng(seed)
+    return [TextNode(id_=f"{prefix}{i}", text=f"node {i}", embedding=rng.normal(size=DIM).tolist())
+            for i in range(NUM_NODES)]
+
+
+def build(persist_path: str, nodes, **kwargs) -> NumpyVectorStore:
+    store = NumpyVectorStore(**kwargs)
+    store.add(nodes)
+    store.persist(persist_path)
+    return store
+
+
+def nearest(store: NumpyVectorStore, node: TextNode):
+    result = store.query(VectorStoreQuery(query_embedding=node.embedding, similarity_top_k=1))
+    return result.ids[0], result.similarities[0]
+
+
+@pytest.fixture
+def persist_path(tmp_path):
+    return str(tmp_path / "vector_store.json")
+
+
+def test_fingerprint_depends_on_the_ids_and_their_order():
+    ids = np.array(["a", "b", "c"])
+    assert NumpyVectorStore.fingerprint(ids) == NumpyVectorStore.fingerprint(ids.copy())
+    assert NumpyVectorStore.fingerprint(ids) != NumpyVectorStore.fingerprint(ids[::-1])
+    assert NumpyVectorStore.fingerprint(ids) != NumpyVectorStore.fingerprint(np.array(["a", "b", "d"]))
+    # the hash is computed in blocks, the block size does not change it
+    assert NumpyVectorStore.fingerprint(ids, block_size=1) == NumpyVectorStore.fingerprint(ids)
+
+
+def test_ivf_index_is_persisted_with_the_fingerprint_of_the_ids(persist_path):
+    nodes = make_nodes("a", seed=0)
+    store = build(persist_path, nodes, ann="ivf", exact_search_threshold=100)
+
+    ivf = IVFIndex.from_path(persist_path.replace(".json", "_ivf.npz"))
+    assert ivf.fingerprint == NumpyVectorStore.fingerprint(store._ids)
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path, ann="ivf", exact_search_threshold=100, nprobe=4)
+    assert loaded._ivf is not None
+    assert nearest(loaded, nodes[7]) == ("a7", pytest.approx(1.0))
+
+
+def test_stale_ivf_index_is_removed_on_persist(persist_path):
+    build(persist_path, make_nodes("a", seed=0), ann="ivf", exact_search_threshold=100)
+    ivf_path = persist_path.replace(".json", "_ivf.npz")
+    assert os.path.exists(ivf_path)
+
+    nodes = make_nodes("b", seed=1)
+    build(persist_path, nodes)
+    assert not os.path.exists(ivf_path)
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path, ann="ivf", exact_search_threshold=100)
+    assert loaded._ivf is None
+    assert nearest(loaded, nodes[192]) == ("b192", pytest.approx(1.0))
+
+
+def test_ivf_index_of_other_vectors_is_not_attached(persist_path):
+    build(persist_path, make_nodes("a", seed=0), ann="ivf", exact_search_threshold=100)
+    ivf_path = persist_path.replace(".json", "_ivf.npz")
+    stale = ivf_path + ".stale"
+    os.replace(ivf_path, stale)
+
+    # the same number of rows, so only the fingerprint tells the assignments apart
+    nodes = make_nodes("b", seed=1)
+    build(persist_path, nodes)
+    os.replace(stale, ivf_path)
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path, ann="ivf", exact_search_threshold=100, nprobe=1)
+    assert loaded._ivf is None
+    assert nearest(loaded, nodes[192]) == ("b192", pytest.approx(1.0))
+
+
+@pytest.mark.parametrize("quantization", ScalarQuantizer.KINDS)
+def test_codes_are_persisted_with_the_fingerprint_of_the_ids(persist_path, quantization):
+    nodes = make_nodes("a", seed=0)
+    store = build(persist_path, nodes, quantization=quantization)
+
+    quantizer = ScalarQuantizer.from_path(persist_path.replace(".json", "_quantizer.npz"))
+    assert quantizer.kind == quantization
+    assert quantizer.fingerprint == NumpyVectorStore.fingerprint(store._ids)
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path, quantization=quantization)
+    assert loaded.is_quantized
+    assert nearest(loaded, nodes[7]) == ("a7", pytest.approx(1.0))
+    loaded.close()
+
+
+def test_stale_codes_are_removed_on_persist(persist_path):
+    build(persist_path, make_nodes("a", seed=0), quantization="int8")
+    codes_path = persist_path.replace(".json", "_codes.npy")
+    quantizer_path = persist_path.replace(".json", "_quantizer.npz")
+
+    nodes = make_nodes("b", seed=1)
+    build(persist_path, nodes)
+    assert not os.path.exists(codes_path) and not os.path.exists(quantizer_path)
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path, quantization="int8")
+    assert not loaded.is_quantized
+    assert nearest(loaded, nodes[192]) == ("b192", pytest.approx(1.0))
+
+
+def test_codes_of_other_vectors_are_not_attached(persist_path):
+    build(persist_path, make_nodes("a", seed=0), quantization="int8")
+    stale = {}
+    for suffix in ("_codes.npy", "_quantizer.npz"):
+        path = persist_path.replace(".json", suffix)
+        stale[path] = path + ".stale"
+        os.replace(path, stale[path])
+
+    # the same number of rows, so only the fingerprint tells the codes apart
+    nodes = make_nodes("b", seed=1)
+    build(persist_path, nodes)
+    for path, stale_path in stale.items():
+        os.replace(stale_path, path)
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path, quantization="int8")
+    assert not loaded.is_quantized
+    assert nearest(loaded, nodes[192]) == ("b192", pytest.approx(1.0))
+
+
+def test_codes_of_another_kind_are_not_attached(persist_path):
+    build(persist_path, make_nodes("a", seed=0), quantization="float16")
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path, quantization="int8")
+    assert not loaded.is_quantized